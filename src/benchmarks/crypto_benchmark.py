@@ -0,0 +1,221 @@
+"""
+Throughput of ciphers and hash functions
+
+Run from src directory:
+    python -m benchmarks.crypto_benchmark --output crypto.jsonl
+    python -m benchmarks.crypto_benchmark --compare crypto.jsonl
+
+Every measurement is a json line with MB/s (wall time) and CPU nanoseconds per byte
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+
+import entity
+import utils
+from crypto import CipherBase, CipherType
+from crypto.aes_convergent import AesConvergent
+from crypto.aes_gcm import AesGcm
+from crypto.cipher_creator import CipherCreator
+
+MB = 2 ** 20
+KEY = entity.Key(id=1, key="benchmark-key")
+
+
+def _cipher(cipher_type: CipherType, chunk_size: int) -> CipherBase:
+    if cipher_type == CipherType.AES_GCM:
+        return AesGcm(KEY, chunk_size=chunk_size)
+    if cipher_type == CipherType.AES_CONVERGENT:
+        return AesConvergent(KEY, chunk_size=chunk_size)
+    return CipherCreator.create(cipher_type, KEY)
+
+
+def _stream(transform, data: bytes, chunk_size: int) -> bytes:
+    output = [transform.update(data[offset:offset + chunk_size]) for offset in range(0, len(data), chunk_size)]
+    output.append(transform.finalize())
+    return b''.join(output)
+
+
+def _encrypt(cipher_type: str, chunk_size: int, data: bytes) -> int:
+    cipher = _cipher(CipherType.from_str(cipher_type), chunk_size)
+    # convergent cipher needs hash of plaintext before the first chunk, as uploader does
+    return len(_stream(cipher.encryptor(hashlib.sha256(data).digest()), data, chunk_size))
+
+
+def _decrypt(cipher_type: str, chunk_size: int, data: bytes) -> int:
+    cipher = _cipher(CipherType.from_str(cipher_type), chunk_size)
+    return len(_stream(cipher.decryptor(), data, chunk_size))
+
+
+def _hash(name: str, chunk_size: int, data: bytes) -> int:
+    h = hashlib.new(name)
+    view = memoryview(data)
+    for offset in range(0, len(data), chunk_size):
+        h.update(view[offset:offset + chunk_size])
+    return len(h.digest())
+
+
+def _hash_file(name: str, chunk_size: int, path: str) -> int:
+    # the same loop as utils.sha1_checksum for other hash functions
+    h = hashlib.new(name)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return len(h.digest())
+
+
+def _measure(func: Callable, args: tuple, size: int, repeat: int, workers: int,
+             executor: Optional[Executor]) -> Dict[str, float]:
+    """
+    Run func repeat times (by workers simultaneous jobs if executor is given)
+    and return the best wall time throughput and CPU time per byte
+    """
+    best_wall, cpu = None, 0.0
+    for _ in range(repeat):
+        cpu_started, started = time.process_time(), time.perf_counter()
+        if executor:
+            list(executor.map(func, *zip(*[args] * workers)))
+        else:
+            func(*args)
+        wall = time.perf_counter() - started
+        cpu += time.process_time() - cpu_started
+        best_wall = wall if best_wall is None else min(best_wall, wall)
+
+    total = size * workers
+    return {
+        'mb_per_s': round(total / MB / best_wall, 2),
+        # process time doesn't include child processes, so it's meaningful for threads and single mode only
+        'cpu_ns_per_byte': round(cpu / repeat / total * 1e9, 3),
+    }
+
+
+def run(block_sizes: Iterable[int], chunk_sizes: Iterable[int], ciphers: Iterable[str], hashes: Iterable[str],
+        modes: Iterable[str], workers: int, repeat: int) -> List[dict]:
+    results = []
+    executors = {
+        'single': None,
+        'threads': ThreadPoolExecutor(workers),
+        'processes': ProcessPoolExecutor(workers),
+    }
+
+    def record(**fields):
+        results.append(fields)
+        print(json.dumps(fields), file=sys.stderr)
+
+    try:
+        for block_size in block_sizes:
+            data = os.urandom(block_size)
+            with tempfile.NamedTemporaryFile() as file:
+                file.write(data)
+                file.flush()
+
+                for mode in modes:
+                    executor = executors[mode]
+                    count = workers if executor else 1
+
+                    for chunk_size in chunk_sizes:
+                        for cipher_type in ciphers:
+                            encrypted = _cipher(CipherType.from_str(cipher_type), chunk_size).encrypt(data)
+                            for operation, func, arg in (('encrypt', _encrypt, data), ('decrypt', _decrypt, encrypted)):
+                                record(kind='cipher', name=cipher_type, operation=operation, mode=mode,
+                                       workers=count, block_size=block_size, chunk_size=chunk_size,
+                                       **_measure(func, (cipher_type, chunk_size, arg), block_size, repeat, count,
+                                                  executor))
+
+                        for name in hashes:
+                            record(kind='hash', name=name, operation='memory', mode=mode, workers=count,
+                                   block_size=block_size, chunk_size=chunk_size,
+                                   **_measure(_hash, (name, chunk_size, data), block_size, repeat, count, executor))
+                            record(kind='hash', name=name, operation='file', mode=mode, workers=count,
+                                   block_size=block_size, chunk_size=chunk_size,
+                                   **_measure(_hash_file, (name, chunk_size, file.name), block_size, repeat, count,
+                                              executor))
+
+                    # the function used by uploader and downloader as is
+                    record(kind='hash', name='utils.sha1_checksum', operation='file', mode=mode, workers=count,
+                           block_size=block_size, chunk_size=4096,
+                           **_measure(utils.sha1_checksum, (file.name,), block_size, repeat, count, executor))
+    finally:
+        for executor in executors.values():
+            if executor:
+                executor.shutdown()
+
+    return results
+
+
+def _key(result: dict) -> tuple:
+    return tuple(result[field] for field in ('kind', 'name', 'operation', 'mode', 'workers', 'block_size',
+                                             'chunk_size'))
+
+
+def compare(old: List[dict], new: List[dict]) -> None:
+    """
+    Print throughput change of every measurement present in both results
+    """
+    old_by_key = {_key(result): result for result in old if 'kind' in result}
+    print(f"{'measurement':<80} {'old MB/s':>10} {'new MB/s':>10} {'change':>8}")
+    for result in new:
+        if 'kind' not in result or _key(result) not in old_by_key:
+            continue
+        before, after = old_by_key[_key(result)]['mb_per_s'], result['mb_per_s']
+        name = ' '.join(str(field) for field in _key(result))
+        print(f"{name:<80} {before:>10} {after:>10} {(after - before) / before * 100:>7.1f}%")
+
+
+def _sizes(s: str) -> List[int]:
+    units = {'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30}
+    sizes = []
+    for item in s.lower().split(','):
+        item = item.strip()
+        sizes.append(int(float(item[:-1]) * units[item[-1]]) if item[-1] in units else int(item))
+    return sizes
+
+
+def _load(path: str) -> List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of ciphers and hash functions")
+    parser.add_argument("--block-sizes", default="1m,5m,20m", type=_sizes, help="Comma separated sizes (k, m, g)")
+    parser.add_argument("--chunk-sizes", default="4k,64k,1m", type=_sizes, help="Comma separated sizes (k, m, g)")
+    parser.add_argument("--ciphers", default=",".join(str(t) for t in CipherType), type=lambda s: s.split(','))
+    parser.add_argument("--hashes", default="sha1,md5,sha256", type=lambda s: s.split(','))
+    parser.add_argument("--modes", default="single,threads,processes", type=lambda s: s.split(','))
+    parser.add_argument("--workers", default=os.cpu_count() or 1, type=int, help="Size of pools")
+    parser.add_argument("--repeat", default=3, type=int)
+    parser.add_argument("--output", help="Write json lines to file instead of stdout")
+    parser.add_argument("--compare", help="Compare with results of previous run")
+    args = parser.parse_args()
+
+    results = run(args.block_sizes, args.chunk_sizes, args.ciphers, args.hashes, args.modes,
+                  args.workers, args.repeat)
+    meta = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+    lines = [json.dumps(meta)] + [json.dumps(result) for result in results]
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        print("\n".join(lines))
+
+    if args.compare:
+        compare(_load(args.compare), results)
+
+
+if __name__ == '__main__':
+    main()
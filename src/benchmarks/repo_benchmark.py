@@ -0,0 +1,209 @@
+"""
+Latency of BlockRepo queries on a synthetic catalog
+
+Run from src directory:
+    python -m benchmarks.repo_benchmark --blocks 10000000
+    python -m benchmarks.repo_benchmark --blocks 1000000 --no-profile  # without indexes and tuned pragmas
+    python -m benchmarks.repo_benchmark --readers 0  # all queries by writer connection
+
+Catalog is built once per database file and reused by next runs.
+Deleting queries remove --count random files and blocks on every run
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from typing import Awaitable, Callable, Dict, List
+
+import entity
+from repository.block_repo import BlockRepo
+
+INDEXES = ("block_content_hash", "block_file_number", "block_name", "block_storage_size")
+
+
+def _name(i: int) -> str:
+    return f"{i:032x}"
+
+
+async def build(repo: BlockRepo, blocks: int, blocks_per_file: int, storages: int, duplicates: int) -> None:
+    """
+    Fill empty repository with files of blocks_per_file blocks, every block has duplicates in different storages
+    """
+    await repo.add_rows("storage", ("id", "token", "type"),
+                        [(i, f"token-{i}", "yandex-disk") for i in range(1, storages + 1)])
+    files = -(-blocks // (blocks_per_file * duplicates))
+    await repo.add_rows("file", ("id", "filename", "size", "uploaded_blocks", "total_blocks", "checksum"),
+                        ((i, f"dir{i % 1000}/file{i}", blocks_per_file * 2 ** 20,
+                          blocks_per_file * duplicates, blocks_per_file, _name(i)) for i in range(1, files + 1)))
+
+    def rows():
+        for i in range(blocks):
+            number, duplicate = divmod(i, duplicates)
+            file_id, number = divmod(number, blocks_per_file)
+            storage_id = (file_id + number + duplicate) % storages + 1
+            yield (number, _name(i), 2 ** 20, storage_id, file_id + 1, _name(i), _name(i // duplicates))
+
+    await repo.add_rows("block", ("number", "name", "size", "storage_id", "file_id", "checksum", "content_hash"),
+                        rows())
+    await repo.commit()
+    await repo.execute("ANALYZE")
+    await repo.commit()
+
+
+async def sample(repo: BlockRepo, table: str, count: int, rand: random.Random) -> List[int]:
+    """
+    Choose random ids of existing rows (deleting queries of previous runs leave gaps)
+    """
+    cur = await repo.execute(f"SELECT max(id), count(*) FROM {table}")
+    upper, total = await cur.fetchone()
+    ids: List[int] = []
+    while len(ids) < min(count, total):
+        candidates = rand.sample(range(1, upper + 1), min(upper, count * 2))
+        cur = await repo.execute(f"SELECT id FROM {table} WHERE id IN ({','.join('?' * len(candidates))})",
+                                 candidates)
+        existing = {row[0] for row in await cur.fetchall()}
+        ids.extend(i for i in candidates if i in existing and i not in ids)
+    return ids[:count]
+
+
+async def measure(name: str, func: Callable[[int], Awaitable], ids: List[int]) -> Dict[str, float]:
+    latencies = []
+    for arg in ids:
+        started = time.perf_counter()
+        await func(arg)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    count = len(latencies)
+    return {
+        'query': name,
+        'count': count,
+        'mean_ms': round(sum(latencies) / count * 1000, 3),
+        'p50_ms': round(latencies[count // 2] * 1000, 3),
+        'p99_ms': round(latencies[min(count - 1, count * 99 // 100)] * 1000, 3),
+    }
+
+
+async def write_load(repo: BlockRepo, stop: asyncio.Event, batch: int) -> None:
+    """
+    Insert and commit batches of blocks of a new file until stopped, like uploads do
+    """
+    cur = await repo.execute("SELECT max(id) FROM file")
+    file_id = (await cur.fetchone())[0] + 1
+    await repo.add_row("file", {"id": file_id, "filename": f"load{file_id}", "size": 0, "uploaded_blocks": 0,
+                                "total_blocks": 0, "checksum": ""})
+    number = 0
+    while not stop.is_set():
+        await repo.add_rows("block", ("number", "name", "size", "storage_id", "file_id"),
+                            [(number + i, f"load-{file_id}-{number + i}", 2 ** 20, 1, file_id) for i in range(batch)])
+        await repo.commit()
+        number += batch
+    await repo.del_file(entity.File(filename=f"load{file_id}"))
+    await repo.commit()
+
+
+async def run(args: argparse.Namespace) -> List[dict]:
+    BlockRepo.reader_num = args.readers
+    if args.no_profile:
+        # the same schema and pragmas as before indexes and tuning
+        BlockRepo.pragmas = (("foreign_keys", "ON"), ("journal_mode", "DELETE"), ("synchronous", "FULL"))
+
+    exists = os.path.exists(args.database)
+    repo = await BlockRepo(args.database)
+    try:
+        if args.no_profile:
+            for index in INDEXES:
+                await repo.execute(f"DROP INDEX IF EXISTS {index}")
+        if not exists:
+            started = time.perf_counter()
+            await build(repo, args.blocks, args.blocks_per_file, args.storages, args.duplicates)
+            print(f"Catalog of {args.blocks} blocks built in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+        storage = await repo.get_storage_by_id(1)
+        rand = random.Random(args.seed)
+
+        async def file_by_name(i):
+            return await repo.get_file_by_filename(f"dir{i % 1000}/file{i}")
+
+        async def blocks_by_file(i):
+            return await repo.get_blocks_by_file(entity.File(id=i))
+
+        async def grouped_blocks(i):
+            return await repo.get_blocks_grouped_by_number(entity.File(id=i))
+
+        async def replicas(i):
+            return await repo.get_replica_storage_ids(entity.Block(file=entity.File(id=i), number=0))
+
+        async def shared(i):
+            cur = await repo.execute("SELECT storage_id FROM block WHERE id = ?", (i,))
+            block = entity.Block(name=_name(i - 1), storage=await repo.get_storage_by_id((await cur.fetchone())[0]))
+            return await repo.get_block_ids_by_data(block)
+
+        async def copies(i):
+            return await repo.get_block_copies(entity.Block(content_hash=_name(i // args.duplicates),
+                                                            size=2 ** 20))
+
+        async def delete_by_name(i):
+            await repo.del_blocks([entity.Block(name=_name(i - 1), storage=storage)])
+            await repo.commit()
+
+        async def delete_file(i):
+            await repo.del_file(entity.File(filename=f"dir{i % 1000}/file{i}"))
+            await repo.commit()
+
+        results = []
+        for name, func, table in (("get_file_by_filename", file_by_name, "file"),
+                                  ("get_blocks_by_file", blocks_by_file, "file"),
+                                  ("get_blocks_grouped_by_number", grouped_blocks, "file"),
+                                  ("get_replica_storage_ids", replicas, "file"),
+                                  ("get_block_ids_by_data", shared, "block"),
+                                  ("get_block_copies", copies, "block"),
+                                  ("get_blocks_by_file while writing", blocks_by_file, "file"),
+                                  # deleting queries change catalog, so they are the last
+                                  ("del_blocks by name", delete_by_name, "block"),
+                                  ("del_file", delete_file, "file")):
+            ids = await sample(repo, table, args.count, rand)
+            if name.endswith("while writing"):
+                stop = asyncio.Event()
+                writer = asyncio.create_task(write_load(repo, stop, args.write_batch))
+                await asyncio.sleep(0.1)
+                result = await measure(name, func, ids)
+                stop.set()
+                await writer
+            else:
+                result = await measure(name, func, ids)
+            result.update(blocks=args.blocks, profile=not args.no_profile, readers=args.readers)
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+        return results
+    finally:
+        await repo.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of metadata repository")
+    parser.add_argument("--database", default="benchmark.sqlite", help="Catalog is built if file doesn't exist")
+    parser.add_argument("--blocks", default=10 ** 7, type=int, help="Number of block rows (with duplicates)")
+    parser.add_argument("--blocks-per-file", default=100, type=int)
+    parser.add_argument("--storages", default=5, type=int)
+    parser.add_argument("--duplicates", default=2, type=int)
+    parser.add_argument("--count", default=100, type=int, help="Number of calls of every query")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--no-profile", action="store_true", help="Drop indexes and use default pragmas")
+    parser.add_argument("--readers", default=BlockRepo.reader_num, type=int, help="Number of reader connections")
+    parser.add_argument("--write-batch", default=20000, type=int, help="Blocks inserted by one commit of write load")
+    parser.add_argument("--output", help="Write json lines to file instead of stdout")
+    args = parser.parse_args()
+
+    lines = "\n".join(json.dumps(result) for result in asyncio.run(run(args))) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(lines)
+    else:
+        print(lines, end="")
+
+
+if __name__ == '__main__':
+    main()
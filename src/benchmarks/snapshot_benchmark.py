@@ -0,0 +1,166 @@
+"""
+Size and time of catalog snapshot compared with copying and dumping sqlite file
+
+Run from src directory:
+    python -m benchmarks.snapshot_benchmark --blocks 1000000
+
+Catalog has random uuid names and hashes like real uploads, so only structure of data is compressible
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from typing import List
+
+from repository import BlockRepo, StoreCreator, StoreType, export_snapshot, import_snapshot
+
+
+async def build(path: str, blocks: int, blocks_per_file: int, storages: int, duplicates: int, seed: int) -> None:
+    rand = random.Random(seed)
+    repo = await BlockRepo(path)
+    try:
+        await repo.add_rows("storage", ("id", "token", "type"),
+                            [(i, f"token-{i}", "yandex-disk") for i in range(1, storages + 1)])
+        await repo.add_rows("key", ("id", "key"), [(1, rand.randbytes(16).hex())])
+        files = -(-blocks // (blocks_per_file * duplicates))
+        await repo.add_rows("file", ("id", "filename", "size", "uploaded_blocks", "total_blocks", "checksum"),
+                            ((i, f"photos/{2000 + i % 20}/IMG_{i:07}.jpg", blocks_per_file * 20 * 2 ** 20,
+                              blocks_per_file * duplicates, blocks_per_file, rand.randbytes(20).hex())
+                             for i in range(1, files + 1)))
+
+        def rows():
+            content_hash = ""
+            for i in range(blocks):
+                number, duplicate = divmod(i, duplicates)
+                file_id, number = divmod(number, blocks_per_file)
+                if duplicate == 0:
+                    content_hash = rand.randbytes(32).hex()
+                yield (number, str(uuid.UUID(bytes=rand.randbytes(16), version=4)), 20 * 2 ** 20,
+                       (file_id + number + duplicate) % storages + 1, file_id + 1, 1, rand.randbytes(16).hex(),
+                       "aes-gcm", content_hash)
+
+        await repo.add_rows("block", ("number", "name", "size", "storage_id", "file_id", "key_id", "checksum",
+                                      "cipher", "content_hash"), rows())
+        await repo.commit()
+        await repo.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        await repo.close()
+
+
+def _timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def _gzip_file(src: str, dst: str) -> None:
+    with open(src, "rb") as fin, gzip.open(dst, "wb", compresslevel=6) as fout:
+        shutil.copyfileobj(fin, fout, 2 ** 20)
+
+
+def _dump(src: str, dst: str) -> None:
+    conn = sqlite3.connect(src)
+    try:
+        with gzip.open(dst, "wt", compresslevel=6) as f:
+            for line in conn.iterdump():
+                f.write(line + "\n")
+    finally:
+        conn.close()
+
+
+def _restore(src: str, dst: str) -> None:
+    conn = sqlite3.connect(dst)
+    try:
+        with gzip.open(src, "rt") as f:
+            conn.executescript(f.read())
+    finally:
+        conn.close()
+
+
+async def run(args: argparse.Namespace) -> List[dict]:
+    directory = tempfile.mkdtemp(prefix="snapshot-benchmark-", dir=args.directory)
+    results = []
+
+    def record(method: str, operation: str, path: str, seconds: float):
+        size = os.path.getsize(path) if os.path.isfile(path) else \
+            sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        result = {'method': method, 'operation': operation, 'blocks': args.blocks, 'mb': round(size / 2 ** 20, 2),
+                  'seconds': round(seconds, 2)}
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+
+    try:
+        db = os.path.join(directory, "db.sqlite")
+        started = time.perf_counter()
+        await build(db, args.blocks, args.blocks_per_file, args.storages, args.duplicates, args.seed)
+        print(f"Catalog of {args.blocks} blocks built in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+        for method, func, suffix in (("copy", shutil.copyfile, ".copy"), ("gzip", _gzip_file, ".gz"),
+                                     ("dump", _dump, ".sql.gz")):
+            _, seconds = _timed(func, db, db + suffix)
+            record(method, "export", db + suffix, seconds)
+        try:
+            _, seconds = _timed(_restore, db + ".sql.gz", db + ".restored")
+            record("dump", "import", db + ".restored", seconds)
+        except sqlite3.OperationalError as e:
+            # hashes of digits and 'e' in STRING columns are stored as REAL, dump writes them as Inf
+            print(json.dumps({'method': 'dump', 'operation': 'import', 'error': str(e)}), file=sys.stderr)
+
+        snapshot = os.path.join(directory, "catalog.snapshot")
+        for level in args.levels:
+            store = await BlockRepo(db)
+            try:
+                started = time.perf_counter()
+                await export_snapshot(store, snapshot, compress_level=level)
+                record(f"snapshot level {level}", "export", snapshot, time.perf_counter() - started)
+            finally:
+                await store.close()
+
+        for store_type in StoreType:
+            path = os.path.join(directory, f"imported.{store_type}")
+            if store_type == StoreType.SHARDED:
+                os.makedirs(path)
+            store = await StoreCreator.create(path, store_type)
+            try:
+                started = time.perf_counter()
+                await import_snapshot(store, snapshot)
+                seconds = time.perf_counter() - started
+            finally:
+                await store.close()
+            record(f"snapshot to {store_type}", "import", path, seconds)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of catalog snapshot")
+    parser.add_argument("--blocks", default=10 ** 6, type=int, help="Number of block rows (with duplicates)")
+    parser.add_argument("--blocks-per-file", default=100, type=int)
+    parser.add_argument("--storages", default=5, type=int)
+    parser.add_argument("--duplicates", default=2, type=int)
+    parser.add_argument("--levels", default="1,6", type=lambda s: [int(level) for level in s.split(',')],
+                        help="Compression levels of snapshot")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--directory", help="Directory of temporary files")
+    parser.add_argument("--output", help="Write json lines to file instead of stdout")
+    args = parser.parse_args()
+
+    lines = "\n".join(json.dumps(result) for result in asyncio.run(run(args))) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(lines)
+    else:
+        print(lines, end="")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Startup time of CLI: imports, opening of catalog and metadata-only commands
+
+Run from src directory:
+    python -m benchmarks.startup_benchmark --output startup.jsonl
+    python -m benchmarks.startup_benchmark --compare startup.jsonl
+
+Every measurement runs in a new interpreter, as a command does. Result is a json line with the best
+and the median wall time in milliseconds, import measurements also have the slowest modules
+(python -X importtime)
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Sequence
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules imported by main.py and by commands, '' is interpreter startup
+MODULES = ("", "cli", "repository", "network.uploader", "vfs.block_reader")
+# commands which read catalog only
+COMMANDS = (("key", "list"), ("list",), ("version", "list", "file"), ("snapshot", "list"), ("--help",))
+
+OPEN_STORE = """
+import asyncio, sys, time
+from repository import StoreCreator, StoreType
+async def main():
+    started = time.perf_counter()
+    store = await StoreCreator.create(sys.argv[1], StoreType.from_str(sys.argv[2]))
+    opened = time.perf_counter()
+    await store.close()
+    print((opened - started) * 1000)
+asyncio.run(main())
+"""
+
+
+def _run(args: Sequence[str], cwd: str) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=SRC, PYTHONDONTWRITEBYTECODE="")
+    return subprocess.run([sys.executable, *args], cwd=cwd, env=env, capture_output=True, text=True, check=True)
+
+
+def _timed(args: Sequence[str], cwd: str, repeat: int) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        _run(args, cwd)
+        times.append((time.perf_counter() - started) * 1000)
+    return {'best_ms': round(min(times), 1), 'median_ms': round(statistics.median(times), 1)}
+
+
+def _slowest_imports(module: str, cwd: str, top: int) -> List[List]:
+    """
+    Modules with the biggest cumulative import time (us), nested modules are counted by their parents too
+    """
+    stderr = _run(["-X", "importtime", "-c", f"import {module}"], cwd).stderr
+    imports = []
+    for line in stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match and len(match.group(3)) <= 4:
+            imports.append([match.group(4), int(match.group(2))])
+    return sorted(imports, key=lambda item: -item[1])[:top]
+
+
+def run(repeat: int, top: int, directory: str) -> List[dict]:
+    results = []
+
+    def record(**fields):
+        results.append(fields)
+        print(json.dumps(fields), file=sys.stderr)
+
+    for module in MODULES:
+        fields = _timed(["-c", f"import {module}" if module else "pass"], directory, repeat)
+        if module:
+            fields['slowest'] = _slowest_imports(module, directory, top)
+        record(kind='import', name=module or 'python', **fields)
+
+    for store_type in ("sqlite", "sharded"):
+        path = os.path.join(directory, f"catalog-{store_type}")
+        _run(["-c", OPEN_STORE, path, store_type], directory)  # create schema
+        times = [float(_run(["-c", OPEN_STORE, path, store_type], directory).stdout) for _ in range(repeat)]
+        record(kind='open', name=store_type, best_ms=round(min(times), 2),
+               median_ms=round(statistics.median(times), 2))
+
+    main = os.path.join(SRC, "main.py")
+    database = os.path.join(directory, "catalog.sqlite")
+    log = os.path.join(directory, "log.txt")
+    for command in COMMANDS:
+        record(kind='command', name=" ".join(command),
+               **_timed([main, "-d", database, "--log", log, *command], directory, repeat))
+    return results
+
+
+def compare(old: List[dict], new: List[dict]) -> None:
+    """
+    Print change of median time of every measurement present in both results
+    """
+    old_by_key = {(result['kind'], result['name']): result for result in old if 'kind' in result}
+    print(f"{'measurement':<40} {'old ms':>10} {'new ms':>10} {'change':>8}")
+    for result in new:
+        key = (result.get('kind'), result.get('name'))
+        if key not in old_by_key:
+            continue
+        before, after = old_by_key[key]['median_ms'], result['median_ms']
+        print(f"{' '.join(key):<40} {before:>10} {after:>10} {(after - before) / before * 100:>7.1f}%")
+
+
+def _load(path: str) -> List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of CLI startup")
+    parser.add_argument("--repeat", default=10, type=int)
+    parser.add_argument("--top", default=5, type=int, help="Number of the slowest imports shown")
+    parser.add_argument("--output", help="Write json lines to file instead of stdout")
+    parser.add_argument("--compare", help="Compare with results of previous run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="startup-benchmark-") as directory:
+        results = run(args.repeat, args.top, directory)
+    meta = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+    lines = [json.dumps(meta)] + [json.dumps(result) for result in results]
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        print("\n".join(lines))
+
+    if args.compare:
+        compare(_load(args.compare), results)
+
+
+if __name__ == '__main__':
+    main()
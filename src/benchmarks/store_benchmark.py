@@ -0,0 +1,411 @@
+"""
+Conformance and latency of metadata stores
+
+Run from src directory:
+    python -m benchmarks.store_benchmark --check  # every store gives the same results as sqlite store
+    python -m benchmarks.store_benchmark --blocks 1000000 --stores sqlite,sharded
+
+Conformance scenario calls every method of MetadataStore and compares results with BlockRepo.
+Benchmark builds the same catalog by add_blocks in every store, measures queries and migration
+to the other type of store. Stores are created in a temporary directory unless --directory is given
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import entity
+import exceptions
+from benchmarks.repo_benchmark import measure
+from crypto import CipherType
+from network.storage_base import StorageBase, StorageType
+from network.storage_creator import StorageCreator
+from repository import MetadataStore, StoreCreator, StoreType, copy_store, export_snapshot, import_snapshot
+
+
+def _storage(token: str) -> StorageBase:
+    storage = StorageCreator.create(StorageType.YANDEX_DISK)
+    storage.token = token
+    return storage
+
+
+def _hash(*parts) -> str:
+    return hashlib.sha256(repr(parts).encode()).hexdigest() if parts else ""
+
+
+def _blocks(file: entity.File, numbers, storages, duplicates: int, cipher=None, size: int = 2 ** 20,
+            content=None) -> List[entity.Block]:
+    return [entity.Block(file=file, number=number, size=size - number, name=f"{file.id}-{number}-{duplicate}",
+                         storage=storages[(file.id + number + duplicate) % len(storages)], cipher=cipher,
+                         checksum=_hash(file.id, number, duplicate),
+                         content_hash=_hash(*(content if content is not None else (file.id, number))))
+            for number in numbers for duplicate in range(duplicates)]
+
+
+def _rows(blocks, checksum: bool = True) -> List[tuple]:
+    return sorted((block.file.id if block.file else None, block.number, block.name, block.size,
+                   block.storage.id if block.storage else None, block.checksum if checksum else None,
+                   str(block.cipher.type) if block.cipher else None,
+                   block.cipher.key().id if block.cipher else None) for block in blocks)
+
+
+async def conformance(store: MetadataStore) -> List[Tuple[str, Any]]:
+    """
+    Call every method of store by the same scenario and return normalized results
+    """
+    results = []
+
+    def record(name: str, value: Any):
+        results.append((name, value))
+
+    for i in range(3):
+        await store.add_storage(_storage(f"token-{i}"))
+    for key in ("key-1", "key-2"):
+        await store.add_key(entity.Key(key=key))
+    await store.commit()
+
+    storages = await store.get_storages()
+    record("get_storages", sorted((s.id, s.token, str(s.type)) for s in storages))
+    record("get_keys", sorted((k.id, k.key) for k in await store.get_keys()))
+    record("get_storage_by_id", (await store.get_storage_by_id(storages[1].id)).token)
+    record("get_storages identity", all(s is t for s, t in zip(storages, await store.get_storages())))
+    try:
+        await store.get_storage_by_id(100)
+        record("get_storage_by_id unknown", "no error")
+    except exceptions.UnknownStorage:
+        record("get_storage_by_id unknown", "UnknownStorage")
+
+    gcm = await store.get_ciphers(CipherType.AES_GCM)
+    convergent = await store.get_ciphers(CipherType.AES_CONVERGENT)
+    record("get_ciphers", [(c.key().id, str(c.type)) for c in gcm + convergent])
+
+    files = []
+    for i in range(5):
+        file = entity.File(filename=f"dir/file{i}", size=4 * 2 ** 20, checksum=_hash(i))
+        file.total_blocks = 4
+        await store.add_file(file)
+        files.append(file)
+    await store.commit()
+
+    # plain, encrypted, convergent with the same content as next file and a file with a gap
+    await store.add_block(_blocks(files[0], [0], storages, 2)[0])
+    await store.add_blocks(_blocks(files[0], [0], storages, 2)[1:] + _blocks(files[0], [1, 2, 3], storages, 2))
+    await store.add_blocks(_blocks(files[1], range(4), storages, 2, gcm[0]))
+    await store.add_blocks(_blocks(files[2], range(4), storages, 2, convergent[1], content=(7,)))
+    await store.add_blocks(_blocks(files[3], range(4), storages, 1, convergent[1], content=(7,)))
+    await store.add_blocks(_blocks(files[4], [0, 2, 3], storages, 3, content=()))
+    await store.commit()
+
+    record("get_files", sorted((f.id, f.filename, f.size) for f in await store.get_files()))
+    for file in files:
+        db_file = await store.get_file_by_filename(file.filename)
+        record("get_file_by_filename", (db_file.id, db_file.size, db_file.uploaded_blocks, db_file.total_blocks,
+                                        db_file.checksum))
+        blocks = await store.get_blocks_by_file(db_file)
+        record("get_blocks_by_file", sorted((b.number, b.name, b.storage.id, str(b.cipher.type) if b.cipher else None,
+                                             b.cipher.key().id if b.cipher else None, b.size, b.content_hash)
+                                            for b in blocks))
+        record("get_blocks_by_file order", [b.number for b in blocks])
+        record("get_blocks_by_file ciphers shared",
+               all(b.cipher is None or b.cipher in gcm + convergent for b in blocks))
+        grouped = await store.get_blocks_grouped_by_number(db_file)
+        record("get_blocks_grouped_by_number", [sorted(b.name for b in group) for group in grouped])
+        record("get_replica_storage_ids",
+               sorted(await store.get_replica_storage_ids(entity.Block(file=db_file, number=2))))
+    try:
+        await store.get_file_by_filename("unknown")
+        record("get_file_by_filename unknown", "no error")
+    except exceptions.UnknownFile:
+        record("get_file_by_filename unknown", "UnknownFile")
+
+    for storage in storages:
+        blocks = await store.get_blocks_by_storage(storage)
+        record("get_blocks_by_storage", _rows(blocks, checksum=False))
+        record("get_blocks_by_storage order", [b.size for b in blocks])
+    all_blocks = await store.get_all_blocks(storages)
+    record("get_all_blocks", _rows(all_blocks))
+    record("get_all_blocks order", [(b.file.id, b.number) for b in all_blocks])
+    record("get_all_blocks content", sorted(b.content_hash for b in all_blocks))
+
+    probe = entity.Block(size=2 ** 20 - 1, content_hash=_hash(7), cipher=convergent[1])
+    record("get_block_copies", sorted((b.storage.id, b.name, b.checksum) for b in await store.get_block_copies(probe)))
+    record("get_block_copies other key",
+           await store.get_block_copies(entity.Block(size=2 ** 20 - 1, content_hash=_hash(7), cipher=convergent[0])))
+    shared = (await store.get_blocks_by_file(files[2]))[1]
+    record("get_block_ids_by_data", len(await store.get_block_ids_by_data(shared)))
+
+    target = next(s for s in storages if s.id != shared.storage.id)
+    record("move_block", await store.move_block(shared, target, "moved"))
+    record("move_block again", await store.move_block(shared, target, "moved"))
+    await store.commit()
+    record("after move_block", sorted(b.name for b in await store.get_blocks_by_file(files[2])))
+
+    blocks = await store.get_blocks_by_file(files[0])
+    await store.del_blocks(blocks[:2] + (entity.Block(name=blocks[2].name, storage=blocks[2].storage),))
+    await store.del_block(blocks[3])
+    await store.commit()
+    record("del_blocks", sorted(b.name for b in await store.get_blocks_by_file(files[0])))
+
+    await store.del_file(entity.File(filename=files[1].filename))
+    await store.del_file(entity.File(filename="unknown"))
+    await store.commit()
+    record("del_file", sorted(f.filename for f in await store.get_files()))
+    record("del_file blocks", await store.get_blocks_by_file(files[1]))
+
+    for path in ("", "dir/"):
+        directory = await store.get_directory(path)
+        record("get_directory", (directory.path, directory.size, directory.file_count))
+        record("get_subdirectories", [d.path for d in await store.get_subdirectories(path)])
+        record("get_files_by_directory", [f.filename for f in await store.get_files_by_directory(path, "dir/file0")])
+    try:
+        await store.get_directory("dir/file1/")
+        record("get_directory unknown", "no error")
+    except exceptions.UnknownDirectory:
+        record("get_directory unknown", "UnknownDirectory")
+    record("get_files_by_range", [(f.filename, f.uploaded_blocks) for f in await store.get_files_by_range("dir/file2")])
+    record("get_files_by_range end", [f.filename for f in await store.get_files_by_range("dir/", "dir/file3", 1)])
+
+    for table in MetadataStore.table_columns:
+        rows = []
+        async for batch in store.iter_rows(table, batch_size=7):
+            rows.extend(tuple(row) for row in batch)
+        record(f"iter_rows {table}", sorted(rows, key=repr))
+
+    copy = await store.copy_file(files[2], "copy/file2")
+    await store.commit()
+    record("copy_file", (copy.size, copy.uploaded_blocks, copy.total_blocks, copy.checksum))
+    copied = await store.get_blocks_by_file(copy)
+    record("copy_file blocks", sorted((b.number, b.name, b.storage.id, str(b.cipher.type) if b.cipher else None,
+                                       b.cipher.key().id if b.cipher else None) for b in copied))
+    record("copy_file shared", sorted([len(await store.get_block_ids_by_data(b)) for b in copied]))
+    record("get_shared_replica_storage_ids",
+           sorted([sorted(await store.get_shared_replica_storage_ids(b)) for b in copied]))
+    for source, target in ((files[3], "copy/file2"), (entity.File(filename="unknown"), "copy/unknown")):
+        try:
+            await store.copy_file(source, target)
+            record("copy_file error", "no error")
+        except (exceptions.FileAlreadyExists, exceptions.UnknownFile) as e:
+            record("copy_file error", type(e).__name__)
+    record("copy_files", await store.copy_files("", "snapshot/", exclude=("copy/",)))
+    try:
+        await store.copy_files("dir/", "copy/")
+        record("copy_files taken", "no error")
+    except exceptions.FileAlreadyExists:
+        record("copy_files taken", "FileAlreadyExists")
+    await store.commit()
+    record("after copy_files", sorted((f.filename, f.uploaded_blocks) for f in await store.get_files()))
+    record("after copy_files directory", (await store.get_directory("snapshot/dir/")).file_count)
+    return results
+
+
+async def _table_rows(store: MetadataStore, name: str) -> List[Tuple[str, Any]]:
+    results = []
+    for table in MetadataStore.table_columns:
+        rows = []
+        async for batch in store.iter_rows(table):
+            rows.extend(tuple(row) for row in batch)
+        results.append((f"{name} {table}", sorted(rows, key=repr)))
+    directory = await store.get_directory("dir/")
+    results.append((f"{name} directory", (directory.size, directory.file_count)))
+    return results
+
+
+async def check(directory: str, store_types: List[StoreType]) -> bool:
+    """
+    Run conformance scenario in every store and in copies made by copy_store and snapshot,
+    compare with sqlite store
+    """
+    async def run(path: str, store_type: StoreType, copy_to: StoreType = None) -> List[Tuple[str, Any]]:
+        store = await StoreCreator.create(path, store_type, shard_count=3)
+        try:
+            results = await conformance(store)
+            if copy_to:
+                copy = await StoreCreator.create(path + "-copy", copy_to, shard_count=5)
+                try:
+                    await copy_store(store, copy, batch_size=7)
+                    results.extend(await _table_rows(copy, "copy_store"))
+                finally:
+                    await copy.close()
+
+                snapshot = await StoreCreator.create(path + "-snapshot", copy_to, shard_count=2)
+                try:
+                    await export_snapshot(store, path + ".snapshot", batch_size=7)
+                    await import_snapshot(snapshot, path + ".snapshot")
+                    results.extend(await _table_rows(snapshot, "snapshot"))
+                finally:
+                    await snapshot.close()
+            return results
+        finally:
+            await store.close()
+
+    expected = await run(os.path.join(directory, "reference.sqlite"), StoreType.SQLITE, StoreType.SQLITE)
+    ok = True
+    for store_type in store_types:
+        for copy_to in StoreType:
+            name = f"{store_type}-to-{copy_to}"
+            path = os.path.join(directory, name + (".sqlite" if store_type == StoreType.SQLITE else ""))
+            results = await run(path, store_type, copy_to)
+            failed = [(check_name, want, got) for (check_name, want), (_, got) in zip(expected, results)
+                      if want != got]
+            if len(results) != len(expected):
+                failed.append(("number of checks", len(expected), len(results)))
+            for check_name, want, got in failed:
+                print(f"FAIL {name}: {check_name}\n  expected: {want}\n  got:      {got}", file=sys.stderr)
+            print(f"{name}: {len(results) - len(failed)}/{len(results)} checks passed", file=sys.stderr)
+            ok = ok and not failed
+    return ok
+
+
+async def build(store: MetadataStore, blocks: int, blocks_per_file: int, storage_count: int,
+                duplicates: int) -> int:
+    """
+    Fill empty store by add_blocks as uploads do, return number of files
+    """
+    for i in range(storage_count):
+        await store.add_storage(_storage(f"token-{i}"))
+    await store.commit()
+    storages = await store.get_storages()
+
+    files = -(-blocks // (blocks_per_file * duplicates))
+    for i in range(files):
+        file = entity.File(filename=f"dir{i % 1000}/file{i}", size=blocks_per_file * 2 ** 20, checksum=_hash(i))
+        file.total_blocks = blocks_per_file
+        await store.add_file(file)
+        await store.add_blocks(_blocks(file, range(blocks_per_file), storages, duplicates))
+        await store.commit()
+    return files
+
+
+async def write_load(store: MetadataStore, stop: asyncio.Event, batch: int) -> None:
+    """
+    Add and commit blocks of a new file until stopped, like uploads do
+    """
+    storages = await store.get_storages()
+    file = entity.File(filename=f"load{time.monotonic_ns()}", size=0, checksum="")
+    await store.add_file(file)
+    number = 0
+    while not stop.is_set():
+        await store.add_blocks(_blocks(file, range(number, number + batch), storages, 1))
+        await store.commit()
+        number += batch
+    await store.del_file(file)
+    await store.commit()
+
+
+async def benchmark(path: str, store_type: StoreType, args: argparse.Namespace) -> List[dict]:
+    results = []
+
+    def record(result: Dict[str, Any]):
+        result.update(store=str(store_type), blocks=args.blocks)
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+
+    store = await StoreCreator.create(path, store_type, args.shards)
+    try:
+        started = time.perf_counter()
+        files = await build(store, args.blocks, args.blocks_per_file, args.storages, args.duplicates)
+        elapsed = time.perf_counter() - started
+        record({'query': 'add_blocks', 'count': args.blocks, 'blocks_per_s': round(args.blocks / elapsed)})
+
+        rand = random.Random(args.seed)
+        ids = [rand.randrange(files) + 1 for _ in range(args.count)]
+        storages = {storage.id: storage for storage in await store.get_storages()}
+
+        def block(i: int) -> entity.Block:
+            file_id = i
+            number = i % args.blocks_per_file
+            return entity.Block(file=entity.File(id=file_id), number=number, size=2 ** 20 - number,
+                                name=f"{file_id}-{number}-0", content_hash=_hash(file_id, number),
+                                storage=storages[(file_id + number) % len(storages) + 1])
+
+        queries: Tuple[Tuple[str, Callable], ...] = (
+            ("get_file_by_filename", lambda i: store.get_file_by_filename(f"dir{(i - 1) % 1000}/file{i - 1}")),
+            ("get_blocks_by_file", lambda i: store.get_blocks_by_file(entity.File(id=i))),
+            ("get_blocks_grouped_by_number", lambda i: store.get_blocks_grouped_by_number(entity.File(id=i))),
+            ("get_replica_storage_ids", lambda i: store.get_replica_storage_ids(block(i))),
+            ("get_block_copies", lambda i: store.get_block_copies(block(i))),
+            ("get_block_ids_by_data", lambda i: store.get_block_ids_by_data(block(i))),
+            ("get_shared_replica_storage_ids", lambda i: store.get_shared_replica_storage_ids(block(i))),
+            ("get_blocks_by_file while writing", lambda i: store.get_blocks_by_file(entity.File(id=i))),
+        )
+        for name, func in queries:
+            if name.endswith("while writing"):
+                stop = asyncio.Event()
+                writer = asyncio.create_task(write_load(store, stop, args.write_batch))
+                await asyncio.sleep(0.1)
+                result = await measure(name, func, ids)
+                stop.set()
+                await writer
+            else:
+                result = await measure(name, func, ids)
+            record(result)
+
+        other = StoreType.SQLITE if store_type == StoreType.SHARDED else StoreType.SHARDED
+        target = await StoreCreator.create(path + f"-copy.{other}", other, args.shards)
+        try:
+            started = time.perf_counter()
+            counts = await copy_store(store, target)
+            elapsed = time.perf_counter() - started
+        finally:
+            await target.close()
+        record({'query': f'copy_store to {other}', 'count': counts['block'],
+                'blocks_per_s': round(counts['block'] / elapsed)})
+    finally:
+        await store.close()
+    return results
+
+
+async def run(args: argparse.Namespace) -> Tuple[bool, List[dict]]:
+    directory = args.directory or tempfile.mkdtemp(prefix="store-benchmark-")
+    os.makedirs(directory, exist_ok=True)
+    try:
+        if args.check:
+            return await check(directory, args.stores), []
+
+        results = []
+        for store_type in args.stores:
+            path = os.path.join(directory, f"benchmark.{store_type}")
+            results.extend(await benchmark(path, store_type, args))
+        return True, results
+    finally:
+        if not args.directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Conformance and benchmark of metadata stores")
+    parser.add_argument("--check", action="store_true", help="Run conformance scenario instead of benchmark")
+    parser.add_argument("--stores", default=",".join(str(t) for t in StoreType),
+                        type=lambda s: [StoreType.from_str(t) for t in s.split(',')])
+    parser.add_argument("--directory", help="Keep stores in directory (new stores are created every run)")
+    parser.add_argument("--blocks", default=10 ** 6, type=int, help="Number of block rows (with duplicates)")
+    parser.add_argument("--blocks-per-file", default=100, type=int)
+    parser.add_argument("--storages", default=5, type=int)
+    parser.add_argument("--duplicates", default=2, type=int)
+    parser.add_argument("--shards", default=8, type=int, help="Number of shards of sharded store")
+    parser.add_argument("--count", default=100, type=int, help="Number of calls of every query")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--write-batch", default=20000, type=int, help="Blocks added by one commit of write load")
+    parser.add_argument("--output", help="Write json lines to file instead of stdout")
+    args = parser.parse_args()
+
+    ok, results = asyncio.run(run(args))
+    if results:
+        lines = "\n".join(json.dumps(result) for result in results) + "\n"
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(lines)
+        else:
+            print(lines, end="")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,38 +2,71 @@ import argparse
 import asyncio
 import os
 import uuid
-from typing import List, Callable, Any, Optional
+from typing import List, Callable, Any, Optional, TYPE_CHECKING
 
-import aiohttp
 import aiosqlite
 from loguru import logger
-from tabulate import tabulate
 
 import entity
 import exceptions
+import utils
 from cli.parser import Parser
-from crypto.aes import Aes
+from crypto import CipherType
 from exceptions import *
-from network.balancer import Balancer
-from network.block_progress import BlockProgress
-from network.downloader import Downloader, ChecksumNoEqual
-from network.storage_base import StorageType, DeleteStatus, DownloadStatus
+from network.storage_base import StorageType, DownloadStatus
 from network.storage_creator import StorageCreator
-from network.uploader import Uploader
-from repository.block_repo import BlockRepo
-from vfs import VFS
+from repository import MetadataStore, StoreCreator, StoreType
+
+if TYPE_CHECKING:
+    # handlers import network, vfs, sync and tabulate when they run, so catalog commands start fast
+    from network.balancer import Balancer
+    from network.block_progress import BlockProgress
+    from vfs import VFS
+    from daemon import DaemonClient
 
 
 class CLI:
     def __init__(self, parser: Parser):
-        self._balancer: Balancer = None
-        self._block_repo: BlockRepo = None
-        self._vfs: VFS = None
+        self._balancer: Optional["Balancer"] = None
+        self._block_repo: Optional[MetadataStore] = None
+        self._vfs: Optional["VFS"] = None
+        self._client: Optional["DaemonClient"] = None  # connection to running daemon
         self._parser = parser
         self._init_parser()
 
+        # commands sent to daemon while it runs: handler -> handler using daemon
+        self._remote_handlers = {
+            self._upload_handler: self._upload_remote_handler,
+            self._download_handler: self._download_remote_handler,
+            self._list_handler: self._list_remote_handler,
+            self._delete_handler: self._delete_remote_handler,
+            self._daemon_stop_handler: self._daemon_stop_handler,
+            self._daemon_status_handler: self._daemon_status_handler,
+        }
+
     async def init(self):
-        self._block_repo = await BlockRepo(self._parser.parse_args().db_path)
+        """
+        Connect to daemon if it runs and command can be sent to it, open catalog otherwise
+        """
+        args = self._parser.parse_args()
+        if args.func in self._remote_handlers and not args.local:
+            self._client = await self._connect(self._socket_path(args))
+            if self._client or args.func in (self._daemon_stop_handler, self._daemon_status_handler):
+                return
+        self._block_repo = await StoreCreator.create(args.db_path)
+
+    @staticmethod
+    async def _connect(socket_path: str) -> Optional["DaemonClient"]:
+        from daemon import DaemonClient
+
+        try:
+            return await DaemonClient(socket_path).__aenter__()
+        except DaemonNotRunning:
+            return None
+
+    @staticmethod
+    def _socket_path(args: argparse.Action) -> str:
+        return args.socket_path or args.db_path.rstrip("/") + ".sock"
 
     @staticmethod
     def _replace_line(s: str):
@@ -41,15 +74,34 @@ class CLI:
 
     def _init_parser(self):
         self._parser.set_upload_handler(self._upload_handler)
+        self._parser.set_sync_handler(self._sync_handler)
         self._parser.set_download_handler(self._download_handler)
         self._parser.set_list_handler(self._list_handler)
+        self._parser.set_mount_handler(self._mount_handler)
         self._parser.set_delete_handler(self._delete_handler)
 
+        self._parser.set_version_list_handler(self._version_list_handler)
+        self._parser.set_version_restore_handler(self._version_restore_handler)
+        self._parser.set_version_prune_handler(self._version_prune_handler)
+        self._parser.set_snapshot_create_handler(self._snapshot_create_handler)
+        self._parser.set_snapshot_list_handler(self._snapshot_list_handler)
+        self._parser.set_snapshot_delete_handler(self._snapshot_delete_handler)
+
         self._parser.set_storage_add_handler(self._storage_add_handler)
         self._parser.set_storage_list_handler(self._storage_list_handler)
         self._parser.set_storage_files_handler(self._storage_files_handler)
         self._parser.set_storage_delete_handler(self._storage_delete_handler)
         self._parser.set_storage_wipe_handler(self._storage_wipe_handler)
+        self._parser.set_rebalance_handler(self._rebalance_handler)
+        self._parser.set_scrub_handler(self._scrub_handler)
+
+        self._parser.set_catalog_migrate_handler(self._catalog_migrate_handler)
+        self._parser.set_catalog_export_handler(self._catalog_export_handler)
+        self._parser.set_catalog_import_handler(self._catalog_import_handler)
+
+        self._parser.set_daemon_start_handler(self._daemon_start_handler)
+        self._parser.set_daemon_stop_handler(self._daemon_stop_handler)
+        self._parser.set_daemon_status_handler(self._daemon_status_handler)
 
         self._parser.set_key_add_handler(self._key_add_handler)
         self._parser.set_key_generate_handler(self._key_generate_handler)
@@ -60,6 +112,11 @@ class CLI:
     # HANDLERS
 
     async def _upload_handler(self, args: argparse.Action):
+        import aiohttp
+        from network.balancer import Balancer
+        from network.placement import create_policy
+        from vfs.versions import Versions, UPLOAD_DIRECTORY
+
         src, dst = args.src, args.dst
         block_size = args.block_size
 
@@ -71,30 +128,80 @@ class CLI:
             return
 
         if args.need_encrypt:
-            keys = await self._block_repo.get_keys()
-            if not keys:
+            ciphers = await self._block_repo.get_ciphers(CipherType.from_str(args.cipher))
+            if not ciphers:
                 print("No keys. Add one by 'key add' or don't use '-e' parameter")
                 return
-
-            ciphers = [Aes(key) for key in keys]
         else:
             ciphers = None
 
+        base = None
+        if args.keep_version or args.update:
+            try:
+                base = await self._block_repo.get_file_by_filename(dst)
+            except UnknownFile:
+                pass
+            if base and base.uploaded_blocks != base.total_blocks:
+                base = None
+        if args.update and not base:
+            print(f"File {dst} isn't uploaded. Upload it without '-u'")
+            return
+
+        hashes = None
+        if args.update:
+            # blocks are compared by number, so file is split like the stored one
+            blocks = await self._block_repo.get_blocks_by_file(base)
+            if base.total_blocks > 1:
+                block_size = blocks[0].size
+            hashes = await asyncio.to_thread(utils.block_hashes, src, block_size, args.worker_count)
+            stored = {block.number: block.content_hash for block in blocks}
+            changed = sum(content_hash != stored.get(number) for number, content_hash in enumerate(hashes))
+            if not changed and len(hashes) == base.total_blocks:
+                print(f"File {dst} is up to date")
+                return
+            print(f"{changed} of {len(hashes)} blocks changed")
+            await Versions(self._block_repo).purge_trash()
+
         storages = await self._block_repo.get_storages()
-        self._balancer = Balancer(storages,
-                                  ciphers=ciphers,
-                                  block_size=block_size)
+        try:
+            self._balancer = Balancer(storages,
+                                      ciphers=ciphers,
+                                      block_size=block_size,
+                                      policy=create_policy(args.placement))
+            async with aiohttp.ClientSession() as session:
+                await self._balancer.update_capacity(session)
+        except NoStorage as e:
+            print("No available storage. Add one by 'storage add' command or check tokens")
+            logger.exception(e)
+            return
 
-        file = entity.File(filename=dst, path=src)
+        if base:
+            # new version is uploaded under temporary name and then replaces the file
+            file = entity.File(filename=UPLOAD_DIRECTORY + uuid.uuid4().hex, path=src,
+                               need_encrypt=args.need_encrypt)
+        else:
+            file = entity.File(filename=dst, path=src, need_encrypt=args.need_encrypt)
 
         print(f"Upload file {repr(src)} like {repr(dst)}\n")
 
         try:
-            await self._upload_file(file)
+            try:
+                await self._upload_file(file, base, hashes)
+            except Exception:
+                if base and file.id:
+                    await Versions(self._block_repo).delete_files([file])
+                raise
+            if base:
+                # replaced blocks are deleted unless they are kept as version
+                await Versions(self._block_repo).replace(file, dst, keep_version=args.keep_version)
         except NoStorage as e:
             print("No storage. Add one by 'storage add' command")
             logger.exception(e)
             return
+        except NotEnoughSpace as e:
+            print("Not enough free space in storages")
+            logger.exception(e)
+            return
         except FileAlreadyExists as e:
             print(f"File with name {file.filename} already exists")
             logger.exception(e)
@@ -111,18 +218,78 @@ class CLI:
 
         print("File successfully uploaded")
 
+    async def _sync_handler(self, args: argparse.Action):
+        import aiohttp
+        from network.balancer import Balancer
+        from network.placement import create_policy
+        from sync import SyncConfig, SyncIndex, Syncer
+        from vfs.vfs import VFS
+
+        if not os.path.isdir(args.src):
+            print(f"{args.src} isn't a directory")
+            return
+
+        ciphers = None
+        if args.need_encrypt:
+            ciphers = await self._block_repo.get_ciphers(CipherType.from_str(args.cipher))
+            if not ciphers:
+                print("No keys. Add one by 'key add' or don't use '-e' parameter")
+                return
+        try:
+            self._balancer = Balancer(await self._block_repo.get_storages(),
+                                      ciphers=ciphers,
+                                      block_size=args.block_size,
+                                      policy=create_policy(args.placement))
+            async with aiohttp.ClientSession() as session:
+                await self._balancer.update_capacity(session)
+        except NoStorage as e:
+            print("No available storage. Add one by 'storage add' command or check tokens")
+            logger.exception(e)
+            return
+
+        config = SyncConfig(target=VFS.normalize(args.dst),
+                            thread_num=args.thread_num,
+                            parallel_num=args.file_count,
+                            block_parallel_num=args.worker_count,
+                            need_encrypt=args.need_encrypt,
+                            delete=args.delete,
+                            keep_versions=args.keep_versions,
+                            full=args.full)
+        index = await SyncIndex(args.index_path)
+        try:
+            syncer = Syncer(self._block_repo, self._balancer, index, args.src, config)
+            plan = await syncer.plan()
+            print(f"{len(plan.new)} new, {len(plan.changed)} changed, {len(plan.deleted)} deleted, "
+                  f"{plan.unchanged} unchanged files")
+            if args.dry_run:
+                for file in plan.new:
+                    print(f"+ {file.path}")
+                for file in plan.changed:
+                    print(f"* {file.path}")
+                for path in plan.deleted:
+                    print(f"- {path}")
+                return
+            if not plan.new and not plan.changed and not plan.deleted:
+                return
+
+            result = await syncer.run(plan, progress=lambda done, total: self._replace_line(f"{done}/{total}"))
+        finally:
+            await index.close()
+
+        print(f"\n{result.uploaded} uploaded, {result.skipped} not changed, {result.deleted} deleted")
+        if result.failed:
+            print(f"Failed to sync {len(result.failed)} files, they are synced again next time:")
+            for path in result.failed:
+                print(path)
+
     async def _download_handler(self, args: argparse.Action):
         src, dst = args.src, args.dst
-        temp_dir = args.temp_dir
         if not dst:
             _, dst = os.path.split(src)
 
-        if not os.path.isdir(temp_dir):
-            os.makedirs(temp_dir)
-
         print(f"Start downloading file {repr(src)} to {repr(dst)}")
         try:
-            await self._download_file(src, dst, temp_dir)
+            await self._download_file(src, dst)
         except ChecksumNoEqual as e:
             logger.exception(e)
             print(f"Checksums not equal")
@@ -154,6 +321,8 @@ class CLI:
         await self._block_repo.commit()
 
     async def _storage_files_handler(self, args: argparse.Action):
+        import aiohttp
+
         storage_id = args.storage_id
 
         async with aiohttp.ClientSession() as session:
@@ -167,11 +336,13 @@ class CLI:
             print(file.filename, self._size2human(file.size))
 
     async def _storage_list_handler(self, args: argparse.Action):
+        import aiohttp
+        from tabulate import tabulate
+        from network.balancer import Balancer
+
         async with aiohttp.ClientSession() as s:
             storages = await self._block_repo.get_storages()
-
-            for storage in storages:
-                storage.used_space, storage.total_space = await storage.size(s)
+            await Balancer.fetch_capacity(storages, s, force=True)
 
             print(tabulate([(storage.id,
                              storage.type,
@@ -179,15 +350,11 @@ class CLI:
                             for storage in storages], headers=["id", "type", "space"]))
 
     async def _storage_wipe_handler(self, args: argparse.Action):
+        from network.deleter import Deleter, DeleterConfig
+
         storage_id = args.storage_id
         worker_count = args.worker_count
 
-        async def worker(queue: asyncio.Queue[entity.Block], session: aiohttp.ClientSession):
-            while not queue.empty():
-                block = await queue.get()
-                await self._delete_block(block, session)
-                queue.task_done()
-
         if self._yes_or_no("Are you sure you want to wipe ENTIRELY storage?"):
             if not self._yes_or_no("Are you REALLY want to WIPE ENTIRELY storage?"):
                 return
@@ -199,39 +366,276 @@ class CLI:
             print("Unknown storage id. Use 'storage list' to see all storages")
             return
 
-        async with aiohttp.ClientSession() as session:
-            status, files = await storage.files(session)
-            if status != DownloadStatus.OK:
-                print("Cannot get files in storage. Something went wrong. Please check log file")
-                return
-
-            queue = asyncio.Queue()
-            for file in files:
-                queue.put_nowait(entity.Block(name=file.filename, storage=storage))
-
-            tasks = []
-            for _ in range(worker_count):
-                tasks.append(asyncio.create_task(worker(queue, session)))
-
-            await queue.join()
+        async with Deleter(self._block_repo, DeleterConfig(parallel_num=worker_count)) as deleter:
+            # storage returns files page by page, so list it again until nothing is left
+            listed = None
+            while True:
+                status, files = await storage.files(deleter.session)
+                if status != DownloadStatus.OK:
+                    print("Cannot get files in storage. Something went wrong. Please check log file")
+                    return
+                if not files:
+                    break
+
+                # files are deleted by path if storage lists them in directories, blocks are named by filename
+                paths = {file.path or file.filename: file.filename for file in files}
+                deleted_count = deleter.deleted_count
+                if paths.keys() == listed:
+                    print(f"{len(paths)} files are still listed after deletion. Please check log file")
+                    return
+                listed = paths.keys()
+
+                blocks = (entity.Block(name=name, path=path, storage=storage) for path, name in paths.items())
+                failed = await deleter.delete_blocks(blocks)
+                if failed:
+                    print(f"Failed to delete {len(failed)} files. Please check log file")
+                    return
+                if deleter.deleted_count == deleted_count:
+                    break
+
+            print(f"Storage #{storage.id} wiped. Deleted {deleter.deleted_count} files")
 
     async def _storage_delete_handler(self, args: argparse.Action):
+        from network.deleter import Deleter, DeleterConfig
+
         storage_id = args.storage_id
         filenames = args.filenames
+        worker_count = args.worker_count
 
         storage = await self._block_repo.get_storage_by_id(storage_id)
-        tasks = []
-        async with aiohttp.ClientSession() as session:
-            for filename in filenames:
-                block = entity.Block(storage=storage, name=filename)
-                tasks.append(asyncio.create_task(self._delete_block(block, session)))
-            await asyncio.gather(*tasks)
+        blocks = (entity.Block(storage=storage, name=filename) for filename in filenames)
+        async with Deleter(self._block_repo, DeleterConfig(parallel_num=worker_count)) as deleter:
+            failed = await deleter.delete_blocks(blocks)
+
+        for status, block in failed:
+            print(f"Failed to delete block {block.name}: {status}")
+        print(f"Deleted {deleter.deleted_count} blocks from storage #{storage.id}")
+
+    async def _rebalance_handler(self, args: argparse.Action):
+        from network.placement import ConsistentHashPolicy
+        from network.rebalancer import Rebalancer, RebalancerConfig
+
+        config = RebalancerConfig(parallel_num=args.worker_count,
+                                  bandwidth=args.bandwidth,
+                                  threshold=args.threshold,
+                                  max_moves=args.max_moves)
+
+        storages = await self._block_repo.get_storages()
+        async with Rebalancer(self._block_repo, config) as rebalancer:
+            if args.placement == "hash":
+                moves = await rebalancer.plan_placement(storages, ConsistentHashPolicy())
+            else:
+                moves = await rebalancer.plan(storages)
+            if not moves:
+                print("Storages are balanced")
+                return
+
+            for move in moves:
+                print(f"block {move.block.name} ({self._size2human(move.block.size)}): "
+                      f"storage #{move.block.storage.id} -> #{move.target.id}")
+            total = sum(move.block.size for move in moves)
+            print(f"{len(moves)} blocks ({self._size2human(total)}) will be moved")
+
+            if args.dry_run or not self._yes_or_no("Are you sure you want to move them?"):
+                return
+
+            failed = await rebalancer.run(moves)
+
+        print(f"Moved {rebalancer.moved} blocks ({self._size2human(rebalancer.moved_bytes)})")
+        if failed:
+            print(f"Failed to move {len(failed)} blocks. Check log file")
+
+    async def _scrub_handler(self, args: argparse.Action):
+        from tabulate import tabulate
+        from network.scrubber import Scrubber, ScrubberConfig, ScrubStatus
+
+        config = ScrubberConfig(parallel_num=args.worker_count,
+                                bandwidth=args.bandwidth,
+                                full=args.full,
+                                repair=args.repair)
+
+        storages = await self._block_repo.get_storages()
+        async with Scrubber(self._block_repo, config) as scrubber:
+            results = await scrubber.scrub(storages)
+
+        counts = {status: 0 for status in ScrubStatus}
+        for status, block in results:
+            counts[status] += 1
+            if status != ScrubStatus.OK:
+                print(f"block {block.name} (file #{block.file.id}, number {block.number}) "
+                      f"on storage #{block.storage.id}: {status.value}")
+
+        print(tabulate([(status.value, count) for status, count in counts.items()], headers=["status", "blocks"]))
 
     async def _list_handler(self, args: argparse.Action):
-        self._vfs = VFS(self._block_repo)
-        await self._vfs.load()
-        # await asyncio.sleep(2)
-        print(self._vfs.tree())
+        from vfs.vfs import VFS
+
+        self._vfs = VFS(self._block_repo, page_size=args.limit)
+
+        if args.prefix:
+            page = await self._vfs.find(args.path, args.after)
+            for file in page.entries:
+                print(self._list_entry(file, file.filename, args))
+        elif args.depth:
+            try:
+                await self._vfs.get_directory(args.path)
+            except UnknownDirectory:
+                print(f"Unknown directory {args.path}")
+                return
+            # tree walks all pages, so only the number of shown entries is limited
+            page, shown = None, 0
+            async for level, entry in self._vfs.tree(args.path, None if args.depth < 0 else args.depth - 1):
+                if shown == args.limit:
+                    print("...")
+                    break
+                shown += 1
+                print(self._list_entry(entry, "  " * level + self._entry_name(entry), args))
+        else:
+            try:
+                directory = await self._vfs.get_directory(args.path)
+            except UnknownDirectory:
+                print(f"Unknown directory {args.path}")
+                return
+            page = await self._vfs.list(args.path, args.after)
+            for entry in page.entries:
+                print(self._list_entry(entry, self._entry_name(entry), args))
+            if args.size:
+                print(f"total {self._size2human(directory.size)} in {directory.file_count} files")
+
+        if page and page.next is not None:
+            print(f"more: use --after {page.next!r}")
+
+    @staticmethod
+    def _entry_name(entry: entity.Directory | entity.File) -> str:
+        if isinstance(entry, entity.Directory):
+            return entry.name
+        return entry.filename.rsplit("/", 1)[-1]
+
+    def _list_entry(self, entry: entity.Directory | entity.File, name: str, args: argparse.Action) -> str:
+        incomplete = isinstance(entry, entity.File) and entry.uploaded_blocks < entry.total_blocks
+        if args.color:
+            if isinstance(entry, entity.Directory):
+                name = f"\033[1;34m{name}\033[0m"
+            elif incomplete:
+                name = f"\033[31m{name}\033[0m"
+        if incomplete:
+            name += " (incomplete)"
+        if args.size:
+            return f"{self._size2human(entry.size):>10} {name}"
+        return name
+
+    async def _mount_handler(self, args: argparse.Action):
+        if not os.path.isdir(args.mountpoint):
+            print(f"Mountpoint {args.mountpoint} isn't a directory")
+            return
+        try:
+            # fuse fails to import without libfuse, other commands don't need it
+            from vfs.mount import mount
+        except OSError as e:
+            print(f"Cannot mount: {e}")
+            return
+
+        import aiohttp
+        from network.balancer import Balancer
+        from vfs import BlockReaderConfig, FsyncMode, WriteBackConfig
+
+        config = BlockReaderConfig(memory_cache=args.memory_cache * 2 ** 20,
+                                   disk_cache=args.cache_size * 2 ** 20,
+                                   cache_path=args.cache_path,
+                                   read_ahead=args.read_ahead,
+                                   race_num=args.race_num,
+                                   parallel_num=args.worker_count)
+        balancer, write_back_config = None, None
+        if args.write:
+            ciphers = None
+            if args.need_encrypt:
+                ciphers = await self._block_repo.get_ciphers(CipherType.from_str(args.cipher))
+                if not ciphers:
+                    print("No keys. Add one by 'key add' or don't use '-e' parameter")
+                    return
+            try:
+                balancer = Balancer(await self._block_repo.get_storages(), ciphers=ciphers,
+                                    block_size=args.block_size)
+                async with aiohttp.ClientSession() as session:
+                    await balancer.update_capacity(session)
+            except NoStorage as e:
+                print("No available storage. Add one by 'storage add' command or check tokens")
+                logger.exception(e)
+                return
+            write_back_config = WriteBackConfig(staging_path=args.staging_path,
+                                                staging_size=args.staging_size * 2 ** 20,
+                                                fsync=FsyncMode.from_str(args.fsync),
+                                                flush_delay=args.flush_delay,
+                                                parallel_num=max(1, args.worker_count // 2),
+                                                need_encrypt=args.need_encrypt,
+                                                keep_versions=args.keep_versions)
+
+        print(f"Catalog is mounted at {args.mountpoint}. Unmount it or press Ctrl+C to stop")
+        await mount(self._block_repo, args.mountpoint, config, balancer, write_back_config)
+        print("Unmounted")
+
+    async def _version_list_handler(self, args: argparse.Action):
+        from tabulate import tabulate
+        from vfs.versions import Versions
+
+        versions = await Versions(self._block_repo).list(args.filename)
+        if not versions:
+            print(f"No versions of {args.filename}")
+            return
+        print(tabulate([(file.filename.rsplit("/", 1)[-1], self._size2human(file.size)) for file in versions],
+                       headers=["version", "size"]))
+
+    async def _version_restore_handler(self, args: argparse.Action):
+        from vfs.versions import Versions
+
+        try:
+            await Versions(self._block_repo).restore(args.filename, args.version)
+        except UnknownFile as e:
+            print(f"Unknown version {args.version} of {args.filename}")
+            logger.exception(e)
+            return
+        print(f"Version {args.version} of {args.filename} restored")
+
+    async def _version_prune_handler(self, args: argparse.Action):
+        from vfs.versions import Versions
+
+        count = await Versions(self._block_repo).prune(args.filename, max(args.keep, 0))
+        print(f"{count} versions of {args.filename} deleted")
+
+    async def _snapshot_create_handler(self, args: argparse.Action):
+        from vfs.versions import Versions
+
+        try:
+            count = await Versions(self._block_repo).create_snapshot(args.name, args.prefix)
+        except ValueError as e:
+            print(e)
+            return
+        except FileAlreadyExists as e:
+            print(f"Snapshot {args.name} already exists")
+            logger.exception(e)
+            return
+        print(f"Snapshot {args.name} of {count} files created")
+
+    async def _snapshot_list_handler(self, args: argparse.Action):
+        from tabulate import tabulate
+        from vfs.versions import Versions
+
+        snapshots = await Versions(self._block_repo).list_snapshots()
+        print(tabulate([(snapshot.name.rstrip("/"), snapshot.file_count, self._size2human(snapshot.size))
+                        for snapshot in snapshots], headers=["name", "files", "size"]))
+
+    async def _snapshot_delete_handler(self, args: argparse.Action):
+        from vfs.versions import Versions
+
+        if not self._yes_or_no(f"Snapshot {args.name} will be deleted. Are you sure?"):
+            return
+        try:
+            count = await Versions(self._block_repo).delete_snapshot(args.name)
+        except (ValueError, UnknownDirectory) as e:
+            print(f"Unknown snapshot {args.name}")
+            logger.exception(e)
+            return
+        print(f"Snapshot {args.name} deleted ({count} files)")
 
     async def _delete_handler(self, args: argparse.Action):
         filenames = args.filenames
@@ -254,7 +658,218 @@ class CLI:
                 return
 
         for file in files:
-            await self._delete_file(file)
+            await self._delete_file(file, args.worker_count)
+
+    async def _catalog_migrate_handler(self, args: argparse.Action):
+        from tabulate import tabulate
+        from repository import copy_store
+
+        if os.path.isfile(args.target) or (os.path.isdir(args.target) and os.listdir(args.target)):
+            print(f"{args.target} already exists. Choose new path")
+            return
+
+        target = await StoreCreator.create(args.target, StoreType.from_str(args.store_type), args.shards)
+        try:
+            counts = await copy_store(self._block_repo, target,
+                                      progress=lambda table, count: self._replace_line(f"{table}: {count} rows"))
+        finally:
+            await target.close()
+
+        print()
+        print(tabulate(counts.items(), headers=["table", "rows"]))
+        print(f"Catalog copied to {args.target}. Use it by '--db {args.target}'")
+
+    async def _catalog_export_handler(self, args: argparse.Action):
+        from tabulate import tabulate
+        from repository import export_snapshot
+
+        if os.path.exists(args.path) and not self._yes_or_no(f"{args.path} already exists. Overwrite it?"):
+            return
+
+        counts = await export_snapshot(self._block_repo, args.path, compress_level=args.level,
+                                       progress=lambda table, count: self._replace_line(f"{table}: {count} rows"))
+        print()
+        print(tabulate(counts.items(), headers=["table", "rows"]))
+        print(f"Catalog exported to {args.path} ({self._size2human(os.path.getsize(args.path))})")
+
+    async def _catalog_import_handler(self, args: argparse.Action):
+        from tabulate import tabulate
+        from repository import import_snapshot
+
+        if not os.path.isfile(args.path):
+            print(f"Cannot open file {args.path}")
+            return
+        if await self._block_repo.get_storages() or await self._block_repo.get_files():
+            print("Catalog isn't empty. Import snapshot into new catalog given by '--db'")
+            return
+
+        try:
+            counts = await import_snapshot(self._block_repo, args.path,
+                                           progress=lambda table, count: self._replace_line(f"{table}: {count} rows"))
+        except exceptions.BrokenSnapshot as e:
+            logger.exception(e)
+            print(f"\nCannot import snapshot: {e}")
+            return
+
+        print()
+        print(tabulate(counts.items(), headers=["table", "rows"]))
+        print(f"Snapshot {args.path} imported")
+
+    async def _daemon_start_handler(self, args: argparse.Action):
+        from daemon import Daemon, DaemonConfig
+
+        config = DaemonConfig(socket_path=self._socket_path(args),
+                              job_num=args.job_num,
+                              block_parallel_num=args.block_parallel_num)
+        try:
+            async with Daemon(self._block_repo, config) as daemon:
+                print(f"Daemon listens on {config.socket_path}. Stop it by 'daemon stop' or Ctrl+C")
+                await daemon.serve()
+        except DaemonAlreadyRunning:
+            print(f"Daemon is already running on {config.socket_path}")
+            return
+        print("Daemon stopped")
+
+    async def _daemon_stop_handler(self, args: argparse.Action):
+        if not self._client:
+            print("Daemon isn't running")
+            return
+        await self._client.request("stop")
+        print("Daemon stopped")
+
+    async def _daemon_status_handler(self, args: argparse.Action):
+        from tabulate import tabulate
+
+        if not self._client:
+            print("Daemon isn't running")
+            return
+        status = await self._client.request("ping")
+        jobs = (await self._client.request("jobs"))["jobs"]
+        print(f"Daemon {status['pid']}: {status['running']} running, {status['queued']} queued jobs")
+        if not jobs:
+            return
+
+        table = []
+        for job in jobs:
+            job_args = job["args"]
+            done, total = job["progress"]
+            table.append((job["id"],
+                          job["command"],
+                          job_args.get("dst") or job_args.get("src") or " ".join(job_args.get("filenames", ())),
+                          f"{job['status']}: {job['error']}" if job["error"] else job["status"],
+                          f"{done * 100 // total}%" if total else ""))
+        print(tabulate(table, headers=["id", "command", "file", "status", "progress"]))
+
+    # HANDLERS USING DAEMON
+
+    async def _upload_remote_handler(self, args: argparse.Action):
+        src, dst = args.src, args.dst
+        if not dst:
+            _, dst = os.path.split(src)
+
+        if not os.path.isfile(src):
+            print(f"Cannot open file {src}")
+            return
+
+        print(f"Upload file {repr(src)} like {repr(dst)} by daemon")
+        try:
+            result = await self._client.request("upload", progress=self._print_progress,
+                                                src=os.path.abspath(src),
+                                                dst=dst,
+                                                block_size=args.block_size,
+                                                need_encrypt=args.need_encrypt,
+                                                cipher=args.cipher,
+                                                placement=args.placement,
+                                                keep_version=args.keep_version,
+                                                update=args.update)
+        except NoCipher:
+            print("No keys. Add one by 'key add' or don't use '-e' parameter")
+            return
+        except UnknownFile:
+            print(f"File {dst} isn't uploaded. Upload it without '-u'")
+            return
+        except NoStorage:
+            print("No available storage. Add one by 'storage add' command or check tokens")
+            return
+        except NotEnoughSpace:
+            print("Not enough free space in storages")
+            return
+        except FileAlreadyExists:
+            print(f"File with name {dst} already exists")
+            return
+        except ErrorBase as e:
+            logger.exception(e)
+            print(f"\n{e}")
+            print("Exit")
+            return
+
+        print()
+        if not result["uploaded"]:
+            print(f"File {dst} is up to date")
+            return
+        if result["changed"] is not None:
+            print(f"{result['changed']} of {result['blocks']} blocks changed")
+        if result["reused"]:
+            print(f"{result['reused']} copies of blocks are reused from the previous version")
+        print("File successfully uploaded")
+
+    async def _download_remote_handler(self, args: argparse.Action):
+        src, dst = args.src, args.dst
+        if not dst:
+            _, dst = os.path.split(src)
+
+        print(f"Start downloading file {repr(src)} to {repr(dst)} by daemon")
+        try:
+            await self._client.request("download", progress=self._print_progress, src=src, dst=os.path.abspath(dst))
+        except ChecksumNoEqual as e:
+            logger.exception(e)
+            print(f"\nChecksums not equal")
+            return
+        except ErrorBase as e:
+            self._fatal_error()
+            logger.exception(e)
+            return
+        print(f"\nFile {src} successfully downloaded to {dst}")
+
+    async def _list_remote_handler(self, args: argparse.Action):
+        from daemon.protocol import decode_entry
+
+        try:
+            result = await self._client.request("list", path=args.path, after=args.after, limit=args.limit,
+                                                prefix=args.prefix, depth=args.depth)
+        except UnknownDirectory:
+            print(f"Unknown directory {args.path}")
+            return
+
+        entries = [(level, decode_entry(entry)) for level, entry in result["entries"]]
+        for level, entry in entries[:args.limit]:
+            name = entry.filename if args.prefix else "  " * level + self._entry_name(entry)
+            print(self._list_entry(entry, name, args))
+        if len(entries) > args.limit:
+            print("...")
+        if result["directory"] and args.size:
+            directory = decode_entry(result["directory"])
+            print(f"total {self._size2human(directory.size)} in {directory.file_count} files")
+        if result["next"] is not None:
+            print(f"more: use --after {result['next']!r}")
+
+    async def _delete_remote_handler(self, args: argparse.Action):
+        filenames = [filename for filename in args.filenames
+                     if self._yes_or_no(f"File {filename} will be deleted. Are you sure you want to load it?[y/n]")]
+        if not filenames:
+            return
+
+        try:
+            result = await self._client.request("delete", filenames=filenames)
+        except UnknownFile as e:
+            print("Unknown file")
+            logger.exception(e)
+            return
+
+        for filename in result["deleted"]:
+            print(f"File {filename} deleted")
+        for filename in result["failed"]:
+            print(f"Failed to delete blocks of file {filename}. Try to delete it again")
 
     async def _key_add_handler(self, args: argparse.Action):
         key = args.key
@@ -274,6 +889,8 @@ class CLI:
         print("Key successfully added")
 
     async def _key_list_handler(self, args: argparse.Action):
+        from tabulate import tabulate
+
         keys = await self._block_repo.get_keys()
         table = []
         for key in keys:
@@ -285,22 +902,18 @@ class CLI:
 
     # OTHER
 
-    async def _delete_block(self, block: entity.Block, session: aiohttp.ClientSession):
-        status = await block.storage.delete(block.name, session)
-        if status == DeleteStatus.OK:
-            print(f"Block {block.name} on storage #{block.storage.id} is deleted")
-            await self._block_repo.del_block(entity.Block(name=block.name, storage=block.storage))
-        else:
-            print(f"Failed to delete block {block.name}")
+    async def _delete_file(self, file: entity.File, worker_count: int):
+        from network.deleter import Deleter, DeleterConfig
 
-    async def _delete_file(self, file: entity.File):
         blocks = await self._block_repo.get_blocks_by_file(file)
 
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            for block in blocks:
-                tasks.append(asyncio.create_task(self._delete_block(block, session)))
-            await asyncio.gather(*tasks)
+        async with Deleter(self._block_repo, DeleterConfig(parallel_num=worker_count)) as deleter:
+            failed = await deleter.delete_blocks(blocks)
+
+        if failed:
+            print(f"Failed to delete {len(failed)} blocks of file {file.filename}. Try to delete it again")
+            return
+
         await self._block_repo.del_file(file)
         await self._block_repo.commit()
         print(f"File {file.filename} deleted")
@@ -353,8 +966,14 @@ class CLI:
         bar = fill * filledLength + '-' * (length - filledLength)
         print(f'\r{prefix} |{bar}| {percent}% {suffix}', end=end)
 
+    @classmethod
+    def _print_progress(cls, done: int, total: int):
+        if total:
+            # chunks of the last block are estimated, so done may exceed total
+            cls._progress_bar(min(done, total), total, end="")
+
     @staticmethod
-    def _multi_progress_bar(progress: List[BlockProgress]) -> int:
+    def _multi_progress_bar(progress: List["BlockProgress"]) -> int:
         if not progress:
             return 0
 
@@ -381,15 +1000,16 @@ class CLI:
     def _go_down(count: int = 1):
         print(end=("\033[B" * count))
 
-    async def _download_file(self, src: str, dst: str, temp_dir: str) -> None:
+    async def _download_file(self, src: str, dst: str) -> None:
         """
         Download file by name in system
 
         :param src: Source file path
         :param dst: Destination file path
-        :param temp_dir: Path to directory for blocks
         :return:
         """
+        from network.downloader import Downloader
+
         async with Downloader(self._block_repo) as downloader:
             file = await self._block_repo.get_file_by_filename(src)
             file.path = dst
@@ -397,7 +1017,7 @@ class CLI:
             block_size = self._size2human(file.size // file.total_blocks)
             print(f"File {file.filename} consist of {file.total_blocks} {block_size} blocks")
 
-            download_task = asyncio.create_task(downloader.download_file(file, temp_dir=temp_dir))
+            download_task = asyncio.create_task(downloader.download_file(file))
             logger.info("Create download task")
             bar_size = 0
             async for progress in self._poll_task(0.5, download_task, lambda: downloader.progress):
@@ -419,12 +1039,15 @@ class CLI:
             yield func()
             await asyncio.sleep(period)
 
-    async def _upload_file(self, file: entity.File) -> None:
+    async def _upload_file(self, file: entity.File, base: Optional[entity.File] = None,
+                           hashes: Optional[List[str]] = None) -> None:
         """
-        Upload file
+        Upload file, blocks which are the same as in base file aren't uploaded (see Uploader.upload_file)
 
         If user don't confirm operation it will raise CancelAction
         """
+        from network.uploader import Uploader
+
         async with Uploader(self._balancer, self._block_repo) as uploader:
             self._balancer.fill_file(file)
 
@@ -443,7 +1066,7 @@ class CLI:
                 if not self._yes_or_no(f"Do you want to continue load?"):
                     raise exceptions.CancelAction()
 
-            upload_task = asyncio.create_task(uploader.upload_file(file))
+            upload_task = asyncio.create_task(uploader.upload_file(file, base, hashes))
             bar_size = 0
             async for progress in self._poll_task(0.5, upload_task, lambda: uploader.progress):
                 bar_size = self._multi_progress_bar(progress)
@@ -456,6 +1079,8 @@ class CLI:
                 for status, block in unloaded_blocks:
                     print(f"block_number={block.number} status={status}")
                 raise exceptions.UploadFailed()
+            if base:
+                print(f"{uploader.reused} copies of blocks are reused from the previous version")
 
     def _parse(self):
         return self._parser.parse_args()
@@ -466,10 +1091,17 @@ class CLI:
 
     async def start(self):
         args = self._parse()
-        await args.func(args)
+        if self._client:
+            await self._remote_handlers[args.func](args)
+        else:
+            await args.func(args)
 
     async def close(self):
-        await self._block_repo.close()
+        if self._block_repo:
+            await self._block_repo.close()
+        if self._client:
+            client, self._client = self._client, None
+            await client.__aexit__(None, None, None)
 
     def interrupt(self):
         print("\nInterrupted")
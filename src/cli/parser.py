@@ -6,11 +6,16 @@ class Parser(argparse.ArgumentParser):
     def __init__(self):
         super(Parser, self).__init__()
 
-        self.add_argument('-d', '--db', dest='db_path', default="db.sqlite", help="Path to config file")
+        self.add_argument('-d', '--db', dest='db_path', default="db.sqlite",
+                          help="Path to catalog (directory for sharded catalog)")
         self.add_argument('--debug', action="store_true", help="Enable debug output")
         self.add_argument('--log', help="Path to log file", default="log.txt", dest="log_path")
         self.add_argument('-w', '--worker-count', help="Count of simultaneous workers (connections)", default=5,
                           type=int, dest="worker_count")
+        self.add_argument('--socket', help="Unix socket of daemon (catalog path with '.sock' by default)",
+                          dest="socket_path")
+        self.add_argument('--local', action="store_true", help="Run upload, download, list and delete in this "
+                                                                "process even if daemon is running")
 
         subparsers = self.add_subparsers(parser_class=argparse.ArgumentParser)
         # UPLOAD
@@ -23,14 +28,50 @@ class Parser(argparse.ArgumentParser):
 
 
         self._upload.add_argument("-e", "--encrypt", action="store_true", dest="need_encrypt")
+        self._upload.add_argument("--cipher", help="Cipher used with '-e'. 'aes-convergent' gives the same "
+                                                    "encrypted data for the same content, so it's uploaded once",
+                                  choices=["aes-gcm", "aes-convergent", "aes"],
+                                  default="aes-gcm")
+        self._upload.add_argument("-p", "--placement", help="Placement policy of blocks: the least used storages, "
+                                                            "the fastest ones or consistent hashing", choices=["space", "throughput", "hash"],
+                                  default="space", dest="placement")
+        self._upload.add_argument("-k", "--keep-version", action="store_true", dest="keep_version",
+                                  help="Replace existing file keeping it as version, only changed blocks are uploaded")
+        self._upload.add_argument("-u", "--update", action="store_true",
+                                  help="Update existing file: block hashes of local file are compared with stored "
+                                       "ones and only changed blocks are uploaded")
+
+        # SYNC
+        self._sync = subparsers.add_parser("sync", help="Upload new and changed files of directory and delete "
+                                                        "removed ones")
+        self._sync.add_argument("src", help="Path to directory")
+        self._sync.add_argument("dst", help="Directory in system (root by default)", nargs='?', default="")
+        self._sync.add_argument("--index", help="Path to index of synced files, unchanged files are skipped "
+                                                "without reading", default="sync.sqlite", dest="index_path")
+        self._sync.add_argument("--full", action="store_true", help="Ignore index: compare block hashes of all "
+                                                                    "files and delete all files missing in directory")
+        self._sync.add_argument("--no-delete", action="store_false", help="Keep files removed from directory",
+                                dest="delete")
+        self._sync.add_argument("--dry-run", action="store_true", help="Only show changes", dest="dry_run")
+        self._sync.add_argument("-k", "--keep-versions", action="store_true", dest="keep_versions",
+                                help="Keep changed and deleted files as versions")
+        self._sync.add_argument("--threads", help="Threads scanning directories and hashing files", type=int,
+                                default=8, dest="thread_num")
+        self._sync.add_argument("-f", "--file-count", help="Files uploaded at once", type=int, default=4,
+                                dest="file_count")
+        self._sync.add_argument("-b", "--block-size", help="Size of block of new files in bytes", type=int,
+                                default=20 * 2 ** 20, dest="block_size")
+        self._sync.add_argument("-e", "--encrypt", action="store_true", dest="need_encrypt")
+        self._sync.add_argument("--cipher", help="Cipher used with '-e'", choices=["aes-gcm", "aes-convergent", "aes"],
+                                default="aes-gcm")
+        self._sync.add_argument("-p", "--placement", help="Placement policy of blocks",
+                                choices=["space", "throughput", "hash"], default="space", dest="placement")
 
         # DOWNLOAD
         self._download = subparsers.add_parser("download", help="Download file")
 
         self._download.add_argument("src", help="Path to file")
         self._download.add_argument("dst", help="Filename in system", nargs='?', default="")
-        self._download.add_argument("--temp-dir", help="Path to temp directory", default="blocks",
-                                    dest="temp_dir")
 
         # STORAGE ADD/LIST/FILES/DELETE/WIPE
         self._storage = subparsers.add_parser("storage", help="Storage options")
@@ -41,8 +82,9 @@ class Parser(argparse.ArgumentParser):
         self._storage_delete = storage_subparsers.add_parser("delete", help="Delete files from storage")
         self._storage_wipe = storage_subparsers.add_parser("wipe", help="Wipe storage")
 
-        self._storage_add.add_argument("type", help="Type of storage", choices=["yandex-disk"])
-        self._storage_add.add_argument("token", help="Authorization token")
+        self._storage_add.add_argument("type", help="Type of storage", choices=["yandex-disk", "s3"])
+        self._storage_add.add_argument("token", help="Authorization token "
+                                                                "(for s3: http[s]://ACCESS_KEY:SECRET_KEY@host/bucket)")
 
         self._storage_files.add_argument("storage_id")
 
@@ -50,15 +92,133 @@ class Parser(argparse.ArgumentParser):
         self._storage_delete.add_argument("filenames", nargs="+")
 
         self._storage_wipe.add_argument("storage_id")
+        # REBALANCE
+        self._rebalance = subparsers.add_parser("rebalance", help="Move blocks to even out usage of storages")
+        self._rebalance.add_argument("--bandwidth", help="Bandwidth limit in bytes per second (0 - unlimited)",
+                                     type=int, default=0)
+        self._rebalance.add_argument("--threshold", help="Acceptable difference of storage usage ratios",
+                                     type=float, default=0.05)
+        self._rebalance.add_argument("--max-moves", help="Maximum number of moved blocks (0 - unlimited)",
+                                     type=int, default=0, dest="max_moves")
+        self._rebalance.add_argument("--dry-run", action="store_true", help="Only show planned moves",
+                                     dest="dry_run")
+        self._rebalance.add_argument("--placement", help="Even out usage of storages or move blocks to storages "
+                                                         "computed by consistent hashing",
+                                     choices=["space", "hash"], default="space")
+
+        # SCRUB
+        self._scrub = subparsers.add_parser("scrub", help="Check blocks in storages and recreate lost duplicates")
+        self._scrub.add_argument("--bandwidth", help="Bandwidth limit in bytes per second (0 - unlimited)",
+                                 type=int, default=0)
+        self._scrub.add_argument("--full", action="store_true", help="Download blocks instead of using metadata")
+        self._scrub.add_argument("--no-repair", action="store_false", help="Only check blocks", dest="repair")
+
         # LIST
         self._list = subparsers.add_parser("list", help="Show list of files")
+        self._list.add_argument("path", nargs="?", default="", help="Directory to list (root by default)")
         self._list.add_argument("-s", "--size", action="store_true", help="Show size of files")
         self._list.add_argument("-c", "--color", action="store_true", help="Show colorized")
+        self._list.add_argument("-p", "--prefix", action="store_true",
+                                help="List all files which names start with path")
+        self._list.add_argument("--depth", type=int, default=0, help="Levels of subdirectories to show (-1 - all)")
+        self._list.add_argument("--limit", type=int, default=100, help="Number of entries in page")
+        self._list.add_argument("--after", default="", help="Show page after this path")
+
+        # MOUNT
+        self._mount = subparsers.add_parser("mount", help="Mount catalog as read-only filesystem (needs libfuse)")
+        self._mount.add_argument("mountpoint", help="Empty directory")
+        self._mount.add_argument("--cache-dir", help="Directory of downloaded blocks", default="cache",
+                                 dest="cache_path")
+        self._mount.add_argument("--cache-size", help="Size of disk cache in MB (0 - disable)", type=int,
+                                 default=2048)
+        self._mount.add_argument("--memory-cache", help="Size of memory cache in MB", type=int, default=256)
+        self._mount.add_argument("--read-ahead", help="Blocks downloaded ahead of sequential reads", type=int,
+                                 default=4)
+        self._mount.add_argument("--race", help="Replicas of block downloaded at once, the first one is used",
+                                 type=int, default=2, dest="race_num")
+        self._mount.add_argument("-w", "--write", action="store_true", help="Writable mount: written files are "
+                                                                            "staged locally and uploaded when closed")
+        self._mount.add_argument("--staging-dir", help="Directory of written files before upload", default="staging",
+                                 dest="staging_path")
+        self._mount.add_argument("--staging-size", help="Size of staging directory in MB, writes wait for uploads "
+                                                        "when it is full", type=int, default=4096)
+        self._mount.add_argument("--fsync", help="What fsync waits for: nothing, writing to local disk or upload",
+                                 choices=["none", "local", "upload"], default="local")
+        self._mount.add_argument("--flush-delay", help="Seconds after file is closed before its upload", type=float,
+                                 default=2)
+        self._mount.add_argument("-b", "--block-size", help="Size of block of written files in bytes", type=int,
+                                 default=20 * 2 ** 20, dest="block_size")
+        self._mount.add_argument("-e", "--encrypt", action="store_true", dest="need_encrypt")
+        self._mount.add_argument("--cipher", help="Cipher used with '-e'", choices=["aes-gcm", "aes-convergent", "aes"],
+                                 default="aes-gcm")
+        self._mount.add_argument("--keep-versions", action="store_true", dest="keep_versions",
+                                 help="Keep replaced content of written files as versions")
+
+        # VERSION LIST/RESTORE/PRUNE
+        self._version = subparsers.add_parser("version", help="Versions of files kept by 'upload -k'")
+        version_subparsers = self._version.add_subparsers(parser_class=argparse.ArgumentParser)
+        self._version_list = version_subparsers.add_parser("list", help="List versions of file")
+        self._version_restore = version_subparsers.add_parser("restore", help="Make version current, current file "
+                                                                              "is kept as version")
+        self._version_prune = version_subparsers.add_parser("prune", help="Delete old versions of file")
+
+        self._version_list.add_argument("filename")
+        self._version_restore.add_argument("filename")
+        self._version_restore.add_argument("version", help="Version shown by 'version list'")
+        self._version_prune.add_argument("filename")
+        self._version_prune.add_argument("--keep", help="Number of the latest versions to keep", type=int,
+                                         default=30)
+
+        # SNAPSHOT CREATE/LIST/DELETE
+        self._snapshot = subparsers.add_parser("snapshot", help="Point-in-time copies of files sharing their blocks")
+        snapshot_subparsers = self._snapshot.add_subparsers(parser_class=argparse.ArgumentParser)
+        self._snapshot_create = snapshot_subparsers.add_parser("create", help="Create snapshot")
+        self._snapshot_list = snapshot_subparsers.add_parser("list", help="List snapshots")
+        self._snapshot_delete = snapshot_subparsers.add_parser("delete", help="Delete snapshot")
+
+        self._snapshot_create.add_argument("name")
+        self._snapshot_create.add_argument("prefix", nargs="?", default="",
+                                           help="Copy only files which names start with prefix")
+        self._snapshot_delete.add_argument("name")
 
         # DELETE
         self._delete = subparsers.add_parser("delete", help="Delete file")
         self._delete.add_argument("filenames", nargs="+")
 
+        # CATALOG MIGRATE/EXPORT/IMPORT
+        self._catalog = subparsers.add_parser("catalog", help="Catalog options")
+        catalog_subparsers = self._catalog.add_subparsers(parser_class=argparse.ArgumentParser)
+        self._catalog_migrate = catalog_subparsers.add_parser("migrate", help="Copy catalog to new store")
+        self._catalog_migrate.add_argument("target", help="Path to new catalog")
+        self._catalog_migrate.add_argument("--type", help="Type of new store: one sqlite file or directory of "
+                                                          "sqlite files with blocks split by file",
+                                           choices=["sqlite", "sharded"], default="sharded", dest="store_type")
+        self._catalog_migrate.add_argument("--shards", help="Number of shards of sharded store", type=int,
+                                           default=8)
+        self._catalog_export = catalog_subparsers.add_parser("export", help="Write compressed snapshot of catalog")
+        self._catalog_export.add_argument("path", help="Path to snapshot file")
+        self._catalog_export.add_argument("--level", help="Compression level (1 - fastest, 9 - smallest). "
+                                                          "Hashes and names are random, so higher levels "
+                                                          "save little", type=int, choices=range(1, 10), default=1)
+        self._catalog_import = catalog_subparsers.add_parser("import", help="Load snapshot into empty catalog "
+                                                                            "given by '--db' (existing directory "
+                                                                            "for sharded catalog)")
+        self._catalog_import.add_argument("path", help="Path to snapshot file")
+
+        # DAEMON START/STOP/STATUS
+        self._daemon = subparsers.add_parser("daemon", help="Process keeping catalog and connections open, "
+                                                            "upload, download, list and delete are sent to it "
+                                                            "while it runs")
+        daemon_subparsers = self._daemon.add_subparsers(parser_class=argparse.ArgumentParser)
+        self._daemon_start = daemon_subparsers.add_parser("start", help="Run daemon until 'daemon stop' or Ctrl+C")
+        self._daemon_stop = daemon_subparsers.add_parser("stop", help="Stop daemon, running jobs are interrupted")
+        self._daemon_status = daemon_subparsers.add_parser("status", help="Show jobs of daemon")
+
+        self._daemon_start.add_argument("-j", "--jobs", help="Jobs running at once, others wait in queue", type=int,
+                                        default=4, dest="job_num")
+        self._daemon_start.add_argument("--blocks", help="Block transfers at once by all jobs", type=int,
+                                        default=10, dest="block_parallel_num")
+
         # KEY ADD/LIST
         self._key = subparsers.add_parser("key", help="Key options")
         key_subparsers = self._key.add_subparsers()
@@ -72,12 +232,36 @@ class Parser(argparse.ArgumentParser):
     def set_upload_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
         self._upload.set_defaults(func=func)
 
+    def set_sync_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._sync.set_defaults(func=func)
+
     def set_download_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
         self._download.set_defaults(func=func)
 
     def set_list_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
         self._list.set_defaults(func=func)
 
+    def set_mount_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._mount.set_defaults(func=func)
+
+    def set_version_list_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._version_list.set_defaults(func=func)
+
+    def set_version_restore_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._version_restore.set_defaults(func=func)
+
+    def set_version_prune_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._version_prune.set_defaults(func=func)
+
+    def set_snapshot_create_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._snapshot_create.set_defaults(func=func)
+
+    def set_snapshot_list_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._snapshot_list.set_defaults(func=func)
+
+    def set_snapshot_delete_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._snapshot_delete.set_defaults(func=func)
+
     def set_storage_add_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
         self._storage_add.set_defaults(func=func)
 
@@ -93,9 +277,33 @@ class Parser(argparse.ArgumentParser):
     def set_storage_wipe_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
         self._storage_wipe.set_defaults(func=func)
 
+    def set_rebalance_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._rebalance.set_defaults(func=func)
+
+    def set_scrub_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._scrub.set_defaults(func=func)
+
     def set_delete_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
         self._delete.set_defaults(func=func)
 
+    def set_catalog_migrate_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._catalog_migrate.set_defaults(func=func)
+
+    def set_catalog_export_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._catalog_export.set_defaults(func=func)
+
+    def set_catalog_import_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._catalog_import.set_defaults(func=func)
+
+    def set_daemon_start_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._daemon_start.set_defaults(func=func)
+
+    def set_daemon_stop_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._daemon_stop.set_defaults(func=func)
+
+    def set_daemon_status_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
+        self._daemon_status.set_defaults(func=func)
+
     def set_key_add_handler(self, func: Callable[[], Coroutine[argparse.Action, None, None]]):
         self._key_add.set_defaults(func=func)
 
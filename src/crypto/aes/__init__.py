@@ -4,10 +4,12 @@ from Crypto import Random
 from Crypto.Cipher import AES
 
 import entity
-from crypto.cipher_base import CipherBase
+from crypto.cipher_base import CipherBase, CipherType
 
 
 class Aes(CipherBase):
+    type = CipherType.AES
+
     def __init__(self, key: entity.Key):
         self._key = key
         self._hashed_key = hashlib.sha256(key.key.encode('ascii')).digest()
@@ -30,3 +32,7 @@ class Aes(CipherBase):
 
     def key(self):
         return self._key
+
+    def encrypted_size(self, size: int) -> int:
+        # iv + data padded by at least one byte
+        return AES.block_size * (size // AES.block_size + 2)
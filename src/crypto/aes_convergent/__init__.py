@@ -0,0 +1,62 @@
+import hashlib
+import hmac
+import struct
+from typing import Optional, Tuple
+
+from Crypto.Cipher import AES
+
+import entity
+from crypto.aes_gcm import AesGcm, HEADER_SIZE, NONCE_PREFIX_SIZE
+from crypto.cipher_base import CipherStream, CipherType, BufferedCipherStream
+
+MAGIC = b'CRC1'
+WRAPPED_KEY_SIZE = 32 + 16  # key of block encrypted by AES-SIV and its tag
+
+
+class AesConvergent(AesGcm):
+    """
+    Convergent encryption: AesGcm with key and nonce derived from hash of plaintext
+
+    Key of data is HMAC of its sha256 by user key, it is wrapped by user key (deterministic AES-SIV)
+    and stored in header, so data is decrypted by user key only.
+    The same plaintext encrypted by the same user key always gives the same ciphertext, so equal blocks
+    can be stored once. Anyone who can read storages sees which blocks are equal
+    """
+    type = CipherType.AES_CONVERGENT
+    convergent = True
+    _magic = MAGIC
+
+    def __init__(self, key: entity.Key, chunk_size: int = 64 * 2 ** 10):
+        super(AesConvergent, self).__init__(key, chunk_size)
+        # AES-SIV needs double length key
+        self._wrapping_key = hashlib.sha512(key.key.encode('ascii')).digest()
+
+    def _new_header(self, content_hash: Optional[bytes]) -> Tuple[bytes, bytes]:
+        if content_hash is None:
+            raise ValueError("Convergent encryption needs hash of plaintext")
+
+        key = hmac.new(self._hashed_key, content_hash, hashlib.sha256).digest()
+        # nonce is never reused with another plaintext, because key is unique for plaintext
+        prefix = hmac.new(key, b'nonce', hashlib.sha256).digest()[:NONCE_PREFIX_SIZE]
+        wrapped, tag = AES.new(self._wrapping_key, AES.MODE_SIV).encrypt_and_digest(key)
+        return key, self._magic + struct.pack('>I', self._chunk_size) + prefix + wrapped + tag
+
+    def _parse_header(self, header: bytes) -> Tuple[bytes, int]:
+        _, chunk_size = super(AesConvergent, self)._parse_header(header)
+        wrapped = header[HEADER_SIZE:HEADER_SIZE + WRAPPED_KEY_SIZE]
+        key = AES.new(self._wrapping_key, AES.MODE_SIV).decrypt_and_verify(wrapped[:-16], wrapped[-16:])
+        return key, chunk_size
+
+    def encrypt(self, data: bytes) -> bytes:
+        encryptor = self.encryptor(hashlib.sha256(data).digest())
+        return encryptor.update(data) + encryptor.finalize()
+
+    def encryptor(self, content_hash: Optional[bytes] = None) -> CipherStream:
+        if content_hash is None:
+            # hash is known only after the whole data
+            return BufferedCipherStream(self.encrypt)
+        return super(AesConvergent, self).encryptor(content_hash)
+
+    @property
+    def header_size(self) -> int:
+        return HEADER_SIZE + WRAPPED_KEY_SIZE
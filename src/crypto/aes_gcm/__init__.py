@@ -0,0 +1,187 @@
+import hashlib
+import struct
+from typing import Callable, Optional, Tuple
+
+from Crypto import Random
+from Crypto.Cipher import AES
+
+import entity
+from crypto.cipher_base import CipherBase, CipherType, CipherStream
+
+MAGIC = b'CRG1'
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 8
+HEADER_SIZE = len(MAGIC) + 4 + NONCE_PREFIX_SIZE
+
+
+class _Frames:
+    """
+    Encryption of one frame
+
+    Frame i is AES-GCM of i-th chunk with nonce (prefix, i). Header, i and flag of the last frame
+    are authenticated, so frames cannot be reordered, cut off or moved to another block
+    """
+
+    def __init__(self, key: bytes, header: bytes):
+        self._key = key
+        self._header = header
+        self._prefix = header[len(MAGIC) + 4:len(MAGIC) + 4 + NONCE_PREFIX_SIZE]
+
+    def _cipher(self, index: int, final: bool):
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=self._prefix + struct.pack('>I', index), mac_len=TAG_SIZE)
+        cipher.update(self._header + struct.pack('>I?', index, final))
+        return cipher
+
+    def encrypt(self, index: int, data: bytes, final: bool) -> bytes:
+        ciphertext, tag = self._cipher(index, final).encrypt_and_digest(data)
+        return ciphertext + tag
+
+    def decrypt(self, index: int, frame: bytes, final: bool) -> bytes:
+        """
+        Raise ValueError if frame is corrupted
+        """
+        return self._cipher(index, final).decrypt_and_verify(frame[:-TAG_SIZE], frame[-TAG_SIZE:])
+
+
+class _Encryptor(CipherStream):
+    def __init__(self, key: bytes, header: bytes, chunk_size: int):
+        self._chunk_size = chunk_size
+        self._frames = _Frames(key, header)
+        self._index = 0
+        self._buffer = bytearray()
+        self._output = bytearray(header)
+
+    def update(self, data: bytes) -> bytes:
+        self._buffer += data
+        # the last chunk is kept until finalize, because the last frame is marked
+        while len(self._buffer) > self._chunk_size:
+            self._output += self._frames.encrypt(self._index, bytes(self._buffer[:self._chunk_size]), False)
+            del self._buffer[:self._chunk_size]
+            self._index += 1
+
+        output, self._output = bytes(self._output), bytearray()
+        return output
+
+    def finalize(self) -> bytes:
+        output = bytes(self._output) + self._frames.encrypt(self._index, bytes(self._buffer), True)
+        self._output, self._buffer = bytearray(), bytearray()
+        return output
+
+
+class _Decryptor(CipherStream):
+    def __init__(self, header_size: int, parse_header: Callable[[bytes], Tuple[bytes, int]]):
+        self._header_size = header_size
+        self._parse_header = parse_header
+        self._frames = None
+        self._frame_size = 0
+        self._index = 0
+        self._buffer = bytearray()
+
+    def update(self, data: bytes) -> bytes:
+        self._buffer += data
+        if not self._frames:
+            if len(self._buffer) < self._header_size:
+                return b''
+            header = bytes(self._buffer[:self._header_size])
+            key, chunk_size = self._parse_header(header)
+            self._frames = _Frames(key, header)
+            self._frame_size = chunk_size + TAG_SIZE
+            del self._buffer[:self._header_size]
+
+        output = bytearray()
+        while len(self._buffer) > self._frame_size:
+            output += self._frames.decrypt(self._index, bytes(self._buffer[:self._frame_size]), False)
+            del self._buffer[:self._frame_size]
+            self._index += 1
+        return bytes(output)
+
+    def finalize(self) -> bytes:
+        if not self._frames or len(self._buffer) < TAG_SIZE:
+            raise ValueError("Encrypted data is truncated")
+        return self._frames.decrypt(self._index, bytes(self._buffer), True)
+
+
+class AesGcm(CipherBase):
+    """
+    AES-GCM over chunks of data
+
+    Format: header (magic, chunk size, random nonce prefix) and frames (encrypted chunk + tag).
+    Data can be encrypted and decrypted chunk by chunk, any range of plaintext is decrypted
+    by its frames only, and every frame is authenticated
+    """
+    type = CipherType.AES_GCM
+    _magic = MAGIC
+
+    def __init__(self, key: entity.Key, chunk_size: int = 64 * 2 ** 10):
+        self._key = key
+        self._hashed_key = hashlib.sha256(key.key.encode('ascii')).digest()
+        self._chunk_size = chunk_size
+
+    def encrypt(self, data: bytes) -> bytes:
+        encryptor = self.encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+    def decrypt(self, data: bytes) -> bytes:
+        decryptor = self.decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+
+    def _new_header(self, content_hash: Optional[bytes]) -> Tuple[bytes, bytes]:
+        """
+        Get key of frames and header for new encrypted data
+        """
+        header = self._magic + struct.pack('>I', self._chunk_size) + Random.new().read(NONCE_PREFIX_SIZE)
+        return self._hashed_key, header
+
+    def _parse_header(self, header: bytes) -> Tuple[bytes, int]:
+        """
+        Get key of frames and chunk size from header
+
+        Raise ValueError if header has unknown format
+        """
+        if header[:len(MAGIC)] != self._magic:
+            raise ValueError("Unknown format of encrypted data")
+        return self._hashed_key, struct.unpack('>I', header[len(MAGIC):len(MAGIC) + 4])[0]
+
+    def encryptor(self, content_hash: Optional[bytes] = None) -> CipherStream:
+        key, header = self._new_header(content_hash)
+        return _Encryptor(key, header, self._chunk_size)
+
+    def decryptor(self) -> CipherStream:
+        return _Decryptor(self.header_size, self._parse_header)
+
+    def key(self):
+        return self._key
+
+    def encrypted_size(self, size: int) -> int:
+        frames = max(1, -(-size // self._chunk_size))
+        return self.header_size + size + frames * TAG_SIZE
+
+    @property
+    def header_size(self) -> int:
+        return HEADER_SIZE
+
+    def ciphertext_range(self, offset, length, size):
+        frame_size = self._chunk_size + TAG_SIZE
+        first = offset // self._chunk_size
+        last = (min(offset + length, size) - 1) // self._chunk_size
+        start = self.header_size + first * frame_size
+        end = min(self.header_size + (last + 1) * frame_size, self.encrypted_size(size))
+        return start, end - start
+
+    def decrypt_range(self, header, data, offset, length, size):
+        key, chunk_size = self._parse_header(header[:self.header_size])
+        if chunk_size != self._chunk_size:
+            raise ValueError(f"Data is encrypted by {chunk_size} bytes chunks instead of {self._chunk_size}")
+
+        frames = _Frames(key, header[:self.header_size])
+        frame_size = chunk_size + TAG_SIZE
+        first = offset // chunk_size
+        last_frame = max(0, -(-size // chunk_size) - 1)
+
+        plaintext = bytearray()
+        for i in range(0, len(data), frame_size):
+            index = first + i // frame_size
+            plaintext += frames.decrypt(index, data[i:i + frame_size], index == last_frame)
+
+        start = offset - first * chunk_size
+        return bytes(plaintext[start:start + length])
\ No newline at end of file
@@ -1,9 +1,61 @@
 from abc import ABC, abstractmethod
+from enum import Enum
+from typing import Callable, Optional, Tuple, Union
 
 import entity
 
 
+class CipherType(Enum):
+    AES = 'aes'
+    AES_GCM = 'aes-gcm'
+    AES_CONVERGENT = 'aes-convergent'
+
+    def __str__(self):
+        return self.value
+
+    @staticmethod
+    def from_str(s: str) -> Union["CipherType", None]:
+        for _, v in CipherType.__members__.items():
+            if v.value == s:
+                return v
+        return None
+
+
+class CipherStream(ABC):
+    """
+    Incremental encryption or decryption
+    """
+
+    @abstractmethod
+    def update(self, data: bytes) -> bytes:
+        pass
+
+    @abstractmethod
+    def finalize(self) -> bytes:
+        pass
+
+
+class BufferedCipherStream(CipherStream):
+    """
+    Stream for ciphers which can process only the whole data
+    """
+
+    def __init__(self, func: Callable[[bytes], bytes]):
+        self._func = func
+        self._buffer = bytearray()
+
+    def update(self, data: bytes) -> bytes:
+        self._buffer += data
+        return b''
+
+    def finalize(self) -> bytes:
+        return self._func(bytes(self._buffer))
+
+
 class CipherBase(ABC):
+    type: CipherType = None
+    convergent: bool = False  # equal plaintext gives equal ciphertext, so encrypted data can be deduplicated
+
     @abstractmethod
     def encrypt(self, data: bytes) -> bytes:
         pass
@@ -15,3 +67,41 @@ class CipherBase(ABC):
     @abstractmethod
     def key(self) -> entity.Key:
         pass
+
+    @abstractmethod
+    def encrypted_size(self, size: int) -> int:
+        pass
+
+    def encryptor(self, content_hash: Optional[bytes] = None) -> CipherStream:
+        """
+        :param content_hash: sha256 of the whole plaintext, used by convergent ciphers only
+        """
+        return BufferedCipherStream(self.encrypt)
+
+    def decryptor(self) -> CipherStream:
+        return BufferedCipherStream(self.decrypt)
+
+    def ciphertext_range(self, offset: int, length: int, size: int) -> Optional[Tuple[int, int]]:
+        """
+        Get (offset, length) of encrypted data needed to decrypt length bytes from offset
+        of plaintext of given size
+
+        Return None if cipher can decrypt only the whole data
+        """
+        return None
+
+    def decrypt_range(self, header: bytes, data: bytes, offset: int, length: int, size: int) -> bytes:
+        """
+        Decrypt length bytes from offset of plaintext
+
+        Ciphers without ciphertext_range decrypt the whole data, which is data after header then
+
+        :param header: beginning of encrypted data (header_size bytes)
+        :param data: encrypted data located by ciphertext_range
+        :param size: size of the whole plaintext
+        """
+        return self.decrypt(header + data)[offset:offset + length]
+
+    @property
+    def header_size(self) -> int:
+        return 0
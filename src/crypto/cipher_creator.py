@@ -0,0 +1,17 @@
+from crypto.cipher_base import CipherBase, CipherType
+import entity
+
+
+class CipherCreator:
+    @staticmethod
+    def create(cipher_type: CipherType, key: entity.Key) -> CipherBase:
+        # pycryptodome is imported by the first cipher
+        if cipher_type == CipherType.AES:
+            from crypto.aes import Aes
+            return Aes(key)
+        if cipher_type == CipherType.AES_GCM:
+            from crypto.aes_gcm import AesGcm
+            return AesGcm(key)
+        if cipher_type == CipherType.AES_CONVERGENT:
+            from crypto.aes_convergent import AesConvergent
+            return AesConvergent(key)
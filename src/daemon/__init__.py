@@ -0,0 +1,20 @@
+import importlib
+
+# server imports network and vfs, clients need the socket only
+_exports = {
+    "Daemon": ".server",
+    "DaemonConfig": ".server",
+    "DaemonClient": ".client",
+    "Job": ".job",
+    "JobStatus": ".job",
+}
+
+
+def __getattr__(name: str):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_exports[name], __name__), name)
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_exports))
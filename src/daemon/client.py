@@ -0,0 +1,84 @@
+import asyncio
+import contextlib
+import itertools
+from typing import Callable, Dict, Optional, Tuple
+
+import exceptions
+from .protocol import MESSAGE_LIMIT, decode_error, read_message, write_message
+
+
+class DaemonClient:
+    """
+    Connection to daemon (see Daemon for protocol)
+
+    Requests can be sent by many tasks at once over one connection, so scripts issuing many operations
+    keep one client and don't wait for every job before submitting the next one
+    """
+
+    def __init__(self, socket_path: str):
+        self._socket_path = socket_path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._ids = itertools.count(1)
+        # request id -> (future of response, progress callback)
+        self._pending: Dict[int, Tuple[asyncio.Future, Optional[Callable[[int, int], None]]]] = {}
+
+    async def __aenter__(self) -> "DaemonClient":
+        """
+        Raise DaemonNotRunning if nobody listens on socket
+        """
+        try:
+            self._reader, self._writer = await asyncio.open_unix_connection(self._socket_path, limit=MESSAGE_LIMIT)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise exceptions.DaemonNotRunning(self._socket_path) from e
+        self._read_task = asyncio.create_task(self._read())
+        return self
+
+    async def __aexit__(self, *args):
+        self._writer.close()
+        self._read_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError, ConnectionError):
+            await self._read_task
+            await self._writer.wait_closed()
+
+    async def _read(self) -> None:
+        try:
+            while (message := await read_message(self._reader)) is not None:
+                future, progress = self._pending.get(message.get("id"), (None, None))
+                if not future:
+                    continue
+                if "progress" in message:
+                    if progress:
+                        progress(*message["progress"])
+                elif not future.done():
+                    future.set_result(message)
+        except ConnectionError:
+            pass
+        for future, _ in self._pending.values():
+            if not future.done():
+                future.set_exception(exceptions.DaemonNotRunning("Connection to daemon is closed"))
+
+    async def request(self, command: str, progress: Optional[Callable[[int, int], None]] = None,
+                      wait: bool = True, **args) -> dict:
+        """
+        Send request and return its result
+
+        Job of upload, download and delete is only queued if wait is False ({"job": id} is returned),
+        otherwise progress is called with done and total units of running job.
+        Raise exception of failed request (JobFailed if it isn't one of exceptions module)
+        """
+        if self._read_task.done():
+            raise exceptions.DaemonNotRunning("Connection to daemon is closed")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = (future, progress)
+        try:
+            await write_message(self._writer, {"id": request_id, "command": command, "args": args, "wait": wait})
+            message = await future
+        finally:
+            del self._pending[request_id]
+
+        if "error" in message:
+            raise decode_error(message["error"])
+        return message["result"]
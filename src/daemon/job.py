@@ -0,0 +1,47 @@
+import asyncio
+import dataclasses
+import time
+from enum import Enum
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+
+class JobStatus(Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __str__(self):
+        return self.value
+
+    @staticmethod
+    def from_str(s: str) -> Union["JobStatus", None]:
+        for _, v in JobStatus.__members__.items():
+            if v.value == s:
+                return v
+        return None
+
+
+@dataclasses.dataclass(kw_only=True)
+class Job:
+    id: int
+    command: str
+    args: Dict[str, Any]
+    status: JobStatus = JobStatus.QUEUED
+    created: float = dataclasses.field(default_factory=time.time)
+    result: Optional[dict] = None
+    error: Optional[Exception] = None
+    progress: Optional[Callable[[], Tuple[int, int]]] = None  # done and total units of work, set by running job
+    finished: asyncio.Event = dataclasses.field(default_factory=asyncio.Event, repr=False)
+
+    def to_dict(self) -> dict:
+        done, total = self.progress() if self.progress and self.status == JobStatus.RUNNING else (0, 0)
+        return {
+            "id": self.id,
+            "command": self.command,
+            "args": self.args,
+            "status": str(self.status),
+            "created": self.created,
+            "progress": [done, total],
+            "error": str(self.error) if self.error else None,
+        }
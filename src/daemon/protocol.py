@@ -0,0 +1,50 @@
+import dataclasses
+import json
+from asyncio import StreamReader, StreamWriter
+from typing import Optional, Union
+
+import entity
+import exceptions
+
+# messages are json lines, a line of listed files may be long
+MESSAGE_LIMIT = 64 * 2 ** 20
+
+
+async def read_message(reader: StreamReader) -> Optional[dict]:
+    """
+    Read one message, None if connection is closed
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+async def write_message(writer: StreamWriter, message: dict) -> None:
+    writer.write(json.dumps(message).encode() + b"\n")
+    await writer.drain()
+
+
+def encode_entry(entry: Union[entity.Directory, entity.File]) -> dict:
+    return {"type": "directory" if isinstance(entry, entity.Directory) else "file", **dataclasses.asdict(entry)}
+
+
+def decode_entry(data: dict) -> Union[entity.Directory, entity.File]:
+    data = dict(data)
+    if data.pop("type") == "directory":
+        return entity.Directory(**data)
+    return entity.File(**data)
+
+
+def encode_error(error: Exception) -> dict:
+    return {"type": type(error).__name__, "message": str(error)}
+
+
+def decode_error(data: dict) -> exceptions.ErrorBase:
+    """
+    Exception of the same type as raised in daemon if it is one of exceptions module, JobFailed otherwise
+    """
+    error_type = getattr(exceptions, data["type"], None)
+    if isinstance(error_type, type) and issubclass(error_type, exceptions.ErrorBase):
+        return error_type(data["message"]) if data["message"] else error_type()
+    return exceptions.JobFailed(f"{data['type']}: {data['message']}")
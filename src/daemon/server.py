@@ -0,0 +1,343 @@
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import os
+import uuid
+from asyncio import StreamReader, StreamWriter
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set
+
+from loguru import logger
+
+import entity
+import exceptions
+import repository
+import utils
+from crypto import CipherType
+from network.balancer import Balancer
+from network.downloader import Downloader
+from network.placement import create_policy
+from network.scheduler import TransferScheduler
+from network.uploader import Uploader
+from vfs.versions import UPLOAD_DIRECTORY, Versions
+from vfs.vfs import VFS
+from .job import Job, JobStatus
+from .protocol import MESSAGE_LIMIT, encode_entry, encode_error, read_message, write_message
+
+
+@dataclasses.dataclass(kw_only=True)
+class DaemonConfig:
+    socket_path: str = "db.sqlite.sock"
+    job_num: int = 4  # transfer jobs running at once, others wait in queue
+    block_parallel_num: int = 10  # block transfers at once by all jobs
+    thread_num: int = 8  # threads hashing blocks of updated files
+    progress_period: float = 0.5  # seconds between progress messages to waiting clients
+    history_size: int = 1000  # finished jobs shown by 'jobs' request
+
+
+class Daemon:
+    """
+    Long-running owner of catalog, HTTP session and transfer scheduler serving clients over unix socket
+
+    Request is a json line {"id": any, "command": str, "args": dict, "wait": bool}. Upload, download
+    and delete are jobs run by job_num workers in order of requests, other commands are answered at once.
+    Client waiting for job gets {"id", "progress": [done, total]} lines and then {"id", "result": dict}
+    or {"id", "error": {"type", "message"}}, without wait only the id of queued job is returned.
+    Paths of local files in requests are absolute, as daemon may run in another directory
+    """
+
+    def __init__(self, block_repo: "repository.MetadataStore", config: Optional[DaemonConfig] = None):
+        self._block_repo = block_repo
+        self._config = config or DaemonConfig()
+        self._scheduler = TransferScheduler(self._config.block_parallel_num)
+        self._versions = Versions(block_repo, self._scheduler)
+
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: Set[StreamWriter] = set()
+        self._workers = []
+        self._queue: asyncio.Queue[Job] = asyncio.Queue()
+        self._jobs: Dict[int, Job] = {}  # queued, running and the last finished jobs by id
+        self._finished: Deque[int] = collections.deque()
+        self._next_id = 1
+        self._stopped = asyncio.Event()
+
+        self._handlers: Dict[str, Callable[[dict], Awaitable[dict]]] = {
+            "ping": self._ping,
+            "list": self._list,
+            "jobs": self._list_jobs,
+            "stop": self._stop,
+        }
+        self._job_handlers: Dict[str, Callable[[Job], Awaitable[dict]]] = {
+            "upload": self._upload,
+            "download": self._download,
+            "delete": self._delete,
+        }
+
+    async def _check_socket(self) -> None:
+        """
+        Remove socket left by daemon which didn't stop, raise DaemonAlreadyRunning if socket is served
+        """
+        path = self._config.socket_path
+        if not os.path.exists(path):
+            return
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            logger.warning(f"Remove stale socket {path}")
+            os.unlink(path)
+            return
+        writer.close()
+        raise exceptions.DaemonAlreadyRunning(path)
+
+    async def __aenter__(self) -> "Daemon":
+        await self._check_socket()
+        await self._scheduler.__aenter__()
+        self._server = await asyncio.start_unix_server(self._handle_connection, self._config.socket_path,
+                                                       limit=MESSAGE_LIMIT)
+        # clients read and write files as the owner of daemon
+        os.chmod(self._config.socket_path, 0o600)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._config.job_num)]
+        logger.info(f"Daemon listens on {self._config.socket_path}")
+        return self
+
+    async def __aexit__(self, *args):
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        await self._scheduler.__aexit__(*args)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self._config.socket_path)
+        logger.info("Daemon stopped")
+
+    async def serve(self) -> None:
+        """
+        Serve clients until stop request
+        """
+        await self._stopped.wait()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    # CONNECTIONS
+
+    async def _handle_connection(self, reader: StreamReader, writer: StreamWriter) -> None:
+        """
+        Requests of one connection are handled at once, responses are matched by id
+        """
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def send(message: dict) -> None:
+            async with lock:
+                await write_message(writer, message)
+
+        self._writers.add(writer)
+        try:
+            while (request := await read_message(reader)) is not None:
+                task = asyncio.create_task(self._handle_request(request, send))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            # client may close its side after the last request and read responses
+            await asyncio.gather(*tasks, return_exceptions=True)
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Drop connection: {e!r}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _handle_request(self, request: dict, send: Callable[[dict], Awaitable[None]]) -> None:
+        request_id = request.get("id")
+        command = request.get("command")
+        try:
+            args = request.get("args") or {}
+            if command in self._job_handlers:
+                job = self._submit(command, args)
+                result = await self._wait(job, request_id, send) if request.get("wait", True) else {"job": job.id}
+            elif command in self._handlers:
+                result = await self._handlers[command](args)
+            else:
+                raise exceptions.JobFailed(f"Unknown command {command!r}")
+            message = {"id": request_id, "result": result}
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            logger.info(f"Request {command} failed: {e!r}")
+            message = {"id": request_id, "error": encode_error(e)}
+        await send(message)
+
+    # JOBS
+
+    def _submit(self, command: str, args: dict) -> Job:
+        job = Job(id=self._next_id, command=command, args=args)
+        self._next_id += 1
+        self._jobs[job.id] = job
+        self._queue.put_nowait(job)
+        return job
+
+    async def _wait(self, job: Job, request_id, send: Callable[[dict], Awaitable[None]]) -> dict:
+        """
+        Wait for job sending its progress, raise exception of failed job
+        """
+        sent = None
+        while not job.finished.is_set():
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(job.finished.wait(), self._config.progress_period)
+            if job.progress and job.status == JobStatus.RUNNING and job.progress() != sent:
+                sent = job.progress()
+                await send({"id": request_id, "progress": list(sent)})
+        if job.progress and job.status == JobStatus.DONE:
+            await send({"id": request_id, "progress": list(job.progress())})
+        if job.error:
+            raise job.error
+        return job.result
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            job.status = JobStatus.RUNNING
+            logger.info(f"Start job {job.id} {job.command} {job.args}")
+            try:
+                job.result = await self._job_handlers[job.command](job)
+                job.status = JobStatus.DONE
+            except Exception as e:
+                logger.exception(e)
+                job.error = e
+                job.status = JobStatus.FAILED
+            finally:
+                job.finished.set()
+                self._finished.append(job.id)
+                while len(self._finished) > self._config.history_size:
+                    self._jobs.pop(self._finished.popleft(), None)
+
+    async def _upload(self, job: Job) -> dict:
+        """
+        Upload file like 'upload' command does, replacing existing file if keep_version or update is set
+        """
+        args = job.args
+        src, dst = args["src"], args["dst"]
+        block_size = args.get("block_size", 20 * 2 ** 20)
+        if not os.path.isfile(src):
+            raise FileNotFoundError(f"Cannot open file {src}")
+        need_encrypt = args.get("need_encrypt", False)
+        ciphers = None
+        if need_encrypt:
+            ciphers = await self._block_repo.get_ciphers(CipherType.from_str(args.get("cipher", "aes-gcm")))
+            if not ciphers:
+                raise exceptions.NoCipher()
+
+        base = None
+        if args.get("keep_version") or args.get("update"):
+            try:
+                base = await self._block_repo.get_file_by_filename(dst)
+            except exceptions.UnknownFile:
+                pass
+            if base and base.uploaded_blocks != base.total_blocks:
+                base = None
+        if args.get("update") and not base:
+            raise exceptions.UnknownFile(dst)
+
+        balancer = Balancer(await self._block_repo.get_storages(),
+                            ciphers=ciphers,
+                            block_size=block_size,
+                            policy=create_policy(args.get("placement", "space")))
+        await balancer.update_capacity(self._scheduler.session)
+
+        # new version is uploaded under temporary name and then replaces the file
+        file = entity.File(filename=UPLOAD_DIRECTORY + uuid.uuid4().hex if base else dst,
+                           path=src,
+                           need_encrypt=need_encrypt)
+        hashes, changed = None, None
+        if args.get("update"):
+            # blocks are compared by number, so file is split like the stored one
+            blocks = await self._block_repo.get_blocks_by_file(base)
+            if base.total_blocks > 1:
+                block_size = blocks[0].size
+            hashes = await asyncio.to_thread(utils.block_hashes, src, block_size, self._config.thread_num)
+            stored = {block.number: block.content_hash for block in blocks}
+            changed = sum(content_hash != stored.get(number) for number, content_hash in enumerate(hashes))
+            if not changed and len(hashes) == base.total_blocks:
+                return {"filename": dst, "blocks": len(hashes), "changed": 0, "reused": 0, "uploaded": False}
+            await self._versions.purge_trash()
+        balancer.fill_file(file, block_size)
+
+        async with Uploader(balancer, self._block_repo, scheduler=self._scheduler) as uploader:
+            job.progress = lambda: (sum(progress.done for progress in uploader.progress),
+                                    sum(progress.total for progress in uploader.progress))
+            try:
+                if await uploader.upload_file(file, base, hashes):
+                    raise exceptions.UploadFailed()
+            except Exception:
+                if base and file.id:
+                    await self._versions.delete_files([file])
+                raise
+        if base:
+            # replaced blocks are deleted unless they are kept as version
+            await self._versions.replace(file, dst, keep_version=args.get("keep_version", False))
+        return {"filename": dst, "blocks": file.total_blocks, "changed": changed, "reused": uploader.reused,
+                "uploaded": True}
+
+    async def _download(self, job: Job) -> dict:
+        file = await self._block_repo.get_file_by_filename(job.args["src"])
+        file.path = job.args["dst"]
+        async with Downloader(self._block_repo, scheduler=self._scheduler) as downloader:
+            job.progress = lambda: (sum(progress.done for progress in downloader.progress),
+                                    sum(progress.total for progress in downloader.progress))
+            await downloader.download_file(file)
+        return {"filename": file.filename, "path": file.path, "size": file.size}
+
+    async def _delete(self, job: Job) -> dict:
+        """
+        Delete files, nothing is deleted if one of them is unknown
+        """
+        filenames = job.args["filenames"]
+        files = [await self._block_repo.get_file_by_filename(filename) for filename in filenames]
+        deleted = []
+        job.progress = lambda: (len(deleted), len(files))
+        for file in files:
+            deleted.extend(file.filename for file in await self._versions.delete_files([file]))
+        return {"deleted": deleted, "failed": [filename for filename in filenames if filename not in deleted]}
+
+    # REQUESTS ANSWERED AT ONCE
+
+    async def _ping(self, args: dict) -> dict:
+        return {"pid": os.getpid(), "queued": self._queue.qsize(),
+                "running": sum(job.status == JobStatus.RUNNING for job in self._jobs.values())}
+
+    async def _list(self, args: dict) -> dict:
+        """
+        Entries of directory like 'list' command shows them, tree is cut after limit + 1 entries
+        """
+        path, after, limit = args.get("path", ""), args.get("after", ""), args.get("limit", 100)
+        vfs = VFS(self._block_repo, page_size=limit)
+        directory, entries, next_ = None, [], None
+        if args.get("prefix"):
+            page = await vfs.find(path, after)
+            entries, next_ = [(0, entry) for entry in page.entries], page.next
+        elif depth := args.get("depth"):
+            await vfs.get_directory(path)
+            async for level, entry in vfs.tree(path, None if depth < 0 else depth - 1):
+                entries.append((level, entry))
+                if len(entries) > limit:
+                    break
+        else:
+            directory = await vfs.get_directory(path)
+            page = await vfs.list(path, after)
+            entries, next_ = [(0, entry) for entry in page.entries], page.next
+        return {"directory": encode_entry(directory) if directory else None,
+                "entries": [[level, encode_entry(entry)] for level, entry in entries],
+                "next": next_}
+
+    async def _list_jobs(self, args: dict) -> dict:
+        return {"jobs": [job.to_dict() for job in self._jobs.values()]}
+
+    async def _stop(self, args: dict) -> dict:
+        """
+        Stop daemon, running jobs are interrupted
+        """
+        self.stop()
+        return {}
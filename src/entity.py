@@ -1,6 +1,11 @@
 import os
 from copy import copy
 from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import network.storage_base
+    import crypto
 
 
 @dataclass(kw_only=True)
@@ -20,28 +25,38 @@ class File:
     need_encrypt: bool = False
 
 
+@dataclass(kw_only=True)
+class Directory:
+    path: str = ""  # ends with '/', root is empty
+    size: int = 0  # of files in directory and its subdirectories
+    file_count: int = 0  # number of files in directory and its subdirectories
+
+    @property
+    def name(self) -> str:
+        return self.path[:-1].rsplit("/", 1)[-1] + "/" if self.path else ""
+
+
 @dataclass(kw_only=True)
 class Key:
     id: int = 0
     key: str = ""
 
 
-import network.storage_base
-import crypto
-
-
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class Block:
     id: int = 0
     name: str = ""
+    path: str = ""  # location in storage if it isn't name (e.g. file in directory)
     number: int = 0
     size: int = 0
+    checksum: str = ""  # md5 of data stored in storage
+    content_hash: str = ""  # sha256 of plain data
 
     duplicate_number: int = 0
 
     file: File = None
-    storage: network.storage_base.StorageBase = None
-    cipher: crypto.CipherBase = None
+    storage: "network.storage_base.StorageBase" = None
+    cipher: "crypto.CipherBase" = None
 
     data: bytes = field(default=None, repr=False)
 
@@ -6,35 +6,52 @@ class DownloaderErrorBase(ErrorBase):
     pass
 
 
-class ChecksumNoEqual(DownloaderError):
+class ChecksumNoEqual(DownloaderErrorBase):
     pass
 
 
-class BlockDownloadFailed(DownloaderError):
+class BlockDownloadFailed(DownloaderErrorBase):
     pass
 
 
 
-class NoStorage(Error):
+class NoStorage(ErrorBase):
     pass
 
-class FileAlreadyExists(Error):
+class NotEnoughSpace(ErrorBase):
     pass
 
-class CancelAction(Error):
+class FileAlreadyExists(ErrorBase):
     pass
 
-class UnknownFile(Error):
+class CancelAction(ErrorBase):
     pass
 
-class KeyAlreadyExists(Error):
+class UnknownFile(ErrorBase):
     pass
 
-class UnknownStorage(Error):
+class UnknownDirectory(ErrorBase):
     pass
 
-class NoCipher(Error):
+class KeyAlreadyExists(ErrorBase):
     pass
 
-class UploadFailed(Error):
-    pass
\ No newline at end of file
+class UnknownStorage(ErrorBase):
+    pass
+
+class NoCipher(ErrorBase):
+    pass
+
+class UploadFailed(ErrorBase):
+    pass
+class BrokenSnapshot(ErrorBase):
+    pass
+
+class DaemonNotRunning(ErrorBase):
+    pass
+
+class DaemonAlreadyRunning(ErrorBase):
+    pass
+
+class JobFailed(ErrorBase):
+    pass
@@ -1,3 +1,21 @@
-from .downloader import Downloader
-from .uploader import Uploader
-from .balancer import Balancer
+import importlib
+
+# submodules import http client, so they are imported on first access
+_exports = {
+    "Downloader": ".downloader",
+    "Uploader": ".uploader",
+    "Balancer": ".balancer",
+    "Deleter": ".deleter",
+    "DeleterConfig": ".deleter",
+    "TransferScheduler": ".scheduler",
+}
+
+
+def __getattr__(name: str):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_exports[name], __name__), name)
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_exports))
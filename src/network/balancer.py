@@ -1,49 +1,144 @@
-import heapq
+import asyncio
 import math
 import os
 import random
+import time
 import uuid
-from typing import Tuple, Iterable, Collection, Optional
+from typing import Tuple, Iterable, Collection, Optional, Dict, List
+
+import aiohttp
+from loguru import logger
 
 import entity
 import exceptions
 from crypto import CipherBase
+from .placement import PlacementPolicy, FreeSpacePolicy
 from .storage_base import StorageBase
 
 
 class Balancer:
     """
     Balancer assign storage to block
-    Using heap sorted by used space in storage
+    Storages are chosen by placement policy (the least used storages by default)
+
+    Capacity of storages is fetched by update_capacity and cached for capacity_ttl seconds.
+    Every assigned block is charged to projected usage of its storage,
+    storage which would overflow is never chosen
     """
 
+    capacity_ttl: float = 60
+    # storage id -> (time of request, used space, total space). Shared by all balancers
+    _capacity_cache: Dict[int, Tuple[float, int, int]] = {}
+
     def __init__(self,
                  storages: Iterable[StorageBase],
                  ciphers: Optional[Iterable[CipherBase]] = None,
-                 block_size: int = 5 * 2 ** 20):
+                 block_size: int = 5 * 2 ** 20,
+                 policy: Optional[PlacementPolicy] = None):
         if not storages:
             raise exceptions.NoStorage()
 
         self._block_size = block_size
-        self._storage_queue = list(storages)
+        self._storages_list = list(storages)
         self._ciphers = list(ciphers) if ciphers else None
+        self._policy = policy or FreeSpacePolicy()
+
+        self._projected: Dict[int, int] = {}  # storage id -> used space including assigned blocks
+        self._available: List[StorageBase] = []  # storages with known capacity
+
+    @classmethod
+    async def fetch_capacity(cls, storages: Iterable[StorageBase], session: aiohttp.ClientSession,
+                             force: bool = False) -> None:
+        """
+        Fill used_space and total_space of storages by simultaneous requests
+
+        Cached values younger than capacity_ttl are used unless force
+        """
+        now = time.monotonic()
+        storages = list(storages)
+        expired = [storage for storage in storages
+                   if force
+                   or storage.id not in cls._capacity_cache
+                   or now - cls._capacity_cache[storage.id][0] > cls.capacity_ttl]
 
-        heapq.heapify(self._storage_queue)
+        sizes = await asyncio.gather(*(storage.size(session) for storage in expired), return_exceptions=True)
+        for storage, size in zip(expired, sizes):
+            if isinstance(size, Exception):
+                logger.exception(size)
+                size = (0, 0)
+            cls._capacity_cache[storage.id] = (now, *size)
 
-    def _cipher(self) -> CipherBase:
-        if not self._cipher:
+        for storage in storages:
+            _, storage.used_space, storage.total_space = cls._capacity_cache[storage.id]
+
+    async def update_capacity(self, session: aiohttp.ClientSession, force: bool = False) -> None:
+        """
+        Fetch capacity of storages and reset projected usage
+        """
+        await self.fetch_capacity(self._storages_list, session, force)
+
+        self._projected = {}
+        self._available = []
+        for storage in self._storages_list:
+            if not storage.total_space:
+                logger.warning(f"Unknown capacity of storage {storage}. It won't be used")
+                continue
+            self._projected[storage.id] = storage.used_space
+            self._available.append(storage)
+
+        if not self._available:
+            raise exceptions.NoStorage()
+        self._policy.set_storages(self._available)
+
+    def _cipher(self, block: entity.Block) -> CipherBase:
+        if not self._ciphers:
             raise exceptions.NoCipher()
 
+        if block.content_hash and all(cipher.convergent for cipher in self._ciphers):
+            # the same content always gets the same key, so its encrypted data can be shared
+            return self._ciphers[int(block.content_hash, 16) % len(self._ciphers)]
         return random.choice(self._ciphers)
 
-    def _storages(self, count: int) -> Tuple[StorageBase]:
-        disks = [heapq.heappop(self._storage_queue) for _ in range(count)]
+    def _charge(self, storage: StorageBase, size: int) -> None:
+        self._projected[storage.id] += size
 
+    def _storages(self, block: entity.Block, count: int, size: int,
+                  exclude: Collection[int] = ()) -> Tuple[StorageBase]:
+        """
+        Choose count different storages having size bytes free by placement policy
+        and charge size to them. Storages with ids from exclude aren't chosen
+
+        Raise NotEnoughSpace if there are less than count such storages
+        """
+        candidates = [storage for storage in self._available
+                      if storage.id not in exclude and self._projected[storage.id] + size <= storage.total_space]
+        if len(candidates) < count:
+            raise exceptions.NotEnoughSpace()
+
+        usage = {storage.id: self._projected[storage.id] / storage.total_space for storage in candidates}
+        disks = self._policy.choose(block, candidates, usage, count)
         for disk in disks:
-            heapq.heappush(self._storage_queue, disk)
+            self._charge(disk, size)
 
         return tuple(disks)
 
+    def choose_storage(self, block: entity.Block, size: int, exclude: Collection[int] = ()) -> StorageBase:
+        """
+        Choose storage for a new duplicate of block that is not kept by storages with ids from exclude
+        """
+        return self._storages(block, 1, size, exclude)[0]
+
+    def record_upload(self, storage: StorageBase, size: int, seconds: float, ok: bool) -> None:
+        """
+        Report result of upload to placement policy
+        """
+        self._policy.record_upload(storage, size, seconds, ok)
+
+    @property
+    def free_space(self) -> int:
+        return sum(storage.total_space - self._projected[storage.id]
+                   for storage in self._available)
+
     @staticmethod
     def _total_blocks(file: entity.File) -> int:
         """
@@ -52,23 +147,38 @@ class Balancer:
         size = os.path.getsize(file.path)
         return math.ceil(size / file.block_size)
 
-    def fill_file(self, file: entity.File) -> None:
+    def fill_file(self, file: entity.File, block_size: Optional[int] = None) -> None:
         """
         Calculate block_size, total_blocks and size by getting file size
+
+        block_size replaces the default one (e.g. to split file like its stored version).
+        Raise NotEnoughSpace if file with all duplicates doesn't fit into storages
         """
-        file.block_size = self._block_size
+        file.block_size = block_size or self._block_size
         file.size = os.path.getsize(file.path)
         file.total_blocks = self._total_blocks(file)
 
-    def fill_blocks(self, blocks: Collection[entity.Block]) -> None:
+        if self._available and file.size * file.duplicate_count > self.free_space:
+            raise exceptions.NotEnoughSpace()
+
+    def fill_ciphers(self, blocks: Collection[entity.Block]) -> None:
+        """
+        Add cipher to every block without one if block.file.need_encrypt
+        """
+        for block in blocks:
+            if block.file.need_encrypt and not block.cipher:
+                block.cipher = self._cipher(block)
+
+    def fill_blocks(self, blocks: Collection[entity.Block], exclude: Collection[int] = ()) -> None:
         """
         Assign unique storage and name to every block. Also add cipher if block.file.need_encrypt
 
         It suppose every block in list belongs to the same file
-        Because duplicates of block have to store in different storages
+        Because duplicates of block have to store in different storages.
+        Storages with ids from exclude (e.g. keeping other duplicates) aren't used
         """
-        for block, storage in zip(blocks, self._storages(len(blocks))):
+        size = max(block.size for block in blocks)
+        for block, storage in zip(blocks, self._storages(next(iter(blocks)), len(blocks), size, exclude)):
             block.storage = storage
             block.name = str(uuid.uuid4())
-            if block.file.need_encrypt:
-                block.cipher = self._cipher()
+        self.fill_ciphers(blocks)
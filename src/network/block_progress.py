@@ -1,6 +1,6 @@
 import dataclasses
 
-@dataclasses.dataclass(init=True, kw_only=True)
+@dataclasses.dataclass(init=True, kw_only=True, slots=True)
 class BlockProgress:
     done: int
     total: int
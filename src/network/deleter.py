@@ -0,0 +1,173 @@
+import asyncio
+import dataclasses
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import aiohttp
+from loguru import logger
+
+import entity
+import repository
+from .scheduler import TransferScheduler
+from .storage_base import DeleteStatus
+
+
+@dataclasses.dataclass(kw_only=True)
+class DeleterConfig:
+    parallel_num: int = 5  # simultaneous requests per storage
+    operation_num: int = 100  # unfinished deletions per storage (including polled operations)
+    repeat_count: int = 3  # number of delete attempts
+    retry_delay: float = 1  # delay before second attempt, doubles every attempt
+    poll_period: float = 1  # seconds between polls of async operation
+    poll_timeout: float = 10 * 60  # seconds to wait for async operation
+    batch_size: int = 500  # count of deleted blocks removed from repository by one commit
+
+
+class Deleter:
+    """
+    Delete blocks from storages and repository
+
+    Requests to every storage are limited by parallel_num,
+    asynchronous operations are polled until storage finishes them.
+    Data shared with blocks which aren't deleted (deduplicated blocks) is kept in storage
+    """
+
+    def __init__(self,
+                 block_repo: "repository.MetadataStore",
+                 config: Optional[DeleterConfig] = None,
+                 scheduler: Optional[TransferScheduler] = None):
+        config = config or DeleterConfig()
+        self._block_repo = block_repo
+        self._scheduler = scheduler  # only its session is shared, requests are limited per storage
+        self._session = None
+        self._config = config
+
+        self._requests: Dict[int, asyncio.Semaphore] = {}
+        self._operations: Dict[int, asyncio.Semaphore] = {}
+
+        self._deleted: List[entity.Block] = []
+        self._failed: List[Tuple[DeleteStatus, entity.Block]] = []
+        self._deleted_count = 0
+        self._deleting: Set[int] = set()  # ids of blocks passed to delete_blocks
+        self._repo_lock = asyncio.Lock()
+
+    async def __aenter__(self) -> "Deleter":
+        self._session = self._scheduler.session if self._scheduler else aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, *args):
+        if not self._scheduler:
+            await self._session.close()
+
+    def _limits(self, block: entity.Block) -> Tuple[asyncio.Semaphore, asyncio.Semaphore]:
+        storage_id = block.storage.id
+        if storage_id not in self._requests:
+            self._requests[storage_id] = asyncio.Semaphore(self._config.parallel_num)
+            self._operations[storage_id] = asyncio.Semaphore(self._config.operation_num)
+        return self._requests[storage_id], self._operations[storage_id]
+
+    async def _wait_operation(self, block: entity.Block, operation: str) -> DeleteStatus:
+        requests, _ = self._limits(block)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._config.poll_timeout
+
+        while loop.time() < deadline:
+            await asyncio.sleep(self._config.poll_period)
+            async with requests:
+                status = await block.storage.operation_status(operation, self._session)
+            if status != DeleteStatus.IN_PROGRESS:
+                return status
+
+        logger.error(f"Operation {operation} for block {block.name} timed out")
+        return DeleteStatus.FAILED
+
+    async def _delete_block(self, block: entity.Block) -> DeleteStatus:
+        requests, _ = self._limits(block)
+        status = DeleteStatus.FAILED
+
+        for attempt in range(self._config.repeat_count):
+            async with requests:
+                status, operation = await block.storage.delete_async(block.path or block.name, self._session)
+            if status == DeleteStatus.IN_PROGRESS:
+                status = await self._wait_operation(block, operation)
+
+            if status in (DeleteStatus.OK, DeleteStatus.FILE_DOESNT_EXIST):
+                logger.info(f"Delete block: {block}")
+                return status
+
+            logger.warning(f"Failed to delete block: {block}: {status}")
+            if attempt + 1 < self._config.repeat_count:
+                await asyncio.sleep(self._config.retry_delay * 2 ** attempt)
+
+        return status
+
+    async def _is_shared(self, block: entity.Block) -> bool:
+        """
+        Check if data of block is used by blocks which aren't being deleted
+        """
+        if not block.id:
+            return False
+        return bool(set(await self._block_repo.get_block_ids_by_data(block)) - self._deleting)
+
+    async def _flush(self) -> None:
+        """
+        Remove deleted blocks from repository
+        """
+        async with self._repo_lock:
+            blocks, self._deleted = self._deleted, []
+            if blocks:
+                await self._block_repo.del_blocks(blocks)
+                await self._block_repo.commit()
+
+    async def _process_block(self, block: entity.Block) -> None:
+        _, operations = self._limits(block)
+        try:
+            if await self._is_shared(block):
+                logger.info(f"Keep data of block {block} used by other blocks")
+                status = DeleteStatus.OK
+            else:
+                status = await self._delete_block(block)
+        finally:
+            operations.release()
+
+        if status in (DeleteStatus.OK, DeleteStatus.FILE_DOESNT_EXIST):
+            self._deleted.append(block)
+            self._deleted_count += 1
+            if len(self._deleted) >= self._config.batch_size:
+                await self._flush()
+        else:
+            logger.error(f"Cannot delete block {block}")
+            self._deleting.discard(block.id)
+            self._failed.append((status, block))
+
+    async def delete_blocks(self, blocks: Iterable[entity.Block]) -> List[Tuple[DeleteStatus, entity.Block]]:
+        """
+        Delete blocks from their storages and repository
+
+        Blocks are consumed lazily so only operation_num blocks per storage are kept in memory
+        Return list of blocks not deleted from storage with its delete status
+        """
+        self._failed = []
+        tasks = set()
+
+        for block in blocks:
+            _, operations = self._limits(block)
+            await operations.acquire()
+            if block.id:
+                self._deleting.add(block.id)
+            task = asyncio.create_task(self._process_block(block))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+        await self._flush()
+
+        return self._failed
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self._session
+
+    @property
+    def deleted_count(self) -> int:
+        return self._deleted_count
@@ -1,4 +1,6 @@
 import asyncio
+import contextlib
+import dataclasses
 import math
 import os
 from typing import List, Tuple, Iterable, Sequence, Optional
@@ -10,30 +12,41 @@ import entity
 import repository
 import utils
 from network.block_progress import BlockProgress
+from network.scheduler import TransferScheduler
 from .storage_base import DownloadStatus
 from exceptions import *
 
 
+@dataclasses.dataclass(kw_only=True)
 class DownloaderConfig:
-    chunc_size: int = 64 * 2 ** 10
+    chunk_size: int = 64 * 2 ** 10
     parallel_num: int = 1
+    range_size: int = 4 * 2 ** 20  # block bigger than range_size is downloaded by ranges (0 - disable)
+    range_parallel_num: int = 4  # simultaneous range requests for one block
+
 
 class Downloader:
     def __init__(self,
-                 block_repo: repository.BlockRepo,
-                 config: DownloaderConfig):
-        self._block_repo = block_repo 
+                 block_repo: "repository.MetadataStore",
+                 config: Optional[DownloaderConfig] = None,
+                 scheduler: Optional[TransferScheduler] = None):
+        config = config or DownloaderConfig()
+        self._block_repo = block_repo
+        self._scheduler = scheduler  # shared with other transfers
         self._session = None
         self._progress: List[BlockProgress] = []
         self._chunk_size = config.chunk_size
         self._parallel_num = config.parallel_num
+        self._range_size = config.range_size
+        self._range_parallel_num = config.range_parallel_num
 
     async def __aenter__(self):
-        self._session = aiohttp.ClientSession()
+        self._session = self._scheduler.session if self._scheduler else aiohttp.ClientSession()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._session.close()
+        if not self._scheduler:
+            await self._session.close()
 
     async def _download_block(self, block: entity.Block) -> Tuple[DownloadStatus, entity.Block]:
         status, data = await block.storage.download(block.name, self._session)
@@ -49,14 +62,154 @@ class Downloader:
 
         return status, block
 
-    async def _download_block_by_chunks(self, block: entity.Block) -> DownloadStatus:
-        def inc_progress():
-            self._progress[block.number].done += 1
+    async def _download_header(self, block: entity.Block) -> Tuple[DownloadStatus, bytes]:
+        size = block.cipher.header_size
+        status, header = await block.storage.download_range(block.name, 0, size, self._session)
+        if status == DownloadStatus.OK and len(header) != size:
+            status = DownloadStatus.FAILED
+        return status, header
+
+    async def read_range(self, block: entity.Block, offset: int, length: int,
+                         header: Optional[bytes] = None) -> Tuple[DownloadStatus, bytes]:
+        """
+        Download and decrypt length bytes of block data starting from offset
+
+        Only frames containing the range are downloaded if cipher supports it.
+        header is beginning of encrypted block, it is downloaded if not given
+        """
+        length = max(0, min(length, block.size - offset))
+
+        if not block.cipher:
+            status, data = await block.storage.download_range(block.name, offset, length, self._session)
+            if status == DownloadStatus.OK and len(data) != length:
+                logger.error(f"Got {len(data)} bytes instead of {length} from block {block.name}")
+                status = DownloadStatus.FAILED
+            return status, data
+
+        cipher_range = block.cipher.ciphertext_range(offset, length, block.size)
+        try:
+            if cipher_range is None:
+                status, data = await block.storage.download(block.name, self._session)
+                if status != DownloadStatus.OK:
+                    return status, bytes()
+                return status, block.cipher.decrypt(data)[offset:offset + length]
+
+            start, size = cipher_range
+            header_size = block.cipher.header_size
+            if header is None and start == header_size:
+                # header and frames are adjacent, so download them together
+                status, data = await block.storage.download_range(block.name, 0, start + size, self._session)
+                header, data = data[:header_size], data[header_size:]
+            else:
+                if header is None:
+                    status, header = await self._download_header(block)
+                    if status != DownloadStatus.OK:
+                        return status, bytes()
+                status, data = await block.storage.download_range(block.name, start, size, self._session)
+            if status != DownloadStatus.OK:
+                return status, bytes()
+
+            return DownloadStatus.OK, block.cipher.decrypt_range(header, data, offset, length, block.size)
+        except ValueError as e:
+            # data is corrupted or tampered
+            logger.exception(e)
+            return DownloadStatus.FAILED, bytes()
 
-        status, data = await block.storage.download_by_chunks(block.name, self._chunk_size, inc_progress, self._session)
+    async def download_first(self, blocks: Sequence[entity.Block], race_num: int = 2) -> Tuple[DownloadStatus, bytes]:
+        """
+        Download data of the same block from race_num replicas at once and return the first one downloaded
 
+        The other downloads are cancelled, the next replica is started instead of a failed one
+        """
+        replicas = iter(blocks)
+        pending = set()
+        status = DownloadStatus.FAILED
+
+        def start_next():
+            block = next(replicas, None)
+            if block:
+                pending.add(asyncio.create_task(self.read_range(block, 0, block.size)))
+
+        for _ in range(max(1, race_num)):
+            start_next()
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        status, data = task.result()
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        logger.exception(e)
+                        status = DownloadStatus.FAILED
+                    if status == DownloadStatus.OK:
+                        return status, data
+                    start_next()
+            return status, bytes()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _download_block_by_ranges(self, block: entity.Block) -> Tuple[DownloadStatus, bytes]:
+        """
+        Download block by range_parallel_num simultaneous range requests
+        """
+        semaphore = asyncio.Semaphore(self._range_parallel_num)
+        progress = self._progress[block.number]
+
+        header = None
         if block.cipher:
-            data = block.cipher.decrypt(data)
+            status, header = await self._download_header(block)
+            if status != DownloadStatus.OK:
+                return status, bytes()
+
+        async def download_range(offset: int) -> Tuple[DownloadStatus, bytes]:
+            async with semaphore:
+                length = min(self._range_size, block.size - offset)
+                status, data = await self.read_range(block, offset, length, header)
+                progress.done = min(progress.total, progress.done + math.ceil(length / self._chunk_size))
+                return status, data
+
+        results = await asyncio.gather(*(download_range(offset)
+                                         for offset in range(0, block.size, self._range_size)))
+        for status, _ in results:
+            if status != DownloadStatus.OK:
+                return status, bytes()
+        return DownloadStatus.OK, b''.join(data for _, data in results)
+
+    async def _download_block_by_stream(self, block: entity.Block) -> Tuple[DownloadStatus, bytes]:
+        """
+        Download block by chunks decrypting them on the fly
+        """
+        decryptor = block.cipher.decryptor() if block.cipher else None
+        progress = self._progress[block.number]
+        progress.done = 0
+        data = bytearray()
+        try:
+            async for chunk in block.storage.download_stream(block.name, self._chunk_size, self._session):
+                data += decryptor.update(chunk) if decryptor else chunk
+                progress.done = min(progress.total, progress.done + 1)
+            if decryptor:
+                data += decryptor.finalize()
+        except BlockDownloadFailed as e:
+            logger.exception(e)
+            return DownloadStatus.FAILED, bytes()
+        except ValueError as e:
+            # data is corrupted or tampered
+            logger.exception(e)
+            return DownloadStatus.FAILED, bytes()
+
+        return DownloadStatus.OK, bytes(data)
+
+    def _by_ranges(self, block: entity.Block) -> bool:
+        if not self._range_size or block.size <= self._range_size:
+            return False
+        return not block.cipher or block.cipher.ciphertext_range(0, 1, block.size) is not None
+
+    async def _download_block_by_chunks(self, block: entity.Block) -> DownloadStatus:
+        if self._by_ranges(block):
+            status, data = await self._download_block_by_ranges(block)
+        else:
+            status, data = await self._download_block_by_stream(block)
 
         block.data = data
         if status == DownloadStatus.OK:
@@ -66,24 +219,13 @@ class Downloader:
 
         return status
 
-    @staticmethod
-    def _merge_blocks(path: str, blocks: Iterable[entity.Block], temp_dir: str):
-        if os.path.exists(path):
-            path += "(NEW)"
-        with open(path, "wb") as f:
-            for block in blocks:
-                with open(os.path.join(temp_dir, block.name), "rb") as ff:
-                    data = ff.read()
-                f.write(data)
-
-    def _init_progress(self, grouped_blocks: Sequence[Sequence[entity.Block]]):
-        self._progress = []
-        for blocks in grouped_blocks:
-            block = blocks[0]
-            self._progress.append(
-                    BlockProgress(done=0,
-                                  total=math.ceil(block.size / self._chunk_size),
-                                  block_number=block.number))
+    def _init_progress(self, file: entity.File):
+        """
+        Reset progress, total of block is estimated until its download starts
+        """
+        total = math.ceil(file.size / max(1, file.total_blocks) / self._chunk_size)
+        self._progress = [BlockProgress(done=0, total=total, block_number=number)
+                          for number in range(file.total_blocks)]
 
     async def _download_block_by_group(self,
                                        blocks: Sequence[entity.Block]) \
@@ -100,35 +242,65 @@ class Downloader:
 
         return tuple(history), block
 
-    async def download_file(self, file: entity.File, temp_dir: str = "") -> None:
-        tasks: List[asyncio.Task] = []
-        blocks = await self._block_repo.get_blocks_grouped_by_number(file)
-        self._init_progress(blocks)
-
-        logger.debug(f"Blocks: {blocks}")
-        blocks_with_data: List[entity.Block] = [None for _ in range(len(blocks))]
-        index = 0
-        while index < len(blocks) or tasks:
-            for _ in range(self._parallel_num - len(tasks)):
-                if index >= len(blocks):
-                    break
-                tasks.append(asyncio.create_task(self._download_block_by_group(blocks[index])))
-                index += 1
-            logger.info(tasks)
-
-            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-            done_tasks: List[asyncio.Task] = list(done)
-            tasks = list(pending)
-            for task in done_tasks:
-                failed, block = task.result()
-                if not block:
-                    logger.error(f"Failed to load block: {failed}")
-                    raise BlockDownloadFailed
-                block.save(temp_dir)
-                blocks_with_data[block.number] = block
-                block.data = None
-
-        self._merge_blocks(file.path, blocks_with_data, temp_dir)
+    async def download_file(self, file: entity.File) -> None:
+        """
+        Download blocks of file and write them to file.path (with suffix "(NEW)" if it exists)
+
+        Blocks are read from repository lazily and written at their offsets as soon as downloaded,
+        so memory doesn't depend on count of blocks: only parallel_num blocks are kept
+
+        Raise BlockDownloadFailed if no duplicate of a block can be downloaded
+        and ChecksumNoEqual if downloaded file differs from uploaded one
+        """
+        if os.path.exists(file.path):
+            file.path += "(NEW)"
+        self._init_progress(file)
+
+        semaphore = asyncio.Semaphore(self._parallel_num)
+        tasks = set()
+        failed = False
+        block_size = 0
+
+        with open(file.path, "wb") as f:
+            f.truncate(file.size)
+
+            async def download_group(group: List[entity.Block]) -> None:
+                nonlocal failed
+                try:
+                    async with self._scheduler.slot() if self._scheduler else contextlib.nullcontext():
+                        history, block = await self._download_block_by_group(group)
+                    if not block:
+                        logger.error(f"Failed to load block: {history}")
+                        failed = True
+                        return
+                    f.seek(block.number * block_size)
+                    f.write(block.data)
+                    block.data = None
+                finally:
+                    semaphore.release()
+
+            async with contextlib.aclosing(self._block_repo.iter_blocks_grouped_by_number(file)) as groups:
+                async for group in groups:
+                    await semaphore.acquire()
+                    if failed:
+                        semaphore.release()
+                        break
+
+                    # blocks are ordered by number, all blocks except the last one have the size of the first
+                    block_size = block_size or group[0].size
+                    if group[0].number < len(self._progress):
+                        self._progress[group[0].number].total = math.ceil(group[0].size / self._chunk_size)
+
+                    task = asyncio.create_task(download_group(group))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+            if tasks:
+                await asyncio.gather(*tasks)
+
+        if failed:
+            raise BlockDownloadFailed()
+
         result, download_checksum, saved_checksum = self._check_hash(file)
         if not result:
             raise ChecksumNoEqual()
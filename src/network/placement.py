@@ -0,0 +1,194 @@
+import bisect
+import dataclasses
+import hashlib
+import heapq
+import math
+import random
+from abc import ABC, abstractmethod
+from typing import Dict, List, Sequence, Optional, Tuple
+
+import entity
+from .storage_base import StorageBase
+
+
+@dataclasses.dataclass(kw_only=True)
+class StorageStats:
+    throughput: float = 0  # EWMA of upload speed in bytes per second
+    error_rate: float = 0  # EWMA of failed uploads share
+    samples: int = 0
+
+    def update(self, size: int, seconds: float, ok: bool, alpha: float) -> None:
+        self.error_rate = (1 - alpha) * self.error_rate + alpha * (0 if ok else 1)
+        if ok and seconds > 0:
+            speed = size / seconds
+            self.throughput = speed if not self.samples else (1 - alpha) * self.throughput + alpha * speed
+            self.samples += 1
+
+
+class PlacementPolicy(ABC):
+    """
+    Policy choosing storages for duplicates of one block
+    """
+
+    @abstractmethod
+    def choose(self,
+               block: entity.Block,
+               storages: Sequence[StorageBase],
+               usage: Dict[int, float],
+               count: int) -> List[StorageBase]:
+        """
+        Choose count different storages for block
+
+        :param block: first duplicate of block
+        :param storages: storages having enough free space for block
+        :param usage: projected used/total space ratio by storage id
+        :param count: number of storages to choose (not greater than len(storages))
+        """
+        pass
+
+    def record_upload(self, storage: StorageBase, size: int, seconds: float, ok: bool) -> None:
+        pass
+
+    def set_storages(self, storages: Sequence[StorageBase]) -> None:
+        """
+        Set all storages known to balancer (including the full ones)
+        """
+        pass
+
+
+class FreeSpacePolicy(PlacementPolicy):
+    """
+    Choose the least used storages
+    """
+
+    def choose(self, block, storages, usage, count):
+        return heapq.nsmallest(count, storages, key=lambda storage: (usage[storage.id], storage.id))
+
+
+class ThroughputPolicy(PlacementPolicy):
+    """
+    Choose storages randomly with weight proportional to observed upload throughput
+    and share of successful uploads
+
+    Storages without statistics get the best known throughput, so they are tried soon
+    """
+
+    min_weight: float = 0.01  # share of best weight given to the worst storage, so it's still measured
+
+    # storage id -> statistics. Shared by all policies
+    _stats: Dict[int, StorageStats] = {}
+
+    def __init__(self, alpha: float = 0.2, rand: Optional[random.Random] = None):
+        self._alpha = alpha
+        self._random = rand or random.Random()
+
+    def stats(self, storage: StorageBase) -> StorageStats:
+        return self._stats.setdefault(storage.id, StorageStats())
+
+    def record_upload(self, storage: StorageBase, size: int, seconds: float, ok: bool) -> None:
+        self.stats(storage).update(size, seconds, ok, self._alpha)
+
+    def _weights(self, storages: Sequence[StorageBase]) -> List[float]:
+        known = [self.stats(storage).throughput for storage in storages if self.stats(storage).samples]
+        default = max(known, default=1.0)
+
+        weights = []
+        for storage in storages:
+            stats = self.stats(storage)
+            throughput = stats.throughput if stats.samples else default
+            weights.append(throughput * (1 - stats.error_rate))
+
+        floor = max(weights, default=1.0) * self.min_weight or self.min_weight
+        return [max(weight, floor) for weight in weights]
+
+    def choose(self, block, storages, usage, count):
+        # weighted sampling without replacement: take count biggest u ** (1 / w)
+        keys = [(math.log(self._random.random() or 1e-300) / weight, index)
+                for index, weight in enumerate(self._weights(storages))]
+        return [storages[index] for _, index in heapq.nlargest(count, keys)]
+
+
+class ConsistentHashPolicy(PlacementPolicy):
+    """
+    Deterministic placement by consistent hashing
+
+    Every storage has virtual nodes on hash ring, their count is proportional to storage total space.
+    Duplicates of block are placed to the first different storages clockwise from hash of
+    block content (its sha256 and size), so location of block can be computed again at any time
+    and blocks sharing stored data (copies, snapshots, deduplicated blocks) get the same location.
+    Adding or removing storage moves only blocks of its ring segments
+    """
+
+    def __init__(self, vnodes: int = 100):
+        self._vnodes = vnodes  # average count of virtual nodes per storage
+        self._ring: List[Tuple[int, int]] = []  # (hash, storage id)
+        self._hashes: List[int] = []
+        self._ring_key: Tuple[Tuple[int, int], ...] = ()
+        self._all: List[StorageBase] = []
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    @staticmethod
+    def placement_key(block: entity.Block) -> str:
+        if block.content_hash:
+            return f"{block.content_hash}:{block.size}"
+        return f"{block.file.id}:{block.number}"
+
+    def _build_ring(self, storages: Sequence[StorageBase]) -> None:
+        ring_key = tuple(sorted((storage.id, storage.total_space) for storage in storages))
+        if ring_key == self._ring_key:
+            return
+
+        mean_space = sum(space for _, space in ring_key) / len(ring_key) or 1
+        ring = []
+        for storage_id, space in ring_key:
+            vnodes = max(1, round(self._vnodes * space / mean_space))
+            ring.extend((self._hash(f"{storage_id}#{i}"), storage_id) for i in range(vnodes))
+        ring.sort()
+
+        self._ring = ring
+        self._hashes = [h for h, _ in ring]
+        self._ring_key = ring_key
+
+    def locate(self, key: str, storages: Sequence[StorageBase], count: int,
+               allowed: Optional[Sequence[StorageBase]] = None) -> List[StorageBase]:
+        """
+        Find count different storages for key on ring built from storages
+
+        Storages not in allowed (e.g. full ones) are skipped, but don't change the ring
+        """
+        self._build_ring(storages)
+        by_id = {storage.id: storage for storage in (allowed if allowed is not None else storages)}
+
+        chosen: List[StorageBase] = []
+        seen = set()
+        start = bisect.bisect(self._hashes, self._hash(key))
+        for i in range(len(self._ring)):
+            _, storage_id = self._ring[(start + i) % len(self._ring)]
+            if storage_id in seen:
+                continue
+            seen.add(storage_id)
+            if storage_id in by_id:
+                chosen.append(by_id[storage_id])
+                if len(chosen) == count:
+                    break
+        return chosen
+
+    def choose(self, block, storages, usage, count):
+        # ring is built from all storages, so placement doesn't depend on their free space
+        return self.locate(self.placement_key(block), self._all or storages, count, allowed=storages)
+
+    def set_storages(self, storages: Sequence[StorageBase]) -> None:
+        self._all = list(storages)
+
+
+def create_policy(name: str) -> PlacementPolicy:
+    if name == "space":
+        return FreeSpacePolicy()
+    if name == "throughput":
+        return ThroughputPolicy()
+    if name == "hash":
+        return ConsistentHashPolicy()
+    raise ValueError(f"Unknown placement policy {name}")
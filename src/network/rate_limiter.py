@@ -0,0 +1,38 @@
+import asyncio
+from typing import AsyncIterable, AsyncIterator
+
+
+class RateLimiter:
+    """
+    Token bucket limiting count of bytes per second shared by many transfers
+
+    Zero rate means no limit
+    """
+
+    def __init__(self, rate: float, burst: float = 0):
+        self._rate = rate
+        self._burst = burst or rate
+        self._tokens = self._burst
+        self._updated = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: int) -> None:
+        if not self._rate:
+            return
+
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            if self._updated is not None:
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+
+            self._tokens -= amount
+            if self._tokens < 0:
+                # wait until debt is paid, so other transfers wait too
+                await asyncio.sleep(-self._tokens / self._rate)
+
+    async def limit(self, chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+        async for chunk in chunks:
+            await self.acquire(len(chunk))
+            yield chunk
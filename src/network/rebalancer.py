@@ -0,0 +1,255 @@
+import asyncio
+import dataclasses
+import uuid
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import aiohttp
+from loguru import logger
+
+import entity
+import exceptions
+import repository
+from .balancer import Balancer
+from .placement import ConsistentHashPolicy
+from .rate_limiter import RateLimiter
+from .storage_base import StorageBase, UploadStatus, DownloadStatus, DeleteStatus
+
+
+@dataclasses.dataclass(kw_only=True)
+class RebalancerConfig:
+    chunk_size: int = 256 * 2 ** 10
+    parallel_num: int = 2  # simultaneous block moves
+    bandwidth: int = 0  # bytes per second for all moves (0 - unlimited)
+    threshold: float = 0.05  # stop when used space ratios differ less than threshold
+    max_moves: int = 0  # 0 - unlimited
+
+
+@dataclasses.dataclass(kw_only=True)
+class Move:
+    block: entity.Block
+    target: StorageBase
+
+
+class Rebalancer:
+    """
+    Move blocks from the most used storages to the least used ones
+
+    Block is streamed from source storage to target storage without temp files,
+    its record in repository is updated only after the new copy is checked
+    and the old copy is deleted after that
+    """
+
+    def __init__(self,
+                 block_repo: "repository.MetadataStore",
+                 config: Optional[RebalancerConfig] = None):
+        self._block_repo = block_repo
+        self._config = config or RebalancerConfig()
+        self._limiter = RateLimiter(self._config.bandwidth)
+        self._session = None
+        self._moved = 0
+        self._moved_bytes = 0
+
+    async def __aenter__(self) -> "Rebalancer":
+        self._session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, *args):
+        await self._session.close()
+
+    async def plan(self, storages: Sequence[StorageBase]) -> List[Move]:
+        """
+        Choose blocks to move until used space ratios of storages differ less than threshold
+
+        Duplicates of block (and of every block sharing its stored data) are never moved to the same storage.
+        Stored data shared by several blocks is moved once
+        """
+        await Balancer.fetch_capacity(storages, self._session, force=True)
+        storages = [storage for storage in storages if storage.total_space]
+        if len(storages) < 2:
+            return []
+
+        used = {storage.id: storage.used_space for storage in storages}
+
+        def ratio(storage: StorageBase) -> float:
+            return used[storage.id] / storage.total_space
+
+        def content(block: entity.Block) -> str:
+            # blocks sharing stored data have the same content
+            return block.content_hash or f"{block.file.id}:{block.number}"
+
+        candidates: Dict[int, List[entity.Block]] = {}
+        planned = set()  # (storage id, name) of planned stored data
+        targets: Dict[str, set] = {}  # content of planned blocks -> ids of their targets
+        moves: List[Move] = []
+
+        while not self._config.max_moves or len(moves) < self._config.max_moves:
+            storages.sort(key=ratio)
+            source = storages[-1]
+            if ratio(source) - ratio(storages[0]) < self._config.threshold:
+                break
+
+            if source.id not in candidates:
+                # reversed, so the biggest block is popped first
+                candidates[source.id] = list(reversed(await self._block_repo.get_blocks_by_storage(source)))
+
+            move = None
+            while candidates[source.id] and not move:
+                block = candidates[source.id].pop()
+                if (block.storage.id, block.name) in planned:
+                    continue
+                planned.add((block.storage.id, block.name))
+
+                replicas = set(await self._block_repo.get_shared_replica_storage_ids(block))
+                replicas |= targets.get(content(block), set())
+                for target in storages[:-1]:
+                    if target.id in replicas:
+                        continue
+                    # don't move if it makes target more used than source
+                    if (used[target.id] + block.size) / target.total_space > \
+                            (used[source.id] - block.size) / source.total_space:
+                        continue
+                    move = Move(block=block, target=target)
+                    break
+
+            if not move:
+                # nothing can be moved from the most used storage
+                break
+
+            used[source.id] -= move.block.size
+            used[move.target.id] += move.block.size
+            targets.setdefault(content(move.block), set()).add(move.target.id)
+            moves.append(move)
+
+        return moves
+
+    @staticmethod
+    def _shared_groups(blocks: Sequence[entity.Block]) -> List[List[entity.Block]]:
+        """
+        Group blocks connected by duplicates of the same (file id, number) or by shared stored data
+        (storage id, name), e.g. of copied files, snapshots and deduplicated blocks
+        """
+        parent: Dict[tuple, tuple] = {}
+
+        def find(node: tuple) -> tuple:
+            parent.setdefault(node, node)
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        for block in blocks:
+            parent[find(("data", block.storage.id, block.name))] = find(("block", block.file.id, block.number))
+
+        groups: Dict[tuple, List[entity.Block]] = {}
+        for block in blocks:
+            groups.setdefault(find(("block", block.file.id, block.number)), []).append(block)
+        return list(groups.values())
+
+    async def plan_placement(self, storages: Sequence[StorageBase],
+                             policy: ConsistentHashPolicy) -> List[Move]:
+        """
+        Choose blocks whose storages differ from ones computed by consistent hashing
+
+        Stored data shared by several blocks is located by one key and moved once.
+        Every stored duplicate placed in a wrong storage (or in the storage of another duplicate)
+        is moved to a computed storage not having a duplicate yet
+        """
+        await Balancer.fetch_capacity(storages, self._session, force=True)
+        storages = [storage for storage in storages if storage.total_space]
+        if not storages:
+            return []
+
+        moves: List[Move] = []
+        blocks = [block for block in await self._block_repo.get_all_blocks(storages) if block.storage]
+        for group in self._shared_groups(blocks):
+            # one block per stored duplicate
+            stored = list({(block.storage.id, block.name): block for block in group}.values())
+            key_block = min(group, key=lambda block: (not block.content_hash, block.file.id, block.number))
+            expected = policy.locate(policy.placement_key(key_block), storages, len(stored))
+
+            kept = set()
+            misplaced = []
+            for block in stored:
+                if block.storage.id in {storage.id for storage in expected} and block.storage.id not in kept:
+                    kept.add(block.storage.id)
+                else:
+                    misplaced.append(block)
+            free_targets = [storage for storage in expected
+                            if storage.id not in kept and storage.id not in {block.storage.id for block in stored}]
+            for block, target in zip(misplaced, free_targets):
+                moves.append(Move(block=block, target=target))
+                if self._config.max_moves and len(moves) >= self._config.max_moves:
+                    return moves
+
+        return moves
+
+    async def _check_copy(self, source: entity.File, target: StorageBase, name: str) -> bool:
+        status, copy = await target.stat(name, self._session)
+        if status != DownloadStatus.OK:
+            logger.error(f"Cannot stat copy {name} in storage {target}: {status}")
+            return False
+        if copy.size != source.size:
+            logger.error(f"Size of copy {name} is {copy.size} instead of {source.size}")
+            return False
+        if copy.checksum and source.checksum and copy.checksum != source.checksum:
+            logger.error(f"Checksum of copy {name} is {copy.checksum} instead of {source.checksum}")
+            return False
+        return True
+
+    async def _move(self, move: Move) -> bool:
+        block, target = move.block, move.target
+        source = block.storage
+        name = str(uuid.uuid4())
+
+        status, original = await source.stat(block.name, self._session)
+        if status != DownloadStatus.OK:
+            logger.error(f"Cannot stat block {block.name} in storage {source}: {status}")
+            return False
+
+        chunks = self._limiter.limit(source.download_stream(block.name, self._config.chunk_size, self._session))
+        try:
+            status = await target.upload_by_chunks(name, chunks, self._session)
+        except exceptions.BlockDownloadFailed as e:
+            logger.exception(e)
+            status = UploadStatus.FAILED
+
+        moved = status == UploadStatus.OK and await self._check_copy(original, target, name)
+        if moved:
+            moved = await self._block_repo.move_block(block, target, name)
+            await self._block_repo.commit()
+
+        if not moved:
+            logger.error(f"Failed to move block {block.name} to storage {target}")
+            await target.delete(name, self._session)
+            return False
+
+        if await source.delete(block.name, self._session) not in (DeleteStatus.OK, DeleteStatus.FILE_DOESNT_EXIST):
+            logger.warning(f"Old copy of block {block.name} is left in storage {source}")
+
+        logger.info(f"Move block {block.name} from storage {source} to {target} as {name}")
+        self._moved += 1
+        self._moved_bytes += original.size
+        return True
+
+    async def run(self, moves: Sequence[Move]) -> List[Move]:
+        """
+        Execute planned moves by parallel_num at a time
+
+        Return moves that failed
+        """
+        semaphore = asyncio.Semaphore(self._config.parallel_num)
+
+        async def move_block(move: Move) -> Tuple[bool, Move]:
+            async with semaphore:
+                return await self._move(move), move
+
+        results = await asyncio.gather(*(move_block(move) for move in moves))
+        return [move for ok, move in results if not ok]
+
+    @property
+    def moved(self) -> int:
+        return self._moved
+
+    @property
+    def moved_bytes(self) -> int:
+        return self._moved_bytes
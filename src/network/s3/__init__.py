@@ -0,0 +1 @@
+from .s3 import S3
\ No newline at end of file
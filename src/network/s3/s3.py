@@ -0,0 +1,380 @@
+import asyncio
+import datetime
+import hashlib
+import hmac
+import xml.etree.ElementTree as ElementTree
+from typing import Tuple, Callable, Optional, Dict, List, Iterable, AsyncIterable, AsyncIterator, Union
+from urllib.parse import urlsplit, parse_qs, quote
+
+import aiohttp
+from loguru import logger
+from tqdm.asyncio import tqdm
+from yarl import URL
+
+import exceptions
+from entity import File
+from network.storage_base import StorageBase, DownloadStatus, UploadStatus, StorageType, DeleteStatus
+
+_XMLNS = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+
+
+class S3(StorageBase):
+    """
+    S3-compatible storage (AWS S3, MinIO, etc.)
+
+    Token is an url with credentials and bucket:
+        http[s]://ACCESS_KEY:SECRET_KEY@host[:port]/bucket[?region=us-east-1&quota=BYTES]
+
+    Big objects are uploaded by multipart upload with parallel_num parts at a time
+    """
+    part_size: int = 8 * 2 ** 20  # S3 doesn't accept parts smaller than 5 MB (except the last one)
+    parallel_num: int = 4  # simultaneous part uploads of one object
+    default_quota: int = 2 ** 40  # S3 doesn't limit bucket size, so quota is used as total space
+
+    def __init__(self):
+        super(S3, self).__init__()
+        self.type = StorageType.S3
+
+    def _settings(self) -> Dict[str, str]:
+        url = urlsplit(self.token)
+        query = parse_qs(url.query)
+        return {
+            'endpoint': f"{url.scheme}://{url.hostname}" + (f":{url.port}" if url.port else ""),
+            'host': url.netloc.rsplit('@', 1)[-1],
+            'bucket': url.path.strip('/'),
+            'access_key': url.username or "",
+            'secret_key': url.password or "",
+            'region': query.get('region', ['us-east-1'])[0],
+            'quota': query.get('quota', [str(self.default_quota)])[0],
+        }
+
+    @staticmethod
+    def _hmac(key: bytes, msg: str) -> bytes:
+        return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+    def _signed_url(self, method: str, filename: str = "", params: Optional[Dict[str, str]] = None,
+                    headers: Optional[Dict[str, str]] = None) -> Tuple[URL, Dict[str, str]]:
+        """
+        Build url and headers signed by AWS Signature Version 4
+
+        Payload isn't signed, so body may be streamed
+        """
+        settings = self._settings()
+        params = params or {}
+        headers = dict(headers or {})
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date = now.strftime('%Y%m%d')
+
+        path = f"/{settings['bucket']}"
+        if filename:
+            path += '/' + quote(filename, safe='/~')
+        query = '&'.join(f"{quote(k, safe='-_.~')}={quote(str(v), safe='-_.~')}"
+                         for k, v in sorted(params.items()))
+
+        headers['host'] = settings['host']
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = 'UNSIGNED-PAYLOAD'
+        signed_headers = ';'.join(sorted(k.lower() for k in headers))
+        canonical_headers = ''.join(f"{k.lower()}:{str(v).strip()}\n" for k, v in sorted(headers.items(),
+                                                                                          key=lambda x: x[0].lower()))
+        canonical_request = '\n'.join([method, path, query, canonical_headers, signed_headers, 'UNSIGNED-PAYLOAD'])
+
+        scope = f"{date}/{settings['region']}/s3/aws4_request"
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+
+        key = self._hmac(('AWS4' + settings['secret_key']).encode('utf-8'), date)
+        key = self._hmac(key, settings['region'])
+        key = self._hmac(key, 's3')
+        key = self._hmac(key, 'aws4_request')
+        signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+        headers['Authorization'] = (f"AWS4-HMAC-SHA256 Credential={settings['access_key']}/{scope}, "
+                                    f"SignedHeaders={signed_headers}, Signature={signature}")
+        del headers['host']
+
+        url = settings['endpoint'] + path + (f"?{query}" if query else "")
+        return URL(url, encoded=True), headers
+
+    async def _put_object(self, filename: str, data: bytes, session: aiohttp.ClientSession) -> UploadStatus:
+        url, headers = self._signed_url('PUT', filename)
+        async with session.put(url, headers=headers, data=data) as resp:
+            if resp.status != 200:
+                logger.error(f"Bad response. Code: {resp.status}")
+                return UploadStatus.FAILED
+        return UploadStatus.OK
+
+    async def _create_multipart_upload(self, filename: str, session: aiohttp.ClientSession) -> Optional[str]:
+        url, headers = self._signed_url('POST', filename, {'uploads': ''})
+        async with session.post(url, headers=headers) as resp:
+            if resp.status != 200:
+                logger.error(f"Bad response. Code: {resp.status}")
+                return None
+            root = ElementTree.fromstring(await resp.read())
+            return root.findtext(f'{_XMLNS}UploadId')
+
+    async def _upload_part(self, filename: str, upload_id: str, number: int, data: bytes,
+                           session: aiohttp.ClientSession) -> Optional[str]:
+        url, headers = self._signed_url('PUT', filename, {'partNumber': str(number), 'uploadId': upload_id})
+        async with session.put(url, headers=headers, data=data) as resp:
+            if resp.status != 200:
+                logger.error(f"Failed to upload part {number} of {filename}. Code: {resp.status}")
+                return None
+            return resp.headers.get('ETag')
+
+    async def _complete_multipart_upload(self, filename: str, upload_id: str, etags: List[str],
+                                         session: aiohttp.ClientSession) -> UploadStatus:
+        body = '<CompleteMultipartUpload>' + ''.join(
+                f'<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>'
+                for number, etag in enumerate(etags, 1)) + '</CompleteMultipartUpload>'
+
+        url, headers = self._signed_url('POST', filename, {'uploadId': upload_id})
+        async with session.post(url, headers=headers, data=body.encode('utf-8')) as resp:
+            # S3 may report error in body of 200 response
+            content = await resp.read()
+            if resp.status != 200 or b'<Error>' in content:
+                logger.error(f"Failed to complete upload of {filename}. Code: {resp.status}")
+                return UploadStatus.FAILED
+        return UploadStatus.OK
+
+    async def _abort_multipart_upload(self, filename: str, upload_id: str, session: aiohttp.ClientSession) -> None:
+        url, headers = self._signed_url('DELETE', filename, {'uploadId': upload_id})
+        async with session.delete(url, headers=headers) as resp:
+            if resp.status != 204:
+                logger.error(f"Failed to abort upload of {filename}. Code: {resp.status}")
+
+    async def _multipart_upload(self, filename: str, parts: AsyncIterator[bytes],
+                                session: aiohttp.ClientSession) -> UploadStatus:
+        """
+        Upload parts by parallel_num simultaneous requests
+
+        Parts are consumed lazily, so no more than parallel_num parts are kept in memory
+        """
+        upload_id = await self._create_multipart_upload(filename, session)
+        if not upload_id:
+            return UploadStatus.FAILED
+
+        semaphore = asyncio.Semaphore(self.parallel_num)
+
+        async def upload_part(number: int, data: bytes) -> Optional[str]:
+            try:
+                return await self._upload_part(filename, upload_id, number, data, session)
+            finally:
+                semaphore.release()
+
+        tasks: List[asyncio.Task] = []
+        try:
+            number = 0
+            async for data in parts:
+                number += 1
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(upload_part(number, data)))
+            etags = await asyncio.gather(*tasks)
+
+            if not all(etags):
+                await self._abort_multipart_upload(filename, upload_id, session)
+                return UploadStatus.FAILED
+            return await self._complete_multipart_upload(filename, upload_id, etags, session)
+        except (aiohttp.ClientConnectionError, exceptions.BlockDownloadFailed):
+            for task in tasks:
+                task.cancel()
+            await self._abort_multipart_upload(filename, upload_id, session)
+            raise
+
+    async def _parts(self, data: Union[Iterable[bytes], AsyncIterable[bytes]]) -> AsyncIterator[bytes]:
+        """
+        Join chunks into parts of part_size
+        """
+        if not hasattr(data, '__aiter__'):
+            data = tqdm(data, disable=True)
+
+        part = bytearray()
+        async for chunk in data:
+            part += chunk
+            while len(part) >= self.part_size:
+                yield bytes(part[:self.part_size])
+                del part[:self.part_size]
+        if part:
+            yield bytes(part)
+
+    async def upload(self, filename: str, data: bytes, session: aiohttp.ClientSession) -> UploadStatus:
+        try:
+            if len(data) <= self.part_size:
+                return await self._put_object(filename, data, session)
+            return await self._multipart_upload(filename, self._parts((data,)), session)
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            return UploadStatus.FAILED
+
+    async def upload_by_chunks(self, filename: str, data: Union[Iterable[bytes], AsyncIterable[bytes]],
+                               session: aiohttp.ClientSession) -> UploadStatus:
+        parts = self._parts(data)
+        try:
+            first = await anext(parts, b'')
+            second = await anext(parts, None)
+            if second is None:
+                return await self._put_object(filename, first, session)
+
+            async def all_parts():
+                yield first
+                yield second
+                async for part in parts:
+                    yield part
+
+            return await self._multipart_upload(filename, all_parts(), session)
+        except (aiohttp.ClientConnectionError, exceptions.BlockDownloadFailed) as e:
+            logger.exception(e)
+            return UploadStatus.FAILED
+
+    async def download(self, filename: str, session: aiohttp.ClientSession) -> Tuple[DownloadStatus, bytes]:
+        url, headers = self._signed_url('GET', filename)
+        try:
+            async with session.get(url, headers=headers) as resp:
+                if resp.status == 200:
+                    return DownloadStatus.OK, await resp.read()
+                elif resp.status == 404:
+                    return DownloadStatus.FILE_DOESNT_EXITS, bytes()
+                logger.error(f"Failed to download file. Code: {resp.status}")
+                return DownloadStatus.FAILED, bytes()
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            return DownloadStatus.FAILED, bytes()
+
+    async def download_by_chunks(self, filename: str, chunk_size: int, inc_progress: Callable[[], None],
+                                 session: aiohttp.ClientSession) -> Tuple[DownloadStatus, bytes]:
+        url, headers = self._signed_url('GET', filename)
+        data = bytearray()
+        try:
+            chunk_count = 0
+            async with session.get(url, headers=headers) as resp:
+                if resp.status != 200:
+                    logger.error(f"Failed to download file. Code: {resp.status}")
+                    return DownloadStatus.FAILED, bytes()
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    data += chunk
+                    if len(data) // chunk_size != chunk_count:
+                        chunk_count += 1
+                        inc_progress()
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            return DownloadStatus.FAILED, bytes(data)
+
+        return DownloadStatus.OK, bytes(data)
+
+    async def download_stream(self, filename: str, chunk_size: int,
+                              session: aiohttp.ClientSession) -> AsyncIterator[bytes]:
+        url, headers = self._signed_url('GET', filename)
+        try:
+            async with session.get(url, headers=headers) as resp:
+                if resp.status != 200:
+                    logger.error(f"Failed to download file. Code: {resp.status}")
+                    raise exceptions.BlockDownloadFailed(filename)
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    yield chunk
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            raise exceptions.BlockDownloadFailed(filename) from e
+
+    async def stat(self, filename: str, session: aiohttp.ClientSession) -> Tuple[DownloadStatus, Optional[File]]:
+        url, headers = self._signed_url('HEAD', filename)
+        try:
+            async with session.head(url, headers=headers) as resp:
+                if resp.status == 200:
+                    etag = resp.headers.get('ETag', '').strip('"')
+                    # ETag of multipart upload isn't md5 of content
+                    checksum = etag if '-' not in etag else ''
+                    return DownloadStatus.OK, File(filename=filename,
+                                                   size=int(resp.headers.get('Content-Length', 0)),
+                                                   checksum=checksum)
+                elif resp.status == 404:
+                    return DownloadStatus.FILE_DOESNT_EXITS, None
+                logger.error(f"Bad response. Code: {resp.status}")
+                return DownloadStatus.FAILED, None
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            return DownloadStatus.FAILED, None
+
+    async def download_range(self, filename: str, offset: int, length: int,
+                             session: aiohttp.ClientSession) -> Tuple[DownloadStatus, bytes]:
+        url, headers = self._signed_url('GET', filename)
+        headers['Range'] = f"bytes={offset}-{offset + length - 1}"
+        try:
+            async with session.get(url, headers=headers) as resp:
+                if resp.status == 206:
+                    return DownloadStatus.OK, await resp.read()
+                elif resp.status == 200:
+                    # server ignored range
+                    return DownloadStatus.OK, (await resp.read())[offset:offset + length]
+                elif resp.status == 404:
+                    return DownloadStatus.FILE_DOESNT_EXITS, bytes()
+                logger.error(f"Failed to download range of file. Code: {resp.status}")
+                return DownloadStatus.FAILED, bytes()
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            return DownloadStatus.FAILED, bytes()
+
+    async def _list_objects(self, session: aiohttp.ClientSession,
+                            continuation_token: str = "") -> Tuple[DownloadStatus, List[File], str]:
+        """
+        Return one page of objects and continuation token of the next page (empty if it's the last)
+        """
+        params = {'list-type': '2', 'max-keys': '1000'}
+        if continuation_token:
+            params['continuation-token'] = continuation_token
+
+        url, headers = self._signed_url('GET', params=params)
+        async with session.get(url, headers=headers) as resp:
+            if resp.status != 200:
+                logger.error(f"Bad response. Code: {resp.status}")
+                return DownloadStatus.FAILED, [], ""
+            root = ElementTree.fromstring(await resp.read())
+
+        files = [File(filename=item.findtext(f'{_XMLNS}Key'), size=int(item.findtext(f'{_XMLNS}Size')))
+                 for item in root.iter(f'{_XMLNS}Contents')]
+        next_token = ""
+        if root.findtext(f'{_XMLNS}IsTruncated') == 'true':
+            next_token = root.findtext(f'{_XMLNS}NextContinuationToken') or ""
+        return DownloadStatus.OK, files, next_token
+
+    async def size(self, session: aiohttp.ClientSession) -> Tuple[int, int]:
+        used_space = 0
+        token = ""
+        try:
+            while True:
+                status, files, token = await self._list_objects(session, token)
+                if status != DownloadStatus.OK:
+                    return 0, 0
+                used_space += sum(file.size for file in files)
+                if not token:
+                    break
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            return 0, 0
+
+        return used_space, int(self._settings()['quota'])
+
+    async def delete(self, filename: str, session: aiohttp.ClientSession) -> DeleteStatus:
+        url, headers = self._signed_url('DELETE', filename)
+        try:
+            async with session.delete(url, headers=headers) as resp:
+                if resp.status in (200, 204):
+                    return DeleteStatus.OK
+                logger.error(f"Bad response. Code: {resp.status}")
+                return DeleteStatus.FAILED
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            return DeleteStatus.FAILED
+
+    async def files(self, session: aiohttp.ClientSession) -> Tuple[DownloadStatus, Tuple[File]]:
+        try:
+            status, files, _ = await self._list_objects(session)
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            return DownloadStatus.FAILED, tuple()
+
+        return status, tuple(files)
+
+    def __str__(self):
+        return f"id={self.id} | {self.type}: {self._settings()['endpoint']}/{self._settings()['bucket']}"
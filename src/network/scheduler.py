@@ -0,0 +1,33 @@
+import asyncio
+
+import aiohttp
+
+
+class TransferScheduler:
+    """
+    Share one HTTP session and limit of simultaneous block transfers between uploads of many files
+
+    Small files are uploaded in parallel while the number of requests to storages stays limited,
+    connections of the session are reused by all uploads
+    """
+
+    def __init__(self, parallel_num: int = 10):
+        self._semaphore = asyncio.Semaphore(parallel_num)
+        self._session = None
+
+    async def __aenter__(self) -> "TransferScheduler":
+        self._session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, *args):
+        await self._session.close()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self._session
+
+    def slot(self) -> asyncio.Semaphore:
+        """
+        Held while block is transferred
+        """
+        return self._semaphore
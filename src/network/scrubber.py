@@ -0,0 +1,210 @@
+import asyncio
+import dataclasses
+import hashlib
+import itertools
+import uuid
+from enum import Enum
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import aiohttp
+from loguru import logger
+
+import entity
+import exceptions
+import repository
+from .balancer import Balancer
+from .rate_limiter import RateLimiter
+from .storage_base import StorageBase, DownloadStatus, UploadStatus
+
+
+class ScrubStatus(Enum):
+    OK = 'Ok'
+    MISSING = 'Missing'
+    CORRUPT = 'Corrupt'
+    FAILED = 'Failed'  # block cannot be checked (e.g. storage is unavailable)
+    REPAIRED = 'Repaired'
+    LOST = 'Lost'  # there is no healthy duplicate of block
+
+
+@dataclasses.dataclass(kw_only=True)
+class ScrubberConfig:
+    chunk_size: int = 256 * 2 ** 10
+    parallel_num: int = 2  # simultaneous requests per storage
+    bandwidth: int = 0  # bytes per second for all downloads and uploads (0 - unlimited)
+    full: bool = False  # download every block instead of using storage metadata
+    repair: bool = True  # recreate missing and corrupt duplicates
+
+
+class Scrubber:
+    """
+    Check that every duplicate of block exists in its storage and isn't corrupted
+
+    Size and md5 from storage metadata are used when storage provides them, otherwise block is downloaded.
+    Bad duplicates are recreated from a healthy one in another storage chosen by balancer
+    """
+
+    def __init__(self,
+                 block_repo: "repository.MetadataStore",
+                 config: Optional[ScrubberConfig] = None):
+        self._block_repo = block_repo
+        self._config = config or ScrubberConfig()
+        self._limiter = RateLimiter(self._config.bandwidth)
+        self._session = None
+        self._requests: Dict[int, asyncio.Semaphore] = {}
+        self._repair_lock = asyncio.Lock()
+        self._repairs: Dict[Tuple[int, str], asyncio.Future] = {}  # (storage id, name) of bad data -> its repair
+        self._targets: Dict[str, set] = {}  # content of repaired blocks -> ids of storages of new copies
+        self._results: List[Tuple[ScrubStatus, entity.Block]] = []
+
+    async def __aenter__(self) -> "Scrubber":
+        self._session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, *args):
+        await self._session.close()
+
+    def _limit(self, storage: StorageBase) -> asyncio.Semaphore:
+        if storage.id not in self._requests:
+            self._requests[storage.id] = asyncio.Semaphore(self._config.parallel_num)
+        return self._requests[storage.id]
+
+    async def _fetch_checksum(self, block: entity.Block) -> Tuple[DownloadStatus, str]:
+        h = hashlib.md5()
+        try:
+            async for chunk in self._limiter.limit(block.storage.download_stream(block.name,
+                                                                                 self._config.chunk_size,
+                                                                                 self._session)):
+                h.update(chunk)
+        except exceptions.BlockDownloadFailed as e:
+            logger.exception(e)
+            return DownloadStatus.FAILED, ""
+        return DownloadStatus.OK, h.hexdigest()
+
+    async def _check_block(self, block: entity.Block) -> ScrubStatus:
+        async with self._limit(block.storage):
+            status, remote = await block.storage.stat(block.name, self._session)
+            if status == DownloadStatus.FILE_DOESNT_EXITS:
+                return ScrubStatus.MISSING
+            if status != DownloadStatus.OK:
+                return ScrubStatus.FAILED
+
+            if not block.checksum:
+                # block uploaded before checksums were saved, it's plain or encrypted by Aes (iv + padded data)
+                if remote.size in (block.size, 16 + (block.size // 16 + 1) * 16):
+                    return ScrubStatus.OK
+                return ScrubStatus.CORRUPT
+
+            if remote.checksum and not self._config.full:
+                return ScrubStatus.OK if remote.checksum == block.checksum else ScrubStatus.CORRUPT
+
+            status, checksum = await self._fetch_checksum(block)
+            if status != DownloadStatus.OK:
+                return ScrubStatus.FAILED
+            return ScrubStatus.OK if checksum == block.checksum else ScrubStatus.CORRUPT
+
+    async def _repair_block(self, block: entity.Block, source: entity.Block, balancer: Balancer) -> bool:
+        """
+        Copy healthy duplicate source to a new storage and point block to the copy
+
+        Data shared by several blocks is repaired once, by the first of them
+        """
+        key = (block.storage.id, block.name)
+        if key not in self._repairs:
+            self._repairs[key] = asyncio.ensure_future(self._recreate_block(block, source, balancer))
+        return await self._repairs[key]
+
+    async def _recreate_block(self, block: entity.Block, source: entity.Block, balancer: Balancer) -> bool:
+        async with self._limit(source.storage):
+            status, data = await source.storage.download(source.name, self._session)
+        if status != DownloadStatus.OK:
+            logger.error(f"Cannot download healthy duplicate {source.name}: {status}")
+            return False
+        if source.checksum and hashlib.md5(data).hexdigest() != source.checksum:
+            logger.error(f"Duplicate {source.name} got corrupted while downloading")
+            return False
+        await self._limiter.acquire(len(data))
+
+        # new copy mustn't be in a storage of duplicates of any block sharing data with block,
+        # blocks sharing data have the same content
+        content = block.content_hash or f"{block.file.id}:{block.number}"
+        async with self._repair_lock:
+            exclude = set(await self._block_repo.get_shared_replica_storage_ids(block))
+            exclude |= self._targets.get(content, set())
+            try:
+                target = balancer.choose_storage(block, len(data), exclude)
+            except exceptions.NotEnoughSpace as e:
+                logger.exception(e)
+                return False
+            self._targets.setdefault(content, set()).add(target.id)
+
+        name = str(uuid.uuid4())
+        async with self._limit(target):
+            status = await target.upload(name, data, self._session)
+        if status != UploadStatus.OK:
+            logger.error(f"Cannot upload copy of block {block.name} to storage {target}: {status}")
+            return False
+
+        async with self._repair_lock:
+            moved = await self._block_repo.move_block(block, target, name)
+            await self._block_repo.commit()
+        if not moved:
+            await target.delete(name, self._session)
+            return False
+
+        # corrupt copy is useless, try to free space
+        await block.storage.delete(block.name, self._session)
+        logger.info(f"Block {block.name} recreated in storage {target} as {name}")
+        return True
+
+    async def _scrub_group(self, group: Sequence[entity.Block], balancer: Optional[Balancer]) -> None:
+        statuses = await asyncio.gather(*(self._check_block(block) for block in group))
+
+        healthy = [block for block, status in zip(group, statuses) if status == ScrubStatus.OK]
+        for block, status in zip(group, statuses):
+            if status in (ScrubStatus.MISSING, ScrubStatus.CORRUPT):
+                logger.warning(f"Block {block.name} in storage {block.storage}: {status}")
+                if not healthy:
+                    status = ScrubStatus.LOST
+                elif self._config.repair and balancer:
+                    if await self._repair_block(block, healthy[0], balancer):
+                        status = ScrubStatus.REPAIRED
+            self._results.append((status, block))
+
+    async def scrub(self, storages: Sequence[StorageBase], group_num: int = 16) -> List[Tuple[ScrubStatus, entity.Block]]:
+        """
+        Check all blocks placed in storages, group_num blocks with their duplicates at a time
+
+        Return status of every checked block
+        """
+        self._results = []
+        self._repairs = {}
+        self._targets = {}
+        balancer = None
+        if self._config.repair:
+            balancer = Balancer(storages)
+            try:
+                await balancer.update_capacity(self._session)
+            except exceptions.NoStorage as e:
+                logger.exception(e)
+                balancer = None
+
+        semaphore = asyncio.Semaphore(group_num)
+
+        async def scrub_group(group: List[entity.Block]) -> None:
+            try:
+                await self._scrub_group(group, balancer)
+            finally:
+                semaphore.release()
+
+        tasks = set()
+        blocks = await self._block_repo.get_all_blocks(storages)
+        for _, group in itertools.groupby(blocks, key=lambda block: (block.file.id, block.number)):
+            group = [block for block in group if block.storage]
+            await semaphore.acquire()
+            task = asyncio.create_task(scrub_group(group))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+        return self._results
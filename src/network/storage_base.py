@@ -1,15 +1,21 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
 from enum import Enum, auto
-from typing import Union, Tuple, Generator, Any, Iterator, Dict, List, Callable
+import hashlib
+from typing import TYPE_CHECKING, Union, Tuple, Generator, Any, Iterator, Dict, List, Callable, Optional, AsyncIterator
 
-import aiohttp
-from tqdm.asyncio import tqdm
 import entity
+import exceptions
+
+if TYPE_CHECKING:
+    # http client is imported by storages, catalog commands don't need it
+    import aiohttp
+    from tqdm.asyncio import tqdm
 
 
 class StorageType(Enum):
     YANDEX_DISK = 'yandex-disk'
+    S3 = 's3'
 
     def __str__(self):
         return self.value
@@ -36,6 +42,8 @@ class DownloadStatus(Enum):
 class DeleteStatus(Enum):
     OK = 'Ok'
     FAILED = 'Failed'
+    IN_PROGRESS = 'In Progress'
+    FILE_DOESNT_EXIST = 'File Doesn\'t Exist'
 
 
 @dataclass(kw_only=True)
@@ -52,29 +60,79 @@ class StorageBase(ABC):
         return self.used_space/self.total_space < other.used_space/other.total_space
 
     @abstractmethod
-    async def upload(self, filename: str, data: bytes, session: aiohttp.ClientSession) -> UploadStatus:
+    async def upload(self, filename: str, data: bytes, session: "aiohttp.ClientSession") -> UploadStatus:
         pass
 
     @abstractmethod
-    async def upload_by_chunks(self, filename: str, data: tqdm, session: aiohttp.ClientSession) -> UploadStatus:
+    async def upload_by_chunks(self, filename: str, data: "tqdm", session: "aiohttp.ClientSession") -> UploadStatus:
+        """
+        Upload file from iterable or async iterable of chunks
+        """
         pass
 
     @abstractmethod
-    async def download(self, filename: str, session: aiohttp.ClientSession) -> DownloadStatus:
+    async def download(self, filename: str, session: "aiohttp.ClientSession") -> DownloadStatus:
         pass
 
     @abstractmethod
-    async def download_by_chunks(self, filename: str, chunk_size: int, inc_progress: Callable[[], None], session: aiohttp.ClientSession) -> Tuple[DownloadStatus, bytes]:
+    async def download_by_chunks(self, filename: str, chunk_size: int, inc_progress: Callable[[], None], session: "aiohttp.ClientSession") -> Tuple[DownloadStatus, bytes]:
         pass
 
+    async def download_stream(self, filename: str, chunk_size: int,
+                              session: "aiohttp.ClientSession") -> AsyncIterator[bytes]:
+        """
+        Iterate over file content by chunks
+
+        Raise BlockDownloadFailed if file cannot be downloaded.
+        Storages supporting streaming should override it, by default whole file is downloaded
+        """
+        status, data = await self.download(filename, session)
+        if status != DownloadStatus.OK:
+            raise exceptions.BlockDownloadFailed(filename)
+        for offset in range(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+
+    async def stat(self, filename: str, session: "aiohttp.ClientSession") -> Tuple[DownloadStatus, Optional[entity.File]]:
+        """
+        Get size and md5 checksum (if storage knows it) of file without downloading it
+
+        Storages should override it, by default whole file is downloaded
+        """
+        status, data = await self.download(filename, session)
+        if status != DownloadStatus.OK:
+            return status, None
+        return status, entity.File(filename=filename, size=len(data), checksum=hashlib.md5(data).hexdigest())
+
+    async def download_range(self, filename: str, offset: int, length: int,
+                             session: "aiohttp.ClientSession") -> Tuple[DownloadStatus, bytes]:
+        """
+        Download length bytes of file starting from offset
+
+        Storages supporting ranged requests should override it, by default whole file is downloaded
+        """
+        status, data = await self.download(filename, session)
+        return status, data[offset:offset + length]
+
     @abstractmethod
-    async def size(self, session: aiohttp.ClientSession) -> Tuple[int, int]:
+    async def size(self, session: "aiohttp.ClientSession") -> Tuple[int, int]:
         pass
 
     @abstractmethod
-    async def delete(self, filename: str, session: aiohttp.ClientSession) -> DeleteStatus:
+    async def delete(self, filename: str, session: "aiohttp.ClientSession") -> DeleteStatus:
         pass
 
+    async def delete_async(self, filename: str, session: "aiohttp.ClientSession") -> Tuple[DeleteStatus, Optional[str]]:
+        """
+        Start deleting file without waiting for storage to finish it
+
+        Return DeleteStatus.IN_PROGRESS and operation id if storage deletes file in background.
+        Operation can be polled by operation_status
+        """
+        return await self.delete(filename, session), None
+
+    async def operation_status(self, operation: str, session: "aiohttp.ClientSession") -> DeleteStatus:
+        return DeleteStatus.OK
+
     @abstractmethod
-    async def files(self, session: aiohttp.ClientSession) -> Tuple[DownloadStatus, Tuple[entity.File]]:
+    async def files(self, session: "aiohttp.ClientSession") -> Tuple[DownloadStatus, Tuple[entity.File]]:
         pass
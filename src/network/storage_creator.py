@@ -1,9 +1,13 @@
 from .storage_base import StorageBase, StorageType
-from .yandex_disk import YandexDisk
 
 
 class StorageCreator:
     @staticmethod
     def create(storage_type: StorageType) -> StorageBase:
+        # storage modules import http client, so they are imported when storage is needed
         if storage_type == StorageType.YANDEX_DISK:
+            from .yandex_disk import YandexDisk
             return YandexDisk()
+        if storage_type == StorageType.S3:
+            from .s3 import S3
+            return S3()
@@ -1,7 +1,11 @@
 import asyncio
+import collections
+import contextlib
 import dataclasses
+import hashlib
 import math
-from typing import Iterator, Tuple, List, Sequence
+import time
+from typing import AsyncIterator, Dict, Iterator, Tuple, List, Sequence, Optional
 
 import aiohttp
 from loguru import logger
@@ -12,6 +16,7 @@ import exceptions
 import repository
 import utils
 from .balancer import Balancer
+from .scheduler import TransferScheduler
 from .storage_base import UploadStatus
 
 
@@ -34,16 +39,21 @@ class Uploader:
     def __init__(
         self,
         balancer: Balancer,
-        blocks_repo: repository.BlockRepo,
-        config: UploaderConfig,
+        blocks_repo: "repository.MetadataStore",
+        config: Optional[UploaderConfig] = None,
+        scheduler: Optional[TransferScheduler] = None,
     ):
+        config = config or UploaderConfig()
         self._balancer = balancer
         self._blocks_repo = blocks_repo
+        self._scheduler = scheduler  # shared with uploads of other files
         self._session = None
         self._progress: List[BlockProgress] = []
         self._chunk_size = config.chunk_size
         self._repeat_count = config.repeat_count  # number of upload attempts
         self._parallel_num = config.parallel_num  # number of simultaneous uploads
+        self._base: Dict[str, List[entity.Block]] = {}  # content hash -> blocks of base file
+        self._reused = 0
 
     async def _upload_block(
         self, block: entity.Block
@@ -60,30 +70,63 @@ class Uploader:
 
         return status, block
 
-    def _block_by_chunk(self, block: entity.Block) -> Iterator[bytes]:
+    def _block_by_chunk(self, block: entity.Block, checksum: "hashlib._Hash") -> Iterator[bytes]:
+        """
+        Iterate over block data by chunks encrypting them on the fly
+
+        checksum is updated by data sent to storage
+        """
+        encryptor = block.cipher.encryptor(bytes.fromhex(block.content_hash)) if block.cipher else None
+        progress = self._progress[
+            block.number * block.file.duplicate_count + block.duplicate_number
+        ]
+        progress.done = 0
+
         offset = 0
-        while offset < len(block.data) - self._chunk_size:
-            yield block.data[offset : offset + self._chunk_size]
-            self._progress[
-                block.number * block.file.duplicate_count + block.duplicate_number
-            ].done += 1
+        while offset < len(block.data):
+            chunk = block.data[offset : offset + self._chunk_size]
+            if encryptor:
+                chunk = encryptor.update(chunk)
+            if chunk:
+                checksum.update(chunk)
+                yield chunk
+            progress.done += 1
             offset += self._chunk_size
 
+        if encryptor:
+            chunk = encryptor.finalize()
+            checksum.update(chunk)
+            yield chunk
+
     async def _upload_block_by_chunks(
         self,
         block: entity.Block,
     ) -> Tuple[UploadStatus, entity.Block]:
-        if block.cipher:
-            block.data = block.cipher.encrypt(block.data)
-
-        data = tqdm(self._block_by_chunk(block), disable=True)
+        if block.data is None:
+            # the same data is already stored (see _deduplicate)
+            progress = self._progress[block.number * block.file.duplicate_count + block.duplicate_number]
+            progress.done = progress.total
+            logger.info(f"Reuse stored block: {block}")
+            return UploadStatus.OK, block
 
         for _ in range(self._repeat_count):
-            status = await block.storage.upload_by_chunks(
-                block.name, data, self._session
+            checksum = hashlib.md5()
+            data = tqdm(self._block_by_chunk(block, checksum), disable=True)
+            async with self._scheduler.slot() if self._scheduler else contextlib.nullcontext():
+                # time waiting for a slot isn't transfer time of storage
+                started = time.monotonic()
+                status = await block.storage.upload_by_chunks(
+                    block.name, data, self._session
+                )
+            self._balancer.record_upload(
+                block.storage,
+                len(block.data),
+                time.monotonic() - started,
+                status == UploadStatus.OK,
             )
 
             if status == UploadStatus.OK:
+                block.checksum = checksum.hexdigest()
                 logger.info(f"Upload block: {block}")
                 break
             else:
@@ -91,37 +134,118 @@ class Uploader:
 
         return status, block
 
-    def _block_generator(self, file: entity.File) -> Iterator[entity.Block]:
+    @staticmethod
+    def _read_block(block: entity.Block) -> bytes:
+        with open(block.file.path, "rb") as f:
+            f.seek(block.number * block.file.block_size)
+            return f.read(block.file.block_size)
+
+    def _block_generator(self, file: entity.File, hashes: Optional[Sequence[str]] = None) -> Iterator[List[entity.Block]]:
         """
-        Iterate over file by blocks without duplicates
+        Iterate over file by blocks, every block is a list of its duplicates
+
+        If content hashes of blocks are given, blocks with data in base file aren't read
         """
 
         with open(file.path, "rb") as f:
-            data = f.read(file.block_size)
             number = 0
-            while data:
-                blocks = [
-                    entity.Block(file=file, number=number, data=data, size=len(data))
-                    for _ in range(file.duplicate_count)
+            while number * file.block_size < file.size:
+                if hashes and hashes[number] in self._base:
+                    data = None
+                    size = min(file.block_size, file.size - number * file.block_size)
+                    content_hash = hashes[number]
+                else:
+                    f.seek(number * file.block_size)
+                    data = f.read(file.block_size)
+                    size = len(data)
+                    content_hash = hashlib.sha256(data).hexdigest()
+                yield [
+                    entity.Block(
+                        file=file,
+                        number=number,
+                        data=data,
+                        size=size,
+                        content_hash=content_hash,
+                        duplicate_number=duplicate_number,
+                    )
+                    for duplicate_number in range(file.duplicate_count)
                 ]
-                self._balancer.fill_blocks(blocks)
-                yield from blocks
-                data = f.read(file.block_size)
                 number += 1
 
     def _block_generator_and_filter(
-        self, file: entity.File, uploaded_blocks: Sequence[entity.Block]
-    ) -> Iterator[entity.Block]:
+        self, file: entity.File, uploaded_blocks: Sequence[entity.Block], hashes: Optional[Sequence[str]] = None
+    ) -> Iterator[List[entity.Block]]:
         """
         Iterate over file by blocks with duplicates and filter already uploaded
         """
-        block_generator = Uploader._block_generator(self, file)
-        for block in block_generator:
-            if block.number not in [block_.number for block_ in uploaded_blocks]:
+        uploaded_numbers = {block.number for block in uploaded_blocks}
+        for blocks in self._block_generator(file, hashes):
+            if blocks[0].number not in uploaded_numbers:
+                yield blocks
+
+    @staticmethod
+    def _cipher_type(block: entity.Block) -> Optional[str]:
+        return str(block.cipher.type) if block.cipher else None
+
+    async def _deduplicate(self, blocks: List[entity.Block]) -> List[entity.Block]:
+        """
+        Point duplicates of block to stored data with the same content (in different storages)
+
+        Data of the base file (previous version) is reused with its cipher. Other data is shared only
+        by plain and convergently encrypted blocks. Return blocks pointed to stored data, their data is dropped
+        """
+        block = blocks[0]
+        copies = [copy for copy in self._base.get(block.content_hash, ())
+                  if copy.size == block.size and self._cipher_type(copy) == self._cipher_type(block)]
+        if not block.cipher or block.cipher.convergent:
+            copies.extend(await self._blocks_repo.get_block_copies(block))
+
+        reused = []
+        storages = set()
+        for copy in copies:
+            if len(reused) == len(blocks):
+                break
+            if copy.storage.id in storages:
+                continue
+            duplicate = blocks[len(reused)]
+            duplicate.storage = copy.storage
+            duplicate.name = copy.name
+            duplicate.checksum = copy.checksum
+            duplicate.cipher = copy.cipher or duplicate.cipher
+            duplicate.data = None
+            storages.add(copy.storage.id)
+            reused.append(duplicate)
+
+        self._reused += len(reused)
+        return reused
+
+    async def _fill_blocks(self, block_generator: Iterator[List[entity.Block]]) -> AsyncIterator[entity.Block]:
+        """
+        Assign storages to duplicates of every block, reusing already stored data where possible
+        """
+        for blocks in block_generator:
+            self._balancer.fill_ciphers(blocks)
+            reused = await self._deduplicate(blocks)
+            if len(reused) < len(blocks):
+                if blocks[-1].data is None:
+                    # block expected in base file is read only if it can't be reused
+                    data = self._read_block(blocks[0])
+                    for block in blocks[len(reused):]:
+                        block.data = data
+                self._balancer.fill_blocks(blocks[len(reused):], exclude={block.storage.id for block in reused})
+            for block in blocks:
                 yield block
 
+    async def _save_blocks(self, blocks: List[entity.Block]) -> None:
+        """
+        Add uploaded blocks to repository by one statement and commit
+        """
+        if blocks:
+            await self._blocks_repo.add_blocks(blocks)
+        await self._blocks_repo.commit()
+
     async def _upload_blocks(
-        self, blocks: Iterator[entity.Block]
+        self, blocks: AsyncIterator[entity.Block]
     ) -> List[Tuple[UploadStatus, entity.Block]]:
         """
         Upload parallel_num blocks simultaneously
@@ -132,19 +256,19 @@ class Uploader:
         upload_tasks: List[asyncio.Task] = []
         db_tasks: List[asyncio.Task] = []
         failed = []
-        first = True
+        exhausted = False
         totally_failed = []
 
-        while first or upload_tasks or db_tasks:
-            first = False
+        # reused blocks finish at once, so all tasks can be done while blocks are left
+        while not exhausted or upload_tasks or db_tasks:
             try:
                 for _ in range(self._parallel_num - len(upload_tasks)):
-                    block = next(blocks)
+                    block = await anext(blocks)
                     upload_tasks.append(
                         asyncio.create_task(self._upload_block_by_chunks(block))
                     )
-            except StopIteration:
-                pass
+            except StopAsyncIteration:
+                exhausted = True
 
             logger.trace(f"Upload tasks: {upload_tasks}")
             logger.trace(f"DB tasks: {db_tasks}")
@@ -157,17 +281,16 @@ class Uploader:
                 upload_tasks = list(pending)
                 done_tasks: List[asyncio.Task] = list(done)
 
+                uploaded = []
                 for task in done_tasks:
                     status, block = task.result()
 
                     if status == UploadStatus.OK:
-                        db_tasks.append(
-                            asyncio.create_task(self._blocks_repo.add_block(block))
-                        )
+                        uploaded.append(block)
                     else:
                         failed.append(self._upload_block_by_chunks(block))
                         logger.error(f"Cannot load block {block}")
-                db_tasks.append(asyncio.create_task(self._blocks_repo.commit()))
+                db_tasks.append(asyncio.create_task(self._save_blocks(uploaded)))
 
             if db_tasks:
                 await asyncio.wait(db_tasks, return_when=asyncio.ALL_COMPLETED)
@@ -178,17 +301,14 @@ class Uploader:
             done, _ = await asyncio.wait(failed, return_when=asyncio.ALL_COMPLETED)
             done: List[asyncio.Task] = list(done)
 
+            uploaded = []
             for task in done:
                 status, block = task.result()
                 if status == UploadStatus.OK:
-                    db_tasks.append(
-                        asyncio.create_task(self._blocks_repo.add_block(block))
-                    )
+                    uploaded.append(block)
                 else:
                     totally_failed.append((status, block))
-        if db_tasks:
-            await asyncio.gather(*db_tasks)
-        await self._blocks_repo.commit()
+            await self._save_blocks(uploaded)
         return totally_failed
 
     def _init_progress(self, file: entity.File):
@@ -208,20 +328,30 @@ class Uploader:
             for i in range(block_count)
         ]
 
-        for i in range(file.duplicate_count):
+        for i in range(min(file.duplicate_count, len(self._progress))):
             self._progress[-i - 1].total = math.ceil(
                 (file.size % file.block_size) / self._chunk_size
             )
 
     async def upload_file(
-        self, file: entity.File
+        self, file: entity.File, base: Optional[entity.File] = None, hashes: Optional[Sequence[str]] = None
     ) -> List[Tuple[UploadStatus, entity.Block]]:
         """
         Return list of files not uploaded to storage (if empty then everything is ok)
 
+        Blocks with the same content as blocks of base file (previous version) aren't uploaded,
+        the new blocks point to the stored data. If content hashes of blocks are computed beforehand
+        (see utils.block_hashes), such blocks aren't even read.
         Raise FileAlreadyExists if file.filename already exists in repository
         """
-        file.checksum = utils.sha1_checksum(file.path)
+        self._base = collections.defaultdict(list)
+        self._reused = 0
+        if base:
+            for block in await self._blocks_repo.get_blocks_by_file(base):
+                if block.content_hash:
+                    self._base[block.content_hash].append(block)
+
+        file.checksum = await asyncio.to_thread(utils.sha1_checksum, file.path)
         uploaded_blocks = []
         try:
             db_file = await self._blocks_repo.get_file_by_filename(file.filename)
@@ -235,13 +365,13 @@ class Uploader:
             uploaded_blocks = await self._blocks_repo.get_blocks_by_file(file)
 
         if uploaded_blocks:
-            blocks = self._block_generator_and_filter(file, uploaded_blocks)
+            blocks = self._block_generator_and_filter(file, uploaded_blocks, hashes)
         else:
-            blocks = self._block_generator(file)
+            blocks = self._block_generator(file, hashes)
 
         self._init_progress(file)
 
-        unloaded_blocks = await self._upload_blocks(blocks)
+        unloaded_blocks = await self._upload_blocks(self._fill_blocks(blocks))
         if unloaded_blocks:
             logger.error(
                 f"Failed to upload file {file}: Can't upload blocks: {uploaded_blocks}"
@@ -255,9 +385,17 @@ class Uploader:
     def progress(self) -> List[BlockProgress]:
         return self._progress
 
+    @property
+    def reused(self) -> int:
+        """
+        Number of blocks of the last file pointed to stored data instead of upload
+        """
+        return self._reused
+
     async def __aenter__(self) -> "Uploader":
-        self._session = aiohttp.ClientSession()
+        self._session = self._scheduler.session if self._scheduler else aiohttp.ClientSession()
         return self
 
     async def __aexit__(self, *args):
-        await self._session.close()
+        if not self._scheduler:
+            await self._session.close()
@@ -1,14 +1,19 @@
-from typing import Tuple, Callable
+import asyncio
+from typing import Tuple, Callable, Optional, AsyncIterator
 
 import aiohttp
 from loguru import logger
 from tqdm.asyncio import tqdm
 
+import exceptions
 from entity import File
 from network.storage_base import StorageBase, DownloadStatus, UploadStatus, StorageType, DeleteStatus
 
 
 class YandexDisk(StorageBase):
+    poll_period: float = 0.5  # seconds between polls of async operation status
+    poll_timeout: float = 10 * 60  # seconds to wait for async operation (the same as Deleter waits)
+
     def __init__(self):
         super(YandexDisk, self).__init__()
         self.type = StorageType.YANDEX_DISK
@@ -155,7 +160,104 @@ class YandexDisk(StorageBase):
 
         return DownloadStatus.OK, data
 
-    async def size(self, session: aiohttp.ClientSession) -> Tuple[DownloadStatus, Tuple[int, int]]:
+    async def download_stream(self, filename: str, chunk_size: int,
+                              session: aiohttp.ClientSession) -> AsyncIterator[bytes]:
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': f'OAuth {self.token}'
+        }
+
+        params = {
+            'path': filename
+        }
+        try:
+            async with session.get('https://cloud-api.yandex.net/v1/disk/resources/download', headers=headers,
+                                   params=params) as resp:
+                if resp.status == 200:
+                    json_data = await resp.json()
+                    download_url = json_data.get('href', '')
+                else:
+                    logger.error(f"Bad download response. Code: {resp.status}")
+                    raise exceptions.BlockDownloadFailed(filename)
+
+            async with session.get(download_url) as resp:
+                if resp.status != 200:
+                    logger.error(f"Failed to download file. Code: {resp.status}")
+                    raise exceptions.BlockDownloadFailed(filename)
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    yield chunk
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            raise exceptions.BlockDownloadFailed(filename) from e
+
+    async def stat(self, filename: str, session: aiohttp.ClientSession) -> Tuple[DownloadStatus, Optional[File]]:
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': f'OAuth {self.token}'
+        }
+
+        params = {
+            'path': filename,
+            'fields': 'name,size,md5'
+        }
+        try:
+            async with session.get('https://cloud-api.yandex.net/v1/disk/resources', headers=headers,
+                                   params=params) as resp:
+                if resp.status == 200:
+                    json_data = await resp.json()
+                    return DownloadStatus.OK, File(filename=json_data['name'],
+                                                   size=json_data['size'],
+                                                   checksum=json_data.get('md5', ''))
+                elif resp.status == 404:
+                    return DownloadStatus.FILE_DOESNT_EXITS, None
+                else:
+                    logger.error(f"Bad response. Code: {resp.status}")
+                    return DownloadStatus.FAILED, None
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            return DownloadStatus.FAILED, None
+
+    async def download_range(self, filename: str, offset: int, length: int,
+                             session: aiohttp.ClientSession) -> Tuple[DownloadStatus, bytes]:
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': f'OAuth {self.token}'
+        }
+
+        params = {
+            'path': filename
+        }
+        try:
+            async with session.get('https://cloud-api.yandex.net/v1/disk/resources/download', headers=headers,
+                                   params=params) as resp:
+                if resp.status == 200:
+                    json_data = await resp.json()
+                    download_url = json_data.get('href', '')
+                else:
+                    logger.error(f"Bad download response. Code: {resp.status}")
+                    return DownloadStatus.FAILED, bytes()
+
+            range_headers = {
+                'Range': f'bytes={offset}-{offset + length - 1}'
+            }
+            async with session.get(download_url, headers=range_headers) as resp:
+                if resp.status == 206:
+                    content = await resp.read()
+                elif resp.status == 200:
+                    content = (await resp.read())[offset:offset + length]
+                else:
+                    logger.error(f"Failed to download file range. Code: {resp.status}")
+                    return DownloadStatus.FAILED, bytes()
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            return DownloadStatus.FAILED, bytes()
+
+        return DownloadStatus.OK, content
+
+    async def size(self, session: aiohttp.ClientSession) -> Tuple[int, int]:
         headers = {
             'Content-Type': 'application/json',
             'Accept': 'application/json',
@@ -174,12 +276,26 @@ class YandexDisk(StorageBase):
                     return json_data['used_space'], json_data['total_space']
                 else:
                     logger.error(f"Bad response. Code: {resp.status}")
-                    return DownloadStatus.FAILED, (0, 0)
+                    return 0, 0
         except aiohttp.ClientConnectionError as e:
             logger.exception(e)
-            return DownloadStatus.FAILED, (0, 0)
+            return 0, 0
 
     async def delete(self, filename: str, session: aiohttp.ClientSession) -> DeleteStatus:
+        status, operation = await self.delete_async(filename, session)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.poll_timeout
+        while status == DeleteStatus.IN_PROGRESS:
+            if loop.time() >= deadline:
+                logger.error(f"Operation {operation} for {filename} timed out")
+                return DeleteStatus.FAILED
+            await asyncio.sleep(self.poll_period)
+            status = await self.operation_status(operation, session)
+
+        return status
+
+    async def delete_async(self, filename: str, session: aiohttp.ClientSession) -> Tuple[DeleteStatus, Optional[str]]:
         headers = {
             'Content-Type': 'application/json',
             'Accept': 'application/json',
@@ -195,8 +311,38 @@ class YandexDisk(StorageBase):
         try:
             async with session.delete('https://cloud-api.yandex.net/v1/disk/resources', headers=headers,
                                       params=params) as resp:
-                if resp.status in (202, 204):
-                    return DeleteStatus.OK
+                if resp.status == 202:
+                    json_data = await resp.json()
+                    return DeleteStatus.IN_PROGRESS, json_data.get('href', '')
+                elif resp.status == 204:
+                    return DeleteStatus.OK, None
+                elif resp.status == 404:
+                    return DeleteStatus.FILE_DOESNT_EXIST, None
+                else:
+                    logger.error(f"Bad response. Code: {resp.status}")
+                    return DeleteStatus.FAILED, None
+        except aiohttp.ClientConnectionError as e:
+            logger.exception(e)
+            return DeleteStatus.FAILED, None
+
+    async def operation_status(self, operation: str, session: aiohttp.ClientSession) -> DeleteStatus:
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': f'OAuth {self.token}'
+        }
+
+        try:
+            async with session.get(operation, headers=headers) as resp:
+                if resp.status == 200:
+                    json_data = await resp.json()
+                    status = json_data.get('status')
+                    if status == 'success':
+                        return DeleteStatus.OK
+                    elif status == 'in-progress':
+                        return DeleteStatus.IN_PROGRESS
+                    logger.error(f"Operation {operation} failed: {status}")
+                    return DeleteStatus.FAILED
                 else:
                     logger.error(f"Bad response. Code: {resp.status}")
                     return DeleteStatus.FAILED
@@ -223,7 +369,8 @@ class YandexDisk(StorageBase):
                     json_data = await resp.json()
                     for file in json_data['items']:
                         files.append(
-                                File(filename=file['name'], size=file['size'])
+                                # all files of disk are listed, path locates files in directories
+                                File(filename=file['name'], path=file['path'], size=file['size'])
                         )
                 else:
                     logger.error(f"Bad response. Code: {resp.status}")
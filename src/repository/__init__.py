@@ -1 +1,6 @@
-from .block_repo import BlockRepo
\ No newline at end of file
+from .metadata_store import MetadataStore, StoreType
+from .block_repo import BlockRepo
+from .sharded_repo import ShardedRepo
+from .store_creator import StoreCreator
+from .store_copy import copy_store
+from .snapshot import export_snapshot, import_snapshot
@@ -1,21 +1,75 @@
+import asyncio
+import functools
+import itertools
+import pathlib
+import weakref
 from abc import ABC, abstractmethod
-from typing import Generator
+from typing import Any, Generator, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
 
 import aiosqlite
 
 
 class AbstractRepo(ABC):
+    # schema changes applied after _create_tables, index + 1 is stored in PRAGMA user_version
+    migrations: Tuple[str, ...] = ()
+    # applied to every connection. WAL lets readers work while blocks are written,
+    # synchronous = NORMAL is safe in WAL mode (the last transactions can be lost on power failure only)
+    pragmas: Tuple[Tuple[str, Union[int, str]], ...] = (
+        ("foreign_keys", "ON"),
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),
+        ("cache_size", -64 * 2 ** 10),  # KiB
+        ("mmap_size", 256 * 2 ** 20),
+        ("temp_store", "MEMORY"),
+    )
+    # read-only connections executing SELECT in their own threads while writer is busy (WAL mode only)
+    reader_num: int = 4
+    reader_pragmas: Tuple[Tuple[str, Union[int, str]], ...] = (
+        ("query_only", "ON"),
+        ("cache_size", -16 * 2 ** 10),  # KiB
+        ("mmap_size", 256 * 2 ** 20),
+        ("temp_store", "MEMORY"),
+    )
+    # rows are accessed by column name, plain tuples are cheaper for big scans
+    row_factory: Optional[type] = aiosqlite.Row
+
     def __init__(self, database: str):
         self.database = database
         self._conn: aiosqlite.Connection = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._next_reader = None
+        self._writing_tasks = weakref.WeakSet()  # tasks which changed data after the last commit
+
+    async def _connect(self, database: str, pragmas: Sequence[Tuple[str, Union[int, str]]],
+                       uri: bool = False) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(database, uri=uri)
+        conn.row_factory = self.row_factory
+        for name, value in pragmas:
+            await conn.execute(f"PRAGMA {name} = {value}")
+        return conn
 
     async def _ainit(self) -> "AbstractRepo":
-        self._conn = await aiosqlite.connect(self.database)
-        self._conn.row_factory = aiosqlite.Row
-        await self._conn.execute("PRAGMA foreign_keys = ON")
-        await self._create_tables()
+        self._conn = await self._connect(self.database, self.pragmas)
+        # all migrations are applied only after tables are created, so current schema needs no DDL
+        if not self.migrations or await self._schema_version() != len(self.migrations):
+            await self._create_tables()
+            await self._migrate()
+        await self._open_readers()
         return self
 
+    async def _open_readers(self) -> None:
+        """
+        Open reader connections if database is a file in WAL mode
+        (otherwise readers would wait for writer or see another database)
+        """
+        cur = await self._conn.execute("PRAGMA journal_mode")
+        if self.database == ":memory:" or (await cur.fetchone())[0].lower() != "wal":
+            return
+
+        uri = pathlib.Path(self.database).absolute().as_uri() + "?mode=ro"
+        self._readers = [await self._connect(uri, self.reader_pragmas, uri=True) for _ in range(self.reader_num)]
+        self._next_reader = itertools.cycle(self._readers)
+
     def __await__(self) -> Generator[None, None, "AbstractRepo"]:
         return self._ainit().__await__()
 
@@ -23,48 +77,115 @@ class AbstractRepo(ABC):
     async def _create_tables(self) -> None:
         pass
 
-    async def add_row(self, table: str, row_data: dict, replace=False) -> aiosqlite.Cursor:
+    async def _schema_version(self) -> int:
+        cur = await self.execute("PRAGMA user_version")
+        return (await cur.fetchone())[0]
+
+    async def _migrate(self) -> None:
         """
-        Add data from dictionary to table
+        Apply migrations which are not applied yet
+        """
+        version = await self._schema_version()
+        for number, sql in enumerate(self.migrations[version:], version + 1):
+            await self.executescript(f"BEGIN; {sql}; PRAGMA user_version = {number}; COMMIT;")
+
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _insert_sql(table: str, columns: Tuple[str, ...], replace: bool = False,
+                    conflict: Optional[Tuple[str, ...]] = None) -> str:
+        """
+        Build parameterized insert, the same text for the same columns, so sqlite reuses prepared statement
 
-        :param table: название таблицы
-        :param row_data: словарь с полями таблицы
-        :param replace:
-        :return:
+        :param conflict: columns of unique constraint, other columns are updated if row already exists
         """
         clause = "INSERT OR REPLACE INTO" if replace else "INSERT INTO"
-        keys = ','.join(row_data.keys())
-        for row in row_data:
-            if row_data[row] is None:
-                row_data[row] = "NULL"
-            else:
-                row_data[row] = repr(row_data[row])
+        sql = f"{clause} {table}({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        if conflict:
+            updates = [f"{column} = excluded.{column}" for column in columns if column not in conflict]
+            sql += f" ON CONFLICT({', '.join(conflict)}) " + \
+                   (f"DO UPDATE SET {', '.join(updates)}" if updates else "DO NOTHING")
+        return sql
+
+    async def add_row(self, table: str, row_data: Mapping[str, Any], replace: bool = False) -> aiosqlite.Cursor:
+        """
+        Add data from dictionary to table
 
-        values = ','.join([row_data[x] for x in row_data])
-        sql = f"{clause} {table}({keys}) VALUES ({values})"
+        :param table: table name
+        :param row_data: column name -> value
+        :param replace: replace row having the same unique values
+        """
+        return await self.execute(self._insert_sql(table, tuple(row_data), replace), tuple(row_data.values()))
+
+    async def add_rows(self, table: str, columns: Sequence[str], rows: Iterable[Sequence[Any]],
+                       replace: bool = False) -> aiosqlite.Cursor:
+        """
+        Add rows by one statement executed for every row
+
+        Rows are consumed lazily, so they can be generated while inserted
+        """
+        return await self.executemany(self._insert_sql(table, tuple(columns), replace), rows)
+
+    async def upsert_row(self, table: str, row_data: Mapping[str, Any], conflict: Sequence[str]) -> aiosqlite.Cursor:
+        """
+        Add row or update existing one having the same values of conflict columns (unique constraint)
+        """
+        return await self.execute(self._insert_sql(table, tuple(row_data), conflict=tuple(conflict)),
+                                  tuple(row_data.values()))
+
+    async def upsert_rows(self, table: str, columns: Sequence[str], rows: Iterable[Sequence[Any]],
+                          conflict: Sequence[str]) -> aiosqlite.Cursor:
+        return await self.executemany(self._insert_sql(table, tuple(columns), conflict=tuple(conflict)), rows)
 
-        return await self.execute(sql)
+    def _connection(self, sql: str) -> aiosqlite.Connection:
+        """
+        Choose connection for statement
 
-    async def execute(self, sql: str, params: tuple = ()) -> aiosqlite.Cursor:
+        SELECT goes to readers by turn unless current task has uncommitted changes, which only writer sees.
+        Other tasks read the last committed data without waiting for writer
+        """
+        task = asyncio.current_task()
+        if sql.lstrip()[:6].upper() != "SELECT":
+            self._writing_tasks.add(task)
+            return self._conn
+        if self._readers and task not in self._writing_tasks:
+            return next(self._next_reader)
+        return self._conn
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> aiosqlite.Cursor:
         """
         Execute sql statement
         :param sql: SQL statement
         :param params:
         :return: cursor
         """
-        return await self._conn.execute(sql, params)
+        return await self._connection(sql).execute(sql, params)
 
-    async def executemany(self, sql: str, params: tuple) -> aiosqlite.Cursor:
-        return await self._conn.executemany(sql, params)
+    async def executemany(self, sql: str, params: Iterable[Sequence[Any]]) -> aiosqlite.Cursor:
+        return await self._connection(sql).executemany(sql, params)
 
     async def executescript(self, sql_script: str) -> aiosqlite.Cursor:
-        return await self._conn.executescript(sql_script)
+        return await self._connection(sql_script).executescript(sql_script)
 
     async def commit(self) -> None:
-        await self._conn.commit()
+        # tasks writing while commit is awaited are queued after it, so they stay in the new set
+        tasks, self._writing_tasks = self._writing_tasks, weakref.WeakSet()
+        try:
+            await self._conn.commit()
+        except BaseException:
+            self._writing_tasks.update(tasks)
+            raise
 
     async def close(self):
+        for reader in self._readers:
+            try:
+                await reader.close()
+            except Exception:
+                pass
+        self._readers = []
+
         try:
+            # update statistics of query planner if it needs them
+            await self._conn.execute("PRAGMA optimize")
             await self._conn.close()
         except Exception:
             pass
@@ -1,21 +1,125 @@
-from typing import Tuple, Generator, List
+from typing import AsyncIterator, Tuple, Generator, List, Iterable, Sequence, Dict, Optional
+
+import collections
 
 import aiosqlite
 from loguru import logger
 
 import entity
 import exceptions
-from crypto.aes import Aes
-from entity import Block, File, Key
+from crypto import CipherBase, CipherType
+from crypto.cipher_creator import CipherCreator
+from entity import Block, Directory, File, Key
 from network.storage_base import StorageBase, StorageType
 from network.storage_creator import StorageCreator
 from repository.abstract_repo import AbstractRepo
+from repository.metadata_store import MetadataStore, StoreType
+
+
+class BlockRepo(AbstractRepo, MetadataStore):
+    type = StoreType.SQLITE
+    migrations = (
+        # md5 of block data stored in storage (after encryption)
+        "ALTER TABLE block ADD COLUMN checksum STRING",
+        # type of cipher, NULL for blocks encrypted by Aes before the column was added
+        "ALTER TABLE block ADD COLUMN cipher STRING",
+        # sha256 of plain data, blocks with the same content can share data in storage
+        "ALTER TABLE block ADD COLUMN content_hash STRING",
+        "CREATE INDEX IF NOT EXISTS block_content_hash ON block(content_hash)",
+        # blocks of file in order and storages of duplicates without reading the table
+        "CREATE INDEX IF NOT EXISTS block_file_number ON block(file_id, number, storage_id)",
+        # deletion by name and blocks sharing data
+        "CREATE INDEX IF NOT EXISTS block_name ON block(name, storage_id)",
+        # blocks of storage biggest first, also used by foreign key check on storage deletion
+        "CREATE INDEX IF NOT EXISTS block_storage_size ON block(storage_id, size)",
+        "ANALYZE",
+        # directory of file (up to the last '/') and files of directory by name
+        "ALTER TABLE file ADD COLUMN directory TEXT "
+        "GENERATED ALWAYS AS (rtrim(filename, replace(filename, '/', ''))) VIRTUAL; "
+        "CREATE INDEX IF NOT EXISTS file_directory ON file(directory, filename)",
+        # total size and number of files of every directory kept by triggers,
+        # changes of directory are added to its parent up to the root ('')
+        """CREATE TABLE IF NOT EXISTS directory(
+        path TEXT PRIMARY KEY,
+        parent TEXT GENERATED ALWAYS AS (CASE WHEN path = '' THEN NULL ELSE
+            rtrim(substr(path, 1, length(path) - 1), replace(substr(path, 1, length(path) - 1), '/', '')) END) VIRTUAL,
+        size INTEGER NOT NULL,
+        file_count INTEGER NOT NULL) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS directory_parent ON directory(parent, path);
+
+        CREATE TRIGGER IF NOT EXISTS directory_insert AFTER INSERT ON directory WHEN new.parent IS NOT NULL BEGIN
+            INSERT INTO directory(path, size, file_count) VALUES (new.parent, new.size, new.file_count)
+            ON CONFLICT(path) DO UPDATE SET size = size + excluded.size, file_count = file_count + excluded.file_count;
+        END;
+        CREATE TRIGGER IF NOT EXISTS directory_update AFTER UPDATE OF size, file_count ON directory
+        WHEN new.parent IS NOT NULL BEGIN
+            UPDATE directory SET size = size + new.size - old.size, file_count = file_count + new.file_count - old.file_count
+            WHERE path = new.parent;
+        END;
+        CREATE TRIGGER IF NOT EXISTS directory_empty AFTER UPDATE OF file_count ON directory
+        WHEN new.file_count = 0 AND new.path != '' BEGIN
+            DELETE FROM directory WHERE path = new.path;
+        END;
+        CREATE TRIGGER IF NOT EXISTS file_insert AFTER INSERT ON file BEGIN
+            INSERT INTO directory(path, size, file_count) VALUES (new.directory, new.size, 1)
+            ON CONFLICT(path) DO UPDATE SET size = size + excluded.size, file_count = file_count + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS file_delete AFTER DELETE ON file BEGIN
+            UPDATE directory SET size = size - old.size, file_count = file_count - 1 WHERE path = old.directory;
+        END;
+        CREATE TRIGGER IF NOT EXISTS file_update AFTER UPDATE OF filename, size ON file BEGIN
+            INSERT INTO directory(path, size, file_count) VALUES (new.directory, new.size, 1)
+            ON CONFLICT(path) DO UPDATE SET size = size + excluded.size, file_count = file_count + 1;
+            UPDATE directory SET size = size - old.size, file_count = file_count - 1 WHERE path = old.directory;
+        END;
+
+        INSERT INTO directory(path, size, file_count)
+        SELECT directory, sum(size), count(*) FROM file WHERE true GROUP BY directory
+        ON CONFLICT(path) DO UPDATE SET size = size + excluded.size, file_count = file_count + excluded.file_count""",
+    )
+    # directory triggers update parent directory by the same triggers
+    pragmas = AbstractRepo.pragmas + (("recursive_triggers", "ON"),)
+
+    def __init__(self, database: str):
+        super(BlockRepo, self).__init__(database)
+        # identity maps, so every storage and cipher is created once and shared by all blocks
+        self._storages: Dict[int, StorageBase] = {}
+        self._ciphers: Dict[Tuple[int, CipherType], CipherBase] = {}
 
-
-class BlockRepo(AbstractRepo):
     def __await__(self) -> Generator[None, None, "BlockRepo"]:
         return self._ainit().__await__()
 
+    def _storage(self, id_: int, type_: str, token: str) -> StorageBase:
+        storage = self._storages.get(id_)
+        if not storage:
+            storage = StorageCreator.create(StorageType.from_str(type_))
+            storage.id = id_
+            storage.token = token
+            self._storages[id_] = storage
+        return storage
+
+    def _cipher(self, key_id: Optional[int], key: Optional[str], cipher_type: Optional[str]) -> Optional[CipherBase]:
+        """
+        Get cipher of block (None for unencrypted block)
+
+        NULL cipher type means Aes used before the type was stored
+        """
+        if key_id is None:
+            return None
+
+        type_ = CipherType.from_str(cipher_type) if cipher_type else CipherType.AES
+        cipher = self._ciphers.get((key_id, type_))
+        if not cipher:
+            cipher = CipherCreator.create(type_, Key(id=key_id, key=key))
+            self._ciphers[(key_id, type_)] = cipher
+        return cipher
+
+    async def get_ciphers(self, cipher_type: CipherType) -> Tuple[CipherBase]:
+        """
+        Get ciphers of given type for all keys
+        """
+        return tuple(self._cipher(key.id, key.key, str(cipher_type)) for key in await self.get_keys())
+
 
     async def _create_tables(self) -> None:
         await self.execute("""CREATE TABLE IF NOT EXISTS storage(
@@ -51,26 +155,41 @@ class BlockRepo(AbstractRepo):
         FOREIGN KEY (file_id) REFERENCES file(id));
         """)
 
+    _block_columns = ('key_id', 'storage_id', 'file_id', 'name', 'number', 'size', 'checksum', 'cipher',
+                      'content_hash')
+
+    @staticmethod
+    def _block_row(block: Block) -> tuple:
+        key_id = block.cipher.key().id if block.cipher else None
+        cipher_type = str(block.cipher.type) if block.cipher else None
+        return (key_id, block.storage.id, block.file.id, block.name, block.number, block.size, block.checksum,
+                cipher_type, block.content_hash or None)
+
     async def add_block(self, block: Block) -> None:
-        key_id = None
         logger.info(block)
-
-        if block.cipher:
-            key_id = block.cipher.key().id
-        cur = await self.add_row('block', {
-            'key_id': key_id,
-            'storage_id': block.storage.id,
-            'file_id': block.file.id,
-            'name': block.name,
-            'number': block.number,
-            'size': block.size,
-        })
+        cur = await self.add_row('block', dict(zip(self._block_columns, self._block_row(block))))
         block.id = cur.lastrowid
-        logger.info(block.file)
-        cur = await self.execute('UPDATE file '
-                                 'SET uploaded_blocks = uploaded_blocks + 1 '
-                                 'WHERE id = ?', (block.file.id,))
+        await self.execute('UPDATE file '
+                           'SET uploaded_blocks = uploaded_blocks + 1 '
+                           'WHERE id = ?', (block.file.id,))
+
+    async def add_blocks(self, blocks: Iterable[Block]) -> None:
+        """
+        Add blocks by one statement and count them in uploaded_blocks of their files
+
+        Ids of blocks aren't set
+        """
+        counts = collections.Counter()
 
+        def rows():
+            for block in blocks:
+                counts[block.file.id] += 1
+                yield self._block_row(block)
+
+        await self.add_rows('block', self._block_columns, rows())
+        await self.executemany('UPDATE file '
+                               'SET uploaded_blocks = uploaded_blocks + ? '
+                               'WHERE id = ?', [(count, file_id) for file_id, count in counts.items()])
 
     async def add_storage(self, disk: StorageBase) -> None:
         await self.add_row('storage', {
@@ -104,11 +223,7 @@ class BlockRepo(AbstractRepo):
 
         disks = []
         async for row in cur:
-            type_ = StorageType.from_str(row['type'])
-            storage = StorageCreator.create(type_)
-            storage.id = row['id']
-            storage.token = row['token']
-            disks.append(storage)
+            disks.append(self._storage(row['id'], row['type'], row['token']))
         return tuple(disks)
 
     async def get_token(self, disk: StorageBase) -> StorageBase:
@@ -139,6 +254,56 @@ class BlockRepo(AbstractRepo):
         file.checksum = row['checksum']
         return file
 
+    @staticmethod
+    def _file(row: aiosqlite.Row) -> File:
+        return File(id=row['id'],
+                    filename=row['filename'],
+                    size=row['size'],
+                    uploaded_blocks=row['uploaded_blocks'],
+                    total_blocks=row['total_blocks'],
+                    checksum=row['checksum'])
+
+    async def get_directory(self, path: str) -> Directory:
+        cur = await self.execute('SELECT path, size, file_count '
+                                 'FROM directory '
+                                 'WHERE path = ?', (path,))
+        row = await cur.fetchone()
+        if not row:
+            raise exceptions.UnknownDirectory()
+        return Directory(path=row['path'], size=row['size'], file_count=row['file_count'])
+
+    async def get_subdirectories(self, path: str, after: str = "", limit: int = -1) -> Tuple[Directory]:
+        cur = await self.execute('SELECT path, size, file_count '
+                                 'FROM directory '
+                                 'WHERE parent = ? AND path > ? '
+                                 'ORDER BY path '
+                                 'LIMIT ?', (path, after, limit))
+        return tuple(Directory(path=row['path'], size=row['size'], file_count=row['file_count'])
+                     for row in await cur.fetchall())
+
+    async def get_files_by_directory(self, path: str, after: str = "", limit: int = -1) -> Tuple[File]:
+        cur = await self.execute('SELECT id, filename, size, uploaded_blocks, total_blocks, checksum '
+                                 'FROM file '
+                                 'WHERE directory = ? AND filename > ? '
+                                 'ORDER BY filename '
+                                 'LIMIT ?', (path, after, limit))
+        return tuple(self._file(row) for row in await cur.fetchall())
+
+    async def get_files_by_range(self, start: str, end: Optional[str] = None, limit: int = -1) -> Tuple[File]:
+        if end is None:
+            cur = await self.execute('SELECT id, filename, size, uploaded_blocks, total_blocks, checksum '
+                                     'FROM file '
+                                     'WHERE filename >= ? '
+                                     'ORDER BY filename '
+                                     'LIMIT ?', (start, limit))
+        else:
+            cur = await self.execute('SELECT id, filename, size, uploaded_blocks, total_blocks, checksum '
+                                     'FROM file '
+                                     'WHERE filename >= ? AND filename < ? '
+                                     'ORDER BY filename '
+                                     'LIMIT ?', (start, end, limit))
+        return tuple(self._file(row) for row in await cur.fetchall())
+
     async def get_blocks_by_file(self, file: File) -> Tuple[Block]:
         query = """
         SELECT
@@ -149,7 +314,11 @@ class BlockRepo(AbstractRepo):
             token,
             "key",
             key_id,
-            storage_id
+            cipher,
+            storage_id,
+            size,
+            checksum,
+            content_hash
         FROM
             block b
             JOIN storage s ON b.storage_id = s.id
@@ -162,14 +331,14 @@ class BlockRepo(AbstractRepo):
         cur = await self.execute(query, (file.id,))
         blocks = []
         async for row in cur:
-            type_ = StorageType.from_str(row['type'])
-            storage = StorageCreator.create(type_)
-            storage.token = row['token']
-            key = Key(id=row['key_id'], key=str(row['key']))
-            cipher = Aes(key)
+            storage = self._storage(row['storage_id'], row['type'], row['token'])
+            cipher = self._cipher(row['key_id'], row['key'], row['cipher'])
             blocks.append(Block(number=row['number'],
                                 name=row['name'],
                                 id=row['id'],
+                                size=row['size'],
+                                checksum=row['checksum'] or "",
+                                content_hash=row['content_hash'] or "",
                                 storage=storage,
                                 cipher=cipher,
                                 file=file
@@ -186,17 +355,132 @@ class BlockRepo(AbstractRepo):
         if not row:
             raise exceptions.UnknownStorage()
 
-        type_ = StorageType.from_str(row['type'])
-        storage = StorageCreator.create(type_)
-        storage.id = row['id']
-        storage.token = row['token']
-
-        return storage
+        return self._storage(row['id'], row['type'], row['token'])
 
     async def del_block(self, block: Block):
         cur = await self.execute('DELETE FROM block '
                                  'WHERE name = ?', (block.name,))
 
+    async def get_blocks_by_storage(self, storage: StorageBase) -> Tuple[Block]:
+        """
+        Get blocks placed in storage without ciphers (biggest blocks first)
+        """
+        cur = await self.execute('SELECT id, number, name, size, file_id, content_hash '
+                                 'FROM block '
+                                 'WHERE storage_id = ? '
+                                 'ORDER BY size DESC', (storage.id,))
+        blocks = []
+        async for row in cur:
+            blocks.append(Block(id=row['id'],
+                                number=row['number'],
+                                name=row['name'],
+                                size=row['size'],
+                                content_hash=row['content_hash'] or "",
+                                storage=storage,
+                                file=File(id=row['file_id'])))
+        return tuple(blocks)
+
+    async def get_all_blocks(self, storages: Sequence[StorageBase]) -> Tuple[Block]:
+        """
+        Get all blocks without ciphers ordered by file and number
+
+        Storage of block is taken from storages by id
+        """
+        by_id = {storage.id: storage for storage in storages}
+        cur = await self.execute('SELECT id, number, name, size, file_id, storage_id, checksum, content_hash '
+                                 'FROM block '
+                                 'ORDER BY file_id, number')
+        blocks = []
+        async for row in cur:
+            blocks.append(Block(id=row['id'],
+                                number=row['number'],
+                                name=row['name'],
+                                size=row['size'],
+                                checksum=row['checksum'] or "",
+                                content_hash=row['content_hash'] or "",
+                                storage=by_id.get(row['storage_id']),
+                                file=File(id=row['file_id'])))
+        return tuple(blocks)
+
+    async def get_replica_storage_ids(self, block: Block) -> Tuple[int]:
+        """
+        Get ids of storages keeping duplicates of block
+        """
+        cur = await self.execute('SELECT storage_id '
+                                 'FROM block '
+                                 'WHERE file_id = ? AND number = ?', (block.file.id, block.number))
+        return tuple(row['storage_id'] for row in await cur.fetchall())
+
+    async def get_shared_replica_storage_ids(self, block: Block) -> Tuple[int]:
+        """
+        Get ids of storages keeping duplicates of every block sharing data in storage with block
+        """
+        cur = await self.execute('SELECT DISTINCT replica.storage_id '
+                                 'FROM block AS shared '
+                                 'JOIN block AS replica '
+                                 'ON replica.file_id = shared.file_id AND replica.number = shared.number '
+                                 'WHERE shared.storage_id = ? AND shared.name = ?', (block.storage.id, block.name))
+        return tuple(row['storage_id'] for row in await cur.fetchall())
+
+    async def get_block_copies(self, block: Block) -> Tuple[Block]:
+        """
+        Get stored data with the same content, size and cipher as block has (one block per data in storage)
+        """
+        key_id = block.cipher.key().id if block.cipher else None
+        cipher_type = str(block.cipher.type) if block.cipher else None
+        cur = await self.execute('SELECT DISTINCT storage_id, name, checksum, type, token '
+                                 'FROM block b '
+                                 'JOIN storage s ON b.storage_id = s.id '
+                                 'WHERE content_hash = ? AND size = ? AND key_id IS ? AND cipher IS ?',
+                                 (block.content_hash, block.size, key_id, cipher_type))
+        blocks = []
+        async for row in cur:
+            blocks.append(Block(name=row['name'],
+                                size=block.size,
+                                checksum=row['checksum'] or "",
+                                content_hash=block.content_hash,
+                                storage=self._storage(row['storage_id'], row['type'], row['token'])))
+        return tuple(blocks)
+
+    async def get_block_ids_by_data(self, block: Block) -> Tuple[int]:
+        """
+        Get ids of blocks sharing data in storage with block (including block itself)
+        """
+        cur = await self.execute('SELECT id '
+                                 'FROM block '
+                                 'WHERE storage_id = ? AND name = ?', (block.storage.id, block.name))
+        return tuple(row['id'] for row in await cur.fetchall())
+
+    async def move_block(self, block: Block, storage: StorageBase, name: str) -> bool:
+        """
+        Point block and all blocks sharing its data to its copy in another storage
+
+        Return False if block was changed or deleted after it was read
+        """
+        cur = await self.execute('UPDATE block '
+                                 'SET storage_id = ?, name = ? '
+                                 'WHERE storage_id = ? AND name = ?',
+                                 (storage.id, name, block.storage.id, block.name))
+        return cur.rowcount > 0
+
+    async def del_blocks(self, blocks: Iterable[Block]):
+        """
+        Delete blocks by id (or by storage and name if block doesn't have id)
+        """
+        ids, names = [], []
+        for block in blocks:
+            if block.id:
+                ids.append((block.id,))
+            else:
+                names.append((block.storage.id, block.name))
+
+        if ids:
+            await self.executemany('DELETE FROM block '
+                                   'WHERE id = ?', ids)
+        if names:
+            await self.executemany('DELETE FROM block '
+                                   'WHERE storage_id = ? AND name = ?', names)
+
     async def del_file(self, file: File):
         cur = await self.execute('DELETE FROM block '
                                  'WHERE file_id IN '
@@ -204,6 +488,70 @@ class BlockRepo(AbstractRepo):
         cur = await self.execute('DELETE FROM file '
                                  'WHERE filename = ?', (file.filename,))
 
+    async def rename_file(self, file: File, filename: str) -> None:
+        cur = await self.execute('SELECT filename '
+                                 'FROM file '
+                                 'WHERE filename IN (?, ?)', (file.filename, filename))
+        found = {row['filename'] for row in await cur.fetchall()}
+        if file.filename not in found:
+            raise exceptions.UnknownFile()
+        if filename in found:
+            raise exceptions.FileAlreadyExists()
+        await self.execute('UPDATE file '
+                           'SET filename = ? '
+                           'WHERE filename = ?', (filename, file.filename))
+        file.filename = filename
+
+    @staticmethod
+    def _copy_where(source: str, target: str, exclude: Sequence[str] = ()) -> Tuple[str, tuple]:
+        """
+        Condition on files 'o' copied from source to target
+        """
+        where, params = ['o.filename >= ?'], [source]
+        if source:
+            where.append('o.filename < ?')
+            params.append(MetadataStore.prefix_end(source))
+        for prefix in (target, *exclude):
+            where.append('NOT (o.filename >= ? AND o.filename < ?)')
+            params.extend((prefix, MetadataStore.prefix_end(prefix)))
+        return ' AND '.join(where), tuple(params)
+
+    async def _copy_files(self, where: str, params: tuple, target: str, cut: int, blocks: bool = True) -> int:
+        """
+        Copy files selected by where, filename of copy is target + filename without cut first characters
+        """
+        renamed = (target, cut + 1)
+        cur = await self.execute(f'SELECT count(*) '
+                                 f'FROM file o '
+                                 f'JOIN file n ON n.filename = ? || substr(o.filename, ?) '
+                                 f'WHERE {where}', renamed + params)
+        if (await cur.fetchone())[0]:
+            raise exceptions.FileAlreadyExists()
+
+        cur = await self.execute(f'INSERT INTO file(filename, size, uploaded_blocks, total_blocks, checksum) '
+                                 f'SELECT ? || substr(o.filename, ?), size, uploaded_blocks, total_blocks, checksum '
+                                 f'FROM file o '
+                                 f'WHERE {where}', renamed + params)
+        count = cur.rowcount
+        if blocks:
+            await self.execute(f'INSERT INTO block(file_id, number, storage_id, name, size, key_id, checksum, '
+                               f'cipher, content_hash) '
+                               f'SELECT n.id, number, storage_id, name, b.size, key_id, b.checksum, cipher, content_hash '
+                               f'FROM file o '
+                               f'JOIN block b ON b.file_id = o.id '
+                               f'JOIN file n ON n.filename = ? || substr(o.filename, ?) '
+                               f'WHERE {where}', renamed + params)
+        return count
+
+    async def copy_file(self, file: File, filename: str) -> File:
+        if not await self._copy_files('o.filename = ?', (file.filename,), filename, len(file.filename)):
+            raise exceptions.UnknownFile()
+        return await self.get_file_by_filename(filename)
+
+    async def copy_files(self, source: str, target: str, exclude: Sequence[str] = ()) -> int:
+        where, params = self._copy_where(source, target, exclude)
+        return await self._copy_files(where, params, target, len(source))
+
     async def add_key(self, key: Key) -> None:
         cur = await self.add_row('key', {
             'key': key.key
@@ -219,7 +567,12 @@ class BlockRepo(AbstractRepo):
                             key=str(row['key'])))
         return tuple(keys)
 
-    async def get_blocks_grouped_by_number(self, file: File) -> Tuple[List[Block]]:
+    async def iter_blocks_grouped_by_number(self, file: File) -> AsyncIterator[List[Block]]:
+        """
+        Iterate over blocks of file ordered by number, every item is a list of duplicates of one block
+
+        Rows are read from cursor lazily, so only the current block is kept in memory
+        """
         query = """
         SELECT
             b.id id,
@@ -230,6 +583,7 @@ class BlockRepo(AbstractRepo):
             token,
             "key",
             key_id,
+            cipher,
             storage_id
         FROM
             block b
@@ -241,24 +595,27 @@ class BlockRepo(AbstractRepo):
         """
 
         cur = await self.execute(query, (file.id,))
-        blocks = []
+        group: List[Block] = []
         async for row in cur:
-            type_ = StorageType.from_str(row['type'])
-            storage = StorageCreator.create(type_)
-            storage.token = row['token']
-            key = Key(id=row['key_id'], key=str(row['key']))
-            cipher = Aes(key)
-            blocks.append(Block(number=row['number'],
-                                name=row['name'],
-                                id=row['id'],
-                                storage=storage,
-                                cipher=cipher,
-                                size=row['size'],
-                                file=file
-                                ))
-        max_number = max(block.number for block in blocks)
-        grouped_blocks = [[] for _ in range(max_number + 1)]
-        for block in blocks:
-            grouped_blocks[block.number].append(block)
-
-        return tuple(grouped_blocks)
+            if group and group[0].number != row['number']:
+                yield group
+                group = []
+            group.append(Block(number=row['number'],
+                               name=row['name'],
+                               id=row['id'],
+                               storage=self._storage(row['storage_id'], row['type'], row['token']),
+                               cipher=self._cipher(row['key_id'], row['key'], row['cipher']),
+                               size=row['size'],
+                               file=file))
+        if group:
+            yield group
+
+    async def iter_rows(self, table: str, batch_size: int = 10000) -> AsyncIterator[List[tuple]]:
+        columns = self.table_columns[table]
+        cur = await self.execute(f'SELECT {", ".join(columns)} '
+                                 f'FROM {table}')
+        while rows := await cur.fetchmany(batch_size):
+            yield [tuple(row) for row in rows]
+
+    async def load_rows(self, table: str, rows: Iterable[Sequence]) -> None:
+        await self.add_rows(table, self.table_columns[table], rows)
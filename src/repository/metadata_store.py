@@ -0,0 +1,305 @@
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import AsyncIterator, Dict, Generator, Iterable, List, Optional, Sequence, Tuple, Union
+
+from crypto import CipherBase, CipherType
+from entity import Block, Directory, File, Key
+from network.storage_base import StorageBase
+
+
+class StoreType(Enum):
+    SQLITE = 'sqlite'
+    SHARDED = 'sharded'
+
+    def __str__(self):
+        return self.value
+
+    @staticmethod
+    def from_str(s: str) -> Union["StoreType", None]:
+        for _, v in StoreType.__members__.items():
+            if v.value == s:
+                return v
+        return None
+
+
+class MetadataStore(ABC):
+    """
+    Catalog of storages, keys, files and blocks
+
+    Changes are visible to other tasks after commit. Storages and ciphers of returned blocks are shared
+    (one object per storage and per key and cipher type)
+    """
+    type: StoreType
+
+    # columns of rows exchanged between stores by iter_rows and load_rows in this order.
+    # Ids of blocks depend on store, so they aren't exchanged
+    table_columns: Dict[str, Tuple[str, ...]] = {
+        'storage': ('id', 'token', 'type'),
+        'key': ('id', 'key'),
+        'file': ('id', 'filename', 'size', 'uploaded_blocks', 'total_blocks', 'checksum'),
+        'block': ('file_id', 'number', 'storage_id', 'name', 'size', 'key_id', 'checksum', 'cipher',
+                  'content_hash'),
+    }
+
+    @abstractmethod
+    def __await__(self) -> Generator[None, None, "MetadataStore"]:
+        """
+        Open store creating schema if needed
+        """
+        pass
+
+    # STORAGES AND KEYS
+
+    @abstractmethod
+    async def add_storage(self, disk: StorageBase) -> None:
+        pass
+
+    @abstractmethod
+    async def get_storages(self) -> Tuple[StorageBase]:
+        pass
+
+    @abstractmethod
+    async def get_storage_by_id(self, id_: int) -> StorageBase:
+        """
+        Raise UnknownStorage if there is no such storage
+        """
+        pass
+
+    @abstractmethod
+    async def get_token(self, disk: StorageBase) -> StorageBase:
+        pass
+
+    @abstractmethod
+    async def add_key(self, key: Key) -> None:
+        pass
+
+    @abstractmethod
+    async def get_keys(self) -> Tuple[Key]:
+        pass
+
+    @abstractmethod
+    async def get_ciphers(self, cipher_type: CipherType) -> Tuple[CipherBase]:
+        """
+        Get ciphers of given type for all keys
+        """
+        pass
+
+    # FILES
+
+    @abstractmethod
+    async def add_file(self, file: File) -> None:
+        pass
+
+    @abstractmethod
+    async def get_files(self) -> Tuple[File]:
+        pass
+
+    @abstractmethod
+    async def get_file_by_filename(self, filename: str) -> File:
+        """
+        Raise UnknownFile if there is no such file
+        """
+        pass
+
+    @abstractmethod
+    async def del_file(self, file: File) -> None:
+        """
+        Delete file and its blocks by filename
+        """
+        pass
+
+    @abstractmethod
+    async def rename_file(self, file: File, filename: str) -> None:
+        """
+        Change filename of file (found by its current filename), blocks are kept
+
+        Raise UnknownFile if there is no such file and FileAlreadyExists if filename is taken
+        """
+        pass
+
+    @abstractmethod
+    async def copy_file(self, file: File, filename: str) -> File:
+        """
+        Copy file (found by its filename) with its blocks, blocks of the copy share data in storages with original
+
+        Raise UnknownFile if there is no such file and FileAlreadyExists if filename is taken
+        """
+        pass
+
+    @abstractmethod
+    async def copy_files(self, source: str, target: str, exclude: Sequence[str] = ()) -> int:
+        """
+        Copy files which filenames start with source replacing it by target, like copy_file does
+
+        Files starting with target and with prefixes in exclude aren't copied.
+        Raise FileAlreadyExists if filename of a copy is taken (nothing is copied then).
+        Return number of copied files
+        """
+        pass
+
+    @staticmethod
+    def prefix_end(prefix: str) -> Optional[str]:
+        """
+        The least string greater than all strings starting with prefix (None for empty prefix)
+        """
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
+
+    # DIRECTORIES (paths end with '/', root is '')
+
+    @abstractmethod
+    async def get_directory(self, path: str) -> Directory:
+        """
+        Get total size and number of files of directory with subdirectories
+
+        Raise UnknownDirectory if directory has no files
+        """
+        pass
+
+    @abstractmethod
+    async def get_subdirectories(self, path: str, after: str = "", limit: int = -1) -> Tuple[Directory]:
+        """
+        Get subdirectories ordered by path, which is greater than after (-1 - no limit)
+        """
+        pass
+
+    @abstractmethod
+    async def get_files_by_directory(self, path: str, after: str = "", limit: int = -1) -> Tuple[File]:
+        """
+        Get files of directory (not of subdirectories) ordered by filename, which is greater than after
+        """
+        pass
+
+    @abstractmethod
+    async def get_files_by_range(self, start: str, end: Optional[str] = None, limit: int = -1) -> Tuple[File]:
+        """
+        Get files ordered by filename, start <= filename < end (no upper bound if end is None)
+        """
+        pass
+
+    # BLOCKS
+
+    @abstractmethod
+    async def add_block(self, block: Block) -> None:
+        pass
+
+    @abstractmethod
+    async def add_blocks(self, blocks: Iterable[Block]) -> None:
+        """
+        Add blocks and count them in uploaded_blocks of their files
+        """
+        pass
+
+    @abstractmethod
+    async def get_blocks_by_file(self, file: File) -> Tuple[Block]:
+        pass
+
+    @abstractmethod
+    def iter_blocks_grouped_by_number(self, file: File) -> AsyncIterator[List[Block]]:
+        """
+        Iterate over blocks of file ordered by number, every item is a list of duplicates of one block
+        """
+        pass
+
+    async def get_blocks_grouped_by_number(self, file: File) -> Tuple[List[Block]]:
+        """
+        Get list of duplicates for every block number (empty list if number has no blocks)
+        """
+        grouped_blocks = []
+        async for group in self.iter_blocks_grouped_by_number(file):
+            grouped_blocks.extend([] for _ in range(group[0].number - len(grouped_blocks)))
+            grouped_blocks.append(group)
+
+        return tuple(grouped_blocks)
+
+    @abstractmethod
+    async def get_blocks_by_storage(self, storage: StorageBase) -> Tuple[Block]:
+        """
+        Get blocks placed in storage without ciphers (biggest blocks first)
+        """
+        pass
+
+    @abstractmethod
+    async def get_all_blocks(self, storages: Sequence[StorageBase]) -> Tuple[Block]:
+        """
+        Get all blocks without ciphers ordered by file and number
+
+        Storage of block is taken from storages by id
+        """
+        pass
+
+    @abstractmethod
+    async def get_replica_storage_ids(self, block: Block) -> Tuple[int]:
+        """
+        Get ids of storages keeping duplicates of block
+        """
+        pass
+
+    @abstractmethod
+    async def get_shared_replica_storage_ids(self, block: Block) -> Tuple[int]:
+        """
+        Get ids of storages keeping duplicates of every block sharing data in storage with block
+        """
+        pass
+
+    @abstractmethod
+    async def get_block_copies(self, block: Block) -> Tuple[Block]:
+        """
+        Get stored data with the same content, size and cipher as block has (one block per data in storage)
+        """
+        pass
+
+    @abstractmethod
+    async def get_block_ids_by_data(self, block: Block) -> Tuple[int]:
+        """
+        Get ids of blocks sharing data in storage with block (including block itself)
+        """
+        pass
+
+    @abstractmethod
+    async def move_block(self, block: Block, storage: StorageBase, name: str) -> bool:
+        """
+        Point block and all blocks sharing its data to its copy in another storage
+
+        Return False if block was changed or deleted after it was read
+        """
+        pass
+
+    @abstractmethod
+    async def del_block(self, block: Block) -> None:
+        """
+        Delete blocks by name
+        """
+        pass
+
+    @abstractmethod
+    async def del_blocks(self, blocks: Iterable[Block]) -> None:
+        """
+        Delete blocks by id (or by storage and name if block doesn't have id)
+        """
+        pass
+
+    # RAW ROWS
+
+    @abstractmethod
+    def iter_rows(self, table: str, batch_size: int = 10000) -> AsyncIterator[List[tuple]]:
+        """
+        Iterate over all rows of table by batches, values go in order of table_columns
+        """
+        pass
+
+    @abstractmethod
+    async def load_rows(self, table: str, rows: Iterable[Sequence]) -> None:
+        """
+        Add rows in order of table_columns as is (uploaded_blocks of files isn't changed by blocks)
+
+        Rows are consumed lazily
+        """
+        pass
+
+    @abstractmethod
+    async def commit(self) -> None:
+        pass
+
+    @abstractmethod
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,425 @@
+import asyncio
+import collections
+import glob
+import heapq
+import os
+from typing import AsyncIterator, Awaitable, Callable, Dict, Generator, Iterable, List, Optional, Sequence, Tuple
+
+import exceptions
+from crypto import CipherBase, CipherType
+from entity import Block, Directory, File, Key
+from network.storage_base import StorageBase
+from repository.abstract_repo import AbstractRepo
+from repository.block_repo import BlockRepo
+from repository.metadata_store import MetadataStore, StoreType
+
+
+class BlockShard(AbstractRepo):
+    """
+    Blocks of files with file_id % shard count == index of shard
+
+    Rows are clustered by (file_id, number), so blocks of a file are read from neighbouring pages without
+    a separate index. Storages and keys are kept in catalog, so there are no foreign keys.
+    Hashes are TEXT, STRING affinity of BlockRepo would turn hashes of digits into numbers
+    """
+    migrations = (
+        "CREATE UNIQUE INDEX IF NOT EXISTS block_id ON block(id)",
+        "CREATE INDEX IF NOT EXISTS block_content_hash ON block(content_hash)",
+        "CREATE INDEX IF NOT EXISTS block_name ON block(name, storage_id)",
+        "CREATE INDEX IF NOT EXISTS block_storage_size ON block(storage_id, size)",
+    )
+    pragmas = tuple(pragma for pragma in AbstractRepo.pragmas if pragma[0] != "foreign_keys")
+    # every shard has its own readers, so fewer of them
+    reader_num = 2
+    row_factory = None
+
+    # order of columns in selected rows
+    columns = ('id', 'file_id', 'number', 'storage_id', 'name', 'size', 'key_id', 'checksum', 'cipher',
+               'content_hash')
+
+    async def _create_tables(self) -> None:
+        await self.execute("""CREATE TABLE IF NOT EXISTS block(
+        file_id INTEGER NOT NULL,
+        number INTEGER NOT NULL,
+        id INTEGER NOT NULL,
+        storage_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        key_id INTEGER,
+        checksum TEXT,
+        cipher TEXT,
+        content_hash TEXT,
+        PRIMARY KEY (file_id, number, id)) WITHOUT ROWID;
+        """)
+
+    async def max_id(self) -> int:
+        cur = await self.execute('SELECT max(id) FROM block')
+        return (await cur.fetchone())[0] or 0
+
+    async def select(self, where: str, params: Sequence = (), order: str = '') -> List[tuple]:
+        cur = await self.execute(f'SELECT {", ".join(self.columns)} '
+                                 f'FROM block '
+                                 f'WHERE {where} {order}', params)
+        return list(await cur.fetchall())
+
+
+class ShardedRepo(MetadataStore):
+    """
+    Store for huge catalogs: storages, keys and files are in catalog database,
+    blocks are split into shard databases by file_id
+
+    Every shard has its own file lock, writer and readers, so queries of different files don't wait
+    for each other and queries without file run in all shards at once.
+    Commit isn't atomic across databases: shards are committed before catalog, so after a crash
+    blocks can be uncounted in uploaded_blocks of their file, which resumed upload skips anyway.
+
+    Ids of blocks are id in shard * shard count + index of shard
+    """
+    type = StoreType.SHARDED
+    shard_count: int = 8
+    catalog_name = "catalog.sqlite"
+    shard_name = "block-{:03}.sqlite"
+
+    def __init__(self, path: str, shard_count: Optional[int] = None):
+        """
+        :param path: directory of databases
+        :param shard_count: number of shards of new store, existing store keeps its number
+        """
+        self.path = path
+        self._shard_count = shard_count or self.shard_count
+        self._catalog: BlockRepo = None
+        self._shards: List[BlockShard] = []
+        self._next_ids: List[int] = []
+        self._storages: Dict[int, StorageBase] = {}
+        self._ciphers: Dict[Tuple[int, Optional[str]], CipherBase] = {}
+
+    def __await__(self) -> Generator[None, None, "ShardedRepo"]:
+        return self._ainit().__await__()
+
+    async def _ainit(self) -> "ShardedRepo":
+        os.makedirs(self.path, exist_ok=True)
+        existing = len(glob.glob(os.path.join(self.path, self.shard_name.replace("{:03}", "[0-9]*"))))
+        count = existing or self._shard_count
+
+        self._catalog = await BlockRepo(os.path.join(self.path, self.catalog_name))
+        self._shards = list(await asyncio.gather(*(BlockShard(os.path.join(self.path, self.shard_name.format(i)))
+                                                   for i in range(count))))
+        self._next_ids = [max_id // count + 1 for max_id in await self._gather(BlockShard.max_id)]
+        return self
+
+    async def _gather(self, func: Callable[[BlockShard], Awaitable]) -> list:
+        """
+        Run query in all shards at once, results go in order of shards
+        """
+        return list(await asyncio.gather(*(func(shard) for shard in self._shards)))
+
+    def _shard(self, file_id: int) -> BlockShard:
+        return self._shards[file_id % len(self._shards)]
+
+    def _new_id(self, file_id: int) -> int:
+        index = file_id % len(self._shards)
+        id_ = self._next_ids[index] * len(self._shards) + index
+        self._next_ids[index] += 1
+        return id_
+
+    async def _resolve(self, rows: Sequence[tuple]) -> None:
+        """
+        Load storages and ciphers used by rows if they are unknown yet
+        """
+        if any(row[3] not in self._storages for row in rows):
+            self._storages = {storage.id: storage for storage in await self._catalog.get_storages()}
+
+        for key_id, cipher_type in {(row[6], row[8]) for row in rows if row[6] is not None} - self._ciphers.keys():
+            # NULL cipher type means Aes used before the type was stored
+            type_ = CipherType.from_str(cipher_type) if cipher_type else CipherType.AES
+            for cipher in await self._catalog.get_ciphers(type_):
+                self._ciphers[(cipher.key().id, cipher_type)] = cipher
+
+    def _block(self, row: tuple, file: File, storage: Optional[StorageBase] = None,
+               with_cipher: bool = True) -> Block:
+        id_, _, number, storage_id, name, size, key_id, checksum, cipher, content_hash = row
+        return Block(id=id_,
+                     number=number,
+                     name=name,
+                     size=size,
+                     checksum=checksum or "",
+                     content_hash=content_hash or "",
+                     storage=storage or self._storages.get(storage_id),
+                     cipher=self._ciphers.get((key_id, cipher)) if with_cipher and key_id is not None else None,
+                     file=file)
+
+    # STORAGES, KEYS AND FILES ARE IN CATALOG
+
+    async def add_storage(self, disk: StorageBase) -> None:
+        await self._catalog.add_storage(disk)
+
+    async def get_storages(self) -> Tuple[StorageBase]:
+        return await self._catalog.get_storages()
+
+    async def get_storage_by_id(self, id_: int) -> StorageBase:
+        return await self._catalog.get_storage_by_id(id_)
+
+    async def get_token(self, disk: StorageBase) -> StorageBase:
+        return await self._catalog.get_token(disk)
+
+    async def add_key(self, key: Key) -> None:
+        await self._catalog.add_key(key)
+
+    async def get_keys(self) -> Tuple[Key]:
+        return await self._catalog.get_keys()
+
+    async def get_ciphers(self, cipher_type: CipherType) -> Tuple[CipherBase]:
+        return await self._catalog.get_ciphers(cipher_type)
+
+    async def add_file(self, file: File) -> None:
+        await self._catalog.add_file(file)
+
+    async def get_files(self) -> Tuple[File]:
+        return await self._catalog.get_files()
+
+    async def get_file_by_filename(self, filename: str) -> File:
+        return await self._catalog.get_file_by_filename(filename)
+
+    async def rename_file(self, file: File, filename: str) -> None:
+        await self._catalog.rename_file(file, filename)
+
+    async def _copy_blocks(self, where: str, params: tuple, target: str, cut: int) -> None:
+        """
+        Copy blocks of files copied in catalog to shards of the copies
+        """
+        cur = await self._catalog.execute(f'SELECT o.id, n.id '
+                                          f'FROM file o '
+                                          f'JOIN file n ON n.filename = ? || substr(o.filename, ?) '
+                                          f'WHERE {where}', (target, cut + 1) + params)
+        while pairs := await cur.fetchmany(500):
+            new_ids = dict(tuple(pair) for pair in pairs)
+            by_shard: Dict[int, List[int]] = collections.defaultdict(list)
+            for old_id in new_ids:
+                by_shard[old_id % len(self._shards)].append(old_id)
+
+            rows = []
+            for index, old_ids in by_shard.items():
+                for row in await self._shards[index].select(f'file_id IN ({", ".join("?" * len(old_ids))})',
+                                                            old_ids):
+                    rows.append((new_ids[row[1]], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9]))
+            # uploaded_blocks of copies are copied with files
+            await self.load_rows('block', rows)
+
+    async def copy_file(self, file: File, filename: str) -> File:
+        copy = await self._catalog.copy_file(file, filename)
+        await self._copy_blocks('o.filename = ?', (file.filename,), filename, len(file.filename))
+        return copy
+
+    async def copy_files(self, source: str, target: str, exclude: Sequence[str] = ()) -> int:
+        count = await self._catalog.copy_files(source, target, exclude)
+        await self._copy_blocks(*BlockRepo._copy_where(source, target, exclude), target, len(source))
+        return count
+
+    async def get_directory(self, path: str) -> Directory:
+        return await self._catalog.get_directory(path)
+
+    async def get_subdirectories(self, path: str, after: str = "", limit: int = -1) -> Tuple[Directory]:
+        return await self._catalog.get_subdirectories(path, after, limit)
+
+    async def get_files_by_directory(self, path: str, after: str = "", limit: int = -1) -> Tuple[File]:
+        return await self._catalog.get_files_by_directory(path, after, limit)
+
+    async def get_files_by_range(self, start: str, end: Optional[str] = None, limit: int = -1) -> Tuple[File]:
+        return await self._catalog.get_files_by_range(start, end, limit)
+
+    async def del_file(self, file: File) -> None:
+        try:
+            file_id = (await self._catalog.get_file_by_filename(file.filename)).id
+        except exceptions.UnknownFile:
+            return
+        await self._shard(file_id).execute('DELETE FROM block '
+                                           'WHERE file_id = ?', (file_id,))
+        await self._catalog.del_file(file)
+
+    # BLOCKS ARE IN SHARDS
+
+    def _block_row(self, block: Block) -> tuple:
+        key_id = block.cipher.key().id if block.cipher else None
+        cipher_type = str(block.cipher.type) if block.cipher else None
+        return (block.id, block.file.id, block.number, block.storage.id, block.name, block.size, key_id,
+                block.checksum, cipher_type, block.content_hash or None)
+
+    async def add_block(self, block: Block) -> None:
+        await self.add_blocks([block])
+
+    async def add_blocks(self, blocks: Iterable[Block]) -> None:
+        """
+        Add blocks shard by shard and count them in uploaded_blocks of their files
+
+        Ids of blocks are set
+        """
+        by_shard: Dict[int, List[tuple]] = collections.defaultdict(list)
+        counts = collections.Counter()
+        for block in blocks:
+            block.id = self._new_id(block.file.id)
+            counts[block.file.id] += 1
+            by_shard[block.file.id % len(self._shards)].append(self._block_row(block))
+
+        # writes stay in current task, so its next reads see them before commit
+        for index, rows in by_shard.items():
+            await self._shards[index].add_rows('block', BlockShard.columns, rows)
+        await self._catalog.executemany('UPDATE file '
+                                        'SET uploaded_blocks = uploaded_blocks + ? '
+                                        'WHERE id = ?', [(count, file_id) for file_id, count in counts.items()])
+
+    async def get_blocks_by_file(self, file: File) -> Tuple[Block]:
+        rows = await self._shard(file.id).select('file_id = ?', (file.id,), 'ORDER BY number')
+        await self._resolve(rows)
+        return tuple(self._block(row, file) for row in rows)
+
+    async def iter_blocks_grouped_by_number(self, file: File) -> AsyncIterator[List[Block]]:
+        """
+        Iterate over blocks of file ordered by number, every item is a list of duplicates of one block
+
+        Rows are read from cursor by batches, so only a part of file is kept in memory
+        """
+        shard = self._shard(file.id)
+        cur = await shard.execute(f'SELECT {", ".join(BlockShard.columns)} '
+                                  f'FROM block '
+                                  f'WHERE file_id = ? '
+                                  f'ORDER BY number', (file.id,))
+        group: List[Block] = []
+        while rows := await cur.fetchmany(1000):
+            await self._resolve(rows)
+            for row in rows:
+                block = self._block(row, file)
+                if group and group[0].number != block.number:
+                    yield group
+                    group = []
+                group.append(block)
+        if group:
+            yield group
+
+    async def get_blocks_by_storage(self, storage: StorageBase) -> Tuple[Block]:
+        results = await self._gather(lambda shard: shard.select('storage_id = ?', (storage.id,), 'ORDER BY size DESC'))
+        rows = heapq.merge(*results, key=lambda row: row[5], reverse=True)
+        return tuple(self._block(row, File(id=row[1]), storage, with_cipher=False) for row in rows)
+
+    async def get_all_blocks(self, storages: Sequence[StorageBase]) -> Tuple[Block]:
+        by_id = {storage.id: storage for storage in storages}
+        results = await self._gather(lambda shard: shard.select('1', (), 'ORDER BY file_id, number'))
+        rows = heapq.merge(*results, key=lambda row: (row[1], row[2]))
+        return tuple(self._block(row, File(id=row[1]), by_id.get(row[3]), with_cipher=False) for row in rows)
+
+    async def get_replica_storage_ids(self, block: Block) -> Tuple[int]:
+        cur = await self._shard(block.file.id).execute('SELECT storage_id '
+                                                       'FROM block '
+                                                       'WHERE file_id = ? AND number = ?',
+                                                       (block.file.id, block.number))
+        return tuple(row[0] for row in await cur.fetchall())
+
+    async def get_shared_replica_storage_ids(self, block: Block) -> Tuple[int]:
+        # duplicates of a block are in the shard of its file, so the join is done in every shard
+        async def storage_ids(shard: BlockShard) -> List[int]:
+            cur = await shard.execute('SELECT DISTINCT replica.storage_id '
+                                      'FROM block AS shared '
+                                      'JOIN block AS replica '
+                                      'ON replica.file_id = shared.file_id AND replica.number = shared.number '
+                                      'WHERE shared.storage_id = ? AND shared.name = ?',
+                                      (block.storage.id, block.name))
+            return [row[0] for row in await cur.fetchall()]
+
+        results = await self._gather(storage_ids)
+        return tuple(sorted({storage_id for shard_ids in results for storage_id in shard_ids}))
+
+    async def get_block_copies(self, block: Block) -> Tuple[Block]:
+        key_id = block.cipher.key().id if block.cipher else None
+        cipher_type = str(block.cipher.type) if block.cipher else None
+        results = await self._gather(lambda shard: shard.select(
+            'content_hash = ? AND size = ? AND key_id IS ? AND cipher IS ?',
+            (block.content_hash, block.size, key_id, cipher_type)))
+
+        rows = {}
+        for row in (row for shard_rows in results for row in shard_rows):
+            rows.setdefault((row[3], row[4]), row)
+        await self._resolve(list(rows.values()))
+        return tuple(Block(name=row[4],
+                           size=block.size,
+                           checksum=row[7] or "",
+                           content_hash=block.content_hash,
+                           storage=self._storages[row[3]]) for row in rows.values())
+
+    async def get_block_ids_by_data(self, block: Block) -> Tuple[int]:
+        results = await self._gather(lambda shard: shard.select('storage_id = ? AND name = ?',
+                                                                (block.storage.id, block.name)))
+        return tuple(row[0] for shard_rows in results for row in shard_rows)
+
+    async def move_block(self, block: Block, storage: StorageBase, name: str) -> bool:
+        moved = 0
+        for shard in self._shards:
+            cur = await shard.execute('UPDATE block '
+                                      'SET storage_id = ?, name = ? '
+                                      'WHERE storage_id = ? AND name = ?',
+                                      (storage.id, name, block.storage.id, block.name))
+            moved += cur.rowcount
+        return moved > 0
+
+    async def del_block(self, block: Block) -> None:
+        for shard in self._shards:
+            await shard.execute('DELETE FROM block '
+                                'WHERE name = ?', (block.name,))
+
+    async def del_blocks(self, blocks: Iterable[Block]) -> None:
+        ids: Dict[int, List[tuple]] = collections.defaultdict(list)
+        names = []
+        for block in blocks:
+            if block.id:
+                ids[block.id % len(self._shards)].append((block.id,))
+            else:
+                names.append((block.storage.id, block.name))
+
+        for index, shard_ids in ids.items():
+            await self._shards[index].executemany('DELETE FROM block '
+                                                  'WHERE id = ?', shard_ids)
+        if names:
+            for shard in self._shards:
+                await shard.executemany('DELETE FROM block '
+                                        'WHERE storage_id = ? AND name = ?', names)
+
+    # RAW ROWS
+
+    async def iter_rows(self, table: str, batch_size: int = 10000) -> AsyncIterator[List[tuple]]:
+        if table != 'block':
+            async for rows in self._catalog.iter_rows(table, batch_size):
+                yield rows
+            return
+
+        columns = self.table_columns['block']
+        for shard in self._shards:
+            cur = await shard.execute(f'SELECT {", ".join(columns)} '
+                                      f'FROM block')
+            while rows := await cur.fetchmany(batch_size):
+                yield rows
+
+    async def load_rows(self, table: str, rows: Iterable[Sequence], batch_size: int = 10000) -> None:
+        if table != 'block':
+            await self._catalog.load_rows(table, rows)
+            return
+
+        columns = ('id',) + self.table_columns['block']
+        by_shard: Dict[int, List[tuple]] = collections.defaultdict(list)
+        for row in rows:
+            file_id = row[0]
+            shard_rows = by_shard[file_id % len(self._shards)]
+            shard_rows.append((self._new_id(file_id), *row))
+            if len(shard_rows) >= batch_size:
+                await self._shard(file_id).add_rows('block', columns, shard_rows)
+                shard_rows.clear()
+
+        for index, shard_rows in by_shard.items():
+            if shard_rows:
+                await self._shards[index].add_rows('block', columns, shard_rows)
+
+    async def commit(self) -> None:
+        await self._gather(BlockShard.commit)
+        await self._catalog.commit()
+
+    async def close(self) -> None:
+        await self._gather(BlockShard.close)
+        if self._catalog:
+            await self._catalog.close()
@@ -0,0 +1,226 @@
+"""
+Compact snapshot of catalog
+
+File is a magic line, a json header line and gzip stream of frames. Every frame keeps a batch of rows
+of one table column by column, so values of the same kind are compressed together:
+integers as deltas, hashes and uuid names as raw bytes, other strings as utf-8 with lengths.
+The last frame has numbers of rows of all tables, import checks them
+"""
+import array
+import asyncio
+import gzip
+import itertools
+import json
+import struct
+import sys
+import time
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+import exceptions
+from repository.metadata_store import MetadataStore
+
+MAGIC = b"CLOUD-RAID-SNAPSHOT\n"
+VERSION = 1
+_END = 0xFFFF
+_FRAME = struct.Struct("<HI")  # table index (_END for the last frame), number of rows
+_COLUMN = struct.Struct("<cBI")  # type, has null mask, size of values
+
+
+def _ints(values: Sequence[int], typecode: str = "q") -> bytes:
+    data = array.array(typecode, values)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data.tobytes()
+
+
+def _from_ints(data: bytes, typecode: str = "q") -> List[int]:
+    values = array.array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tolist()
+
+
+def _uuid_bytes(values: List[str]) -> bytes:
+    data = bytes.fromhex("".join(values).replace("-", ""))
+    if len(data) != 16 * len(values):
+        raise ValueError("Not uuid")
+    return data
+
+
+def _encode_strings(type_: bytes, present: List[str], encode: Callable[[], bytes]) -> Optional[bytes]:
+    """
+    Encode strings as raw bytes if they are decoded back exactly (lower case hex, canonical uuid)
+    """
+    try:
+        data = encode()
+    except ValueError:
+        return None
+    return data if _decode_column(type_, len(present), data) == present else None
+
+
+def _encode_column(values: Sequence[Any]) -> Tuple[bytes, bool, bytes]:
+    """
+    Return type, whether null mask is used and encoded values (nulls are left out)
+    """
+    present = [value for value in values if value is not None]
+    strings = all(type(value) is str for value in present)
+
+    if all(type(value) is int for value in present):
+        # ids and numbers grow, so deltas are small and compress well
+        type_, data = b"i", _ints([value - previous for previous, value in zip([0] + present, present)])
+    elif strings and (data := _encode_strings(b"u", present, lambda: _uuid_bytes(present))):
+        type_ = b"u"
+    elif strings and (data := _encode_strings(b"h", present,
+                                              lambda: _ints([len(value) // 2 for value in present], "I") +
+                                              bytes.fromhex("".join(present)))):
+        type_ = b"h"
+    elif strings:
+        encoded = [value.encode() for value in present]
+        type_, data = b"s", _ints([len(value) for value in encoded], "I") + b"".join(encoded)
+    else:
+        # numbers stored in STRING columns and other mixed values
+        type_, data = b"j", json.dumps(present).encode()
+
+    return type_, len(present) != len(values), data
+
+
+def _decode_column(type_: bytes, count: int, data: bytes) -> List[Any]:
+    if type_ == b"i":
+        return list(itertools.accumulate(_from_ints(data)))
+    if type_ == b"u":
+        text = data.hex()
+        return [f"{text[i:i + 8]}-{text[i + 8:i + 12]}-{text[i + 12:i + 16]}-{text[i + 16:i + 20]}-{text[i + 20:i + 32]}"
+                for i in range(0, len(text), 32)]
+    if type_ == b"h":
+        text = data[count * 4:].hex()
+        offsets = list(itertools.accumulate((length * 2 for length in _from_ints(data[:count * 4], "I")), initial=0))
+        return [text[start:end] for start, end in zip(offsets, offsets[1:])]
+    if type_ == b"s":
+        offsets = list(itertools.accumulate(_from_ints(data[:count * 4], "I"), initial=count * 4))
+        return [data[start:end].decode() for start, end in zip(offsets, offsets[1:])]
+    if type_ == b"j":
+        return json.loads(data)
+    raise exceptions.BrokenSnapshot(f"Unknown column type {type_}")
+
+
+def _write_frame(f: BinaryIO, table_index: int, rows: List[Sequence[Any]]) -> None:
+    f.write(_FRAME.pack(table_index, len(rows)))
+    for values in zip(*rows):
+        type_, has_nulls, data = _encode_column(values)
+        f.write(_COLUMN.pack(type_, has_nulls, len(data)))
+        if has_nulls:
+            f.write(bytes(value is not None for value in values))
+        f.write(data)
+
+
+def _read_exactly(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise exceptions.BrokenSnapshot("Unexpected end of snapshot")
+    return data
+
+
+def _read_frame(f: BinaryIO, column_count: int, count: int) -> List[tuple]:
+    """
+    Read rows of frame after its header
+    """
+    columns = []
+    for _ in range(column_count):
+        type_, has_nulls, size = _COLUMN.unpack(_read_exactly(f, _COLUMN.size))
+        if not has_nulls:
+            columns.append(_decode_column(type_, count, _read_exactly(f, size)))
+            continue
+        mask = _read_exactly(f, count)
+        present = iter(_decode_column(type_, sum(mask), _read_exactly(f, size)))
+        columns.append([next(present) if flag else None for flag in mask])
+    return list(zip(*columns))
+
+
+async def export_snapshot(store: MetadataStore, path: str, batch_size: int = 50000, compress_level: int = 1,
+                          progress: Optional[Callable[[str, int], None]] = None) -> Dict[str, int]:
+    """
+    Write all rows of store to snapshot file by batches, return number of rows by table
+
+    :param progress: called with table and number of rows written so far after every batch
+    """
+    tables = list(MetadataStore.table_columns)
+    header = {
+        'version': VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'store': str(store.type),
+        'tables': {table: list(columns) for table, columns in MetadataStore.table_columns.items()},
+    }
+    counts = {}
+    with open(path, "wb") as raw:
+        raw.write(MAGIC)
+        raw.write(json.dumps(header).encode() + b"\n")
+        with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=compress_level) as f:
+            for index, table in enumerate(tables):
+                counts[table] = 0
+                async for rows in store.iter_rows(table, batch_size):
+                    _write_frame(f, index, rows)
+                    counts[table] += len(rows)
+                    if progress:
+                        progress(table, counts[table])
+            trailer = json.dumps(counts).encode()
+            f.write(_FRAME.pack(_END, len(trailer)) + trailer)
+
+    logger.info(f"Catalog exported to {path}: {counts}")
+    return counts
+
+
+async def import_snapshot(store: MetadataStore, path: str,
+                          progress: Optional[Callable[[str, int], None]] = None) -> Dict[str, int]:
+    """
+    Load snapshot into empty store batch by batch (every batch is committed), return number of rows by table
+
+    Raise BrokenSnapshot if file isn't a snapshot, is truncated or has other columns
+    """
+    with open(path, "rb") as raw:
+        if raw.read(len(MAGIC)) != MAGIC:
+            raise exceptions.BrokenSnapshot(f"{path} isn't a catalog snapshot")
+        header = json.loads(raw.readline())
+        if header.get('version') != VERSION:
+            raise exceptions.BrokenSnapshot(f"Unsupported snapshot version {header.get('version')}")
+
+        tables = list(header['tables'])
+        for table in tables:
+            if tuple(header['tables'][table]) != MetadataStore.table_columns.get(table):
+                raise exceptions.BrokenSnapshot(f"Columns of {table} don't match catalog")
+
+        counts = {table: 0 for table in tables}
+
+        async def load(table: str, rows: List[tuple]):
+            await store.load_rows(table, rows)
+            await store.commit()
+            counts[table] += len(rows)
+            if progress:
+                progress(table, counts[table])
+
+        # the next frame is decoded while database thread inserts the previous one
+        loading: Optional[asyncio.Task] = None
+        try:
+            with gzip.GzipFile(fileobj=raw, mode="rb") as f:
+                while True:
+                    table_index, count = _FRAME.unpack(_read_exactly(f, _FRAME.size))
+                    if table_index == _END:
+                        expected = json.loads(_read_exactly(f, count))
+                        break
+
+                    table = tables[table_index]
+                    rows = _read_frame(f, len(header['tables'][table]), count)
+                    if loading:
+                        await loading
+                    loading = asyncio.create_task(load(table, rows))
+        except (OSError, EOFError) as e:
+            raise exceptions.BrokenSnapshot(str(e)) from e
+        finally:
+            if loading:
+                await loading
+
+    if expected != counts:
+        raise exceptions.BrokenSnapshot(f"Snapshot has {expected} rows, {counts} loaded")
+    return counts
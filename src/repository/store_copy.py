@@ -0,0 +1,28 @@
+from typing import Callable, Dict, Optional
+
+from loguru import logger
+
+from repository.metadata_store import MetadataStore
+
+
+async def copy_store(source: MetadataStore, target: MetadataStore, batch_size: int = 10000,
+                     progress: Optional[Callable[[str, int], None]] = None) -> Dict[str, int]:
+    """
+    Copy all rows from source to empty target keeping ids of storages, keys and files
+
+    Tables are streamed by batches, every batch is committed, so memory doesn't depend on catalog size.
+    Return number of copied rows by table
+
+    :param progress: called with table and number of rows copied so far after every batch
+    """
+    counts = {}
+    for table in MetadataStore.table_columns:
+        counts[table] = 0
+        async for rows in source.iter_rows(table, batch_size):
+            await target.load_rows(table, rows)
+            await target.commit()
+            counts[table] += len(rows)
+            if progress:
+                progress(table, counts[table])
+        logger.info(f"Copied {counts[table]} rows of {table} from {source.type} to {target.type} store")
+    return counts
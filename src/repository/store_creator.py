@@ -0,0 +1,26 @@
+import os
+from typing import Optional
+
+from repository.block_repo import BlockRepo
+from repository.metadata_store import MetadataStore, StoreType
+from repository.sharded_repo import ShardedRepo
+
+
+class StoreCreator:
+    @staticmethod
+    def detect(path: str) -> StoreType:
+        """
+        Sharded store is a directory, sqlite store is a file
+        """
+        return StoreType.SHARDED if os.path.isdir(path) else StoreType.SQLITE
+
+    @staticmethod
+    def create(path: str, store_type: Optional[StoreType] = None, shard_count: Optional[int] = None) -> MetadataStore:
+        """
+        Create store not opened yet (await it), type is detected by path if it isn't given
+        """
+        store_type = store_type or StoreCreator.detect(path)
+        if store_type == StoreType.SQLITE:
+            return BlockRepo(path)
+        if store_type == StoreType.SHARDED:
+            return ShardedRepo(path, shard_count)
@@ -0,0 +1,3 @@
+from .walker import LocalFile, scan
+from .index import SyncIndex
+from .syncer import Syncer, SyncConfig, SyncPlan, SyncResult
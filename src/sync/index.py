@@ -0,0 +1,43 @@
+from typing import Dict, Iterable
+
+from repository.abstract_repo import AbstractRepo
+from .walker import LocalFile
+
+
+class SyncIndex(AbstractRepo):
+    """
+    Size, mtime and inode of local files when they were synced, by prefix of their filenames in catalog
+
+    Files with the same values are skipped by the next sync without reading them
+    """
+    row_factory = None
+    reader_num = 1
+
+    async def _create_tables(self) -> None:
+        await self.execute("""CREATE TABLE IF NOT EXISTS entry(
+        target TEXT NOT NULL,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        PRIMARY KEY (target, path)) WITHOUT ROWID;
+        """)
+
+    async def get_entries(self, target: str) -> Dict[str, LocalFile]:
+        cur = await self.execute('SELECT path, size, mtime, inode '
+                                 'FROM entry '
+                                 'WHERE target = ?', (target,))
+        entries = {}
+        while rows := await cur.fetchmany(10000):
+            entries.update((path, LocalFile(path=path, size=size, mtime=mtime, inode=inode))
+                           for path, size, mtime, inode in rows)
+        return entries
+
+    async def put_entries(self, target: str, files: Iterable[LocalFile]) -> None:
+        await self.upsert_rows('entry', ('target', 'path', 'size', 'mtime', 'inode'),
+                               ((target, file.path, file.size, file.mtime, file.inode) for file in files),
+                               conflict=('target', 'path'))
+
+    async def del_entries(self, target: str, paths: Iterable[str]) -> None:
+        await self.executemany('DELETE FROM entry '
+                               'WHERE target = ? AND path = ?', ((target, path) for path in paths))
@@ -0,0 +1,244 @@
+import asyncio
+import dataclasses
+import os
+import uuid
+from typing import Callable, Collection, List, Optional, Tuple
+
+from loguru import logger
+
+import entity
+import exceptions
+import repository
+import utils
+from network.balancer import Balancer
+from network.scheduler import TransferScheduler
+from network.uploader import Uploader
+from vfs.versions import HIDDEN_DIRECTORIES, UPLOAD_DIRECTORY, Versions
+from .index import SyncIndex
+from .walker import LocalFile, scan
+
+
+@dataclasses.dataclass(kw_only=True)
+class SyncConfig:
+    target: str = ""  # prefix of filenames in catalog, 'backup/' keeps files in backup directory
+    thread_num: int = 8  # threads scanning directories and hashing blocks
+    parallel_num: int = 4  # files uploaded at once
+    block_parallel_num: int = 10  # blocks uploaded at once by all files
+    duplicate_count: int = 1
+    need_encrypt: bool = False
+    delete: bool = True  # delete files removed from directory
+    keep_versions: bool = False  # changed and deleted files are kept as versions
+    full: bool = False  # ignore index: compare block hashes of all files, delete all files missing in directory
+    index_batch: int = 1000  # synced files written to index by one commit
+
+
+@dataclasses.dataclass(kw_only=True)
+class SyncPlan:
+    new: List[LocalFile]
+    changed: List[LocalFile]  # size, mtime or inode differ from index, content is compared by block hashes
+    deleted: List[str]  # paths of files removed from directory
+    unchanged: int
+
+
+@dataclasses.dataclass(kw_only=True)
+class SyncResult:
+    uploaded: int = 0
+    skipped: int = 0  # changed files with the same content
+    deleted: int = 0
+    failed: List[str] = dataclasses.field(default_factory=list)
+
+
+class Syncer:
+    """
+    Make files under target prefix of catalog the same as files of local directory
+
+    Files with size, mtime and inode kept in index since the last sync aren't read, other files
+    are compared with catalog by block hashes and only changed blocks are uploaded.
+    Files are uploaded in parallel, their block transfers share one scheduler
+    """
+
+    def __init__(self,
+                 block_repo: "repository.MetadataStore",
+                 balancer: Balancer,
+                 index: SyncIndex,
+                 root: str,
+                 config: Optional[SyncConfig] = None):
+        self._block_repo = block_repo
+        self._balancer = balancer
+        self._index = index
+        self._root = root
+        self._config = config or SyncConfig()
+        self._versions = Versions(block_repo)
+        self._synced: List[LocalFile] = []  # not written to index yet
+
+    def _index_files(self) -> Collection[str]:
+        """
+        Relative paths of index database files if index is in synced directory
+        """
+        path = os.path.relpath(os.path.abspath(self._index.database), os.path.abspath(self._root))
+        if path.startswith(".." + os.sep):
+            return ()
+        path = path.replace(os.sep, "/")
+        return {path, path + "-wal", path + "-shm", path + "-journal"}
+
+    async def _catalog_paths(self) -> List[str]:
+        """
+        Paths of files under target in catalog (hidden directories are skipped)
+        """
+        target = self._config.target
+        end = repository.MetadataStore.prefix_end(target)
+        start, paths = target, []
+        while files := await self._block_repo.get_files_by_range(start, end, 10000):
+            paths.extend(file.filename[len(target):] for file in files
+                         if not file.filename[len(target):].startswith(HIDDEN_DIRECTORIES))
+            start = files[-1].filename + "\0"
+        return paths
+
+    async def plan(self) -> SyncPlan:
+        local = await asyncio.to_thread(scan, self._root, self._config.thread_num, self._index_files())
+        if self._config.full:
+            indexed, stored = {}, set(await self._catalog_paths())
+        else:
+            indexed = await self._index.get_entries(self._config.target)
+            stored = indexed.keys()
+
+        new, changed, unchanged = [], [], 0
+        for path, file in local.items():
+            entry = indexed.get(path)
+            if entry is None and path not in stored:
+                new.append(file)
+            elif entry is None or not entry.same_stat(file):
+                changed.append(file)
+            else:
+                unchanged += 1
+
+        deleted = []
+        if self._config.delete:
+            deleted = sorted(path for path in stored if path not in local)
+        return SyncPlan(new=sorted(new, key=lambda file: file.path),
+                        changed=sorted(changed, key=lambda file: file.path),
+                        deleted=deleted,
+                        unchanged=unchanged)
+
+    async def _sync_file(self, file: LocalFile, scheduler: TransferScheduler) -> bool:
+        """
+        Upload file if its content differs from catalog, return False if it is the same
+        """
+        filename = self._config.target + file.path
+        path = os.path.join(self._root, file.path)
+        try:
+            base = await self._block_repo.get_file_by_filename(filename)
+        except exceptions.UnknownFile:
+            base = None
+        if base and base.uploaded_blocks != base.total_blocks:
+            # interrupted upload of content which may be changed since
+            await self._versions.delete_files([base])
+            base = None
+
+        upload = entity.File(filename=UPLOAD_DIRECTORY + uuid.uuid4().hex if base else filename,
+                             path=path,
+                             duplicate_count=self._config.duplicate_count,
+                             need_encrypt=self._config.need_encrypt)
+        hashes = None
+        if base:
+            # blocks are compared by number, so file is split like the stored one
+            blocks = await self._block_repo.get_blocks_by_file(base)
+            self._balancer.fill_file(upload, blocks[0].size if base.total_blocks > 1 else None)
+            hashes = await asyncio.to_thread(utils.block_hashes, path, upload.block_size, self._config.thread_num)
+            stored = {block.number: block.content_hash for block in blocks}
+            if len(hashes) == base.total_blocks and all(content_hash == stored.get(number)
+                                                        for number, content_hash in enumerate(hashes)):
+                return False
+        else:
+            self._balancer.fill_file(upload)
+
+        async with Uploader(self._balancer, self._block_repo, scheduler=scheduler) as uploader:
+            try:
+                if await uploader.upload_file(upload, base, hashes):
+                    raise exceptions.UploadFailed()
+            except (exceptions.ErrorBase, OSError):
+                if base and upload.id:
+                    await self._versions.delete_files([upload])
+                raise
+        if base:
+            await self._versions.replace(upload, filename, self._config.keep_versions)
+        return True
+
+    async def _flush(self) -> None:
+        synced, self._synced = self._synced, []
+        if synced:
+            await self._index.put_entries(self._config.target, synced)
+            await self._index.commit()
+
+    async def _delete(self, paths: List[str]) -> Tuple[int, List[str]]:
+        """
+        Delete files of paths from catalog (or make them versions) and from index
+
+        Return number of deleted files and paths of files which failed
+        """
+        target = self._config.target
+        files, removed = [], []
+        for path in paths:
+            try:
+                files.append(await self._block_repo.get_file_by_filename(target + path))
+            except exceptions.UnknownFile:
+                removed.append(path)
+
+        if self._config.keep_versions:
+            for file in files:
+                await self._block_repo.rename_file(file, Versions.version_name(file.filename))
+            await self._block_repo.commit()
+            deleted = files
+        else:
+            deleted = await self._versions.delete_files(files)
+        deleted_paths = [file.filename[len(target):] for file in deleted]
+        await self._index.del_entries(target, removed + deleted_paths)
+        await self._index.commit()
+        failed = set(file.filename[len(target):] for file in files) - set(deleted_paths)
+        return len(deleted), sorted(failed)
+
+    async def run(self, plan: SyncPlan, progress: Optional[Callable[[int, int], None]] = None) -> SyncResult:
+        """
+        Upload new and changed files, then delete removed ones
+
+        Files which failed are kept out of index, so they are synced again next time
+        """
+        result = SyncResult()
+        total = len(plan.new) + len(plan.changed) + len(plan.deleted)
+        done = 0
+        files = iter(plan.new + plan.changed)
+
+        async def worker(scheduler: TransferScheduler) -> None:
+            nonlocal done
+            for file in files:
+                try:
+                    if await self._sync_file(file, scheduler):
+                        result.uploaded += 1
+                    else:
+                        result.skipped += 1
+                    self._synced.append(file)
+                except (exceptions.ErrorBase, OSError) as e:
+                    logger.exception(e)
+                    logger.error(f"Cannot sync {file.path}")
+                    result.failed.append(file.path)
+                done += 1
+                if progress:
+                    progress(done, total)
+                if len(self._synced) >= self._config.index_batch:
+                    await self._flush()
+
+        async with TransferScheduler(self._config.block_parallel_num) as scheduler:
+            try:
+                await asyncio.gather(*(worker(scheduler) for _ in range(self._config.parallel_num)))
+            finally:
+                await self._flush()
+
+        for start in range(0, len(plan.deleted), self._config.index_batch):
+            paths = plan.deleted[start:start + self._config.index_batch]
+            deleted, failed = await self._delete(paths)
+            result.deleted += deleted
+            result.failed.extend(failed)
+            done += len(paths)
+            if progress:
+                progress(done, total)
+        return result
@@ -0,0 +1,55 @@
+import concurrent.futures
+import dataclasses
+import os
+from typing import Collection, Dict, List, Tuple
+
+from loguru import logger
+
+
+@dataclasses.dataclass(kw_only=True, slots=True)
+class LocalFile:
+    path: str  # relative to scanned directory, parts are separated by '/'
+    size: int
+    mtime: int  # nanoseconds
+    inode: int
+
+    def same_stat(self, other: "LocalFile") -> bool:
+        return (self.size, self.mtime, self.inode) == (other.size, other.mtime, other.inode)
+
+
+def _scan_directory(root: str, directory: str) -> Tuple[List[LocalFile], List[str]]:
+    """
+    List regular files and subdirectories of directory (relative to root), symlinks are skipped
+    """
+    files, subdirectories = [], []
+    try:
+        with os.scandir(os.path.join(root, directory)) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(f"{directory}{entry.name}/")
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    files.append(LocalFile(path=directory + entry.name, size=stat.st_size,
+                                           mtime=stat.st_mtime_ns, inode=stat.st_ino))
+    except OSError as e:
+        logger.warning(f"Cannot scan {os.path.join(root, directory)}: {e}")
+    return files, subdirectories
+
+
+def scan(root: str, thread_num: int = 8, exclude: Collection[str] = ()) -> Dict[str, LocalFile]:
+    """
+    Get regular files of directory tree by relative path
+
+    Every directory is listed by a task of thread pool, so stat calls of many directories overlap.
+    Paths in exclude aren't returned
+    """
+    files = {}
+    with concurrent.futures.ThreadPoolExecutor(thread_num) as executor:
+        pending = {executor.submit(_scan_directory, root, "")}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                directory_files, subdirectories = future.result()
+                files.update((file.path, file) for file in directory_files if file.path not in exclude)
+                pending.update(executor.submit(_scan_directory, root, directory) for directory in subdirectories)
+    return files
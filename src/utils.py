@@ -1,10 +1,30 @@
+import concurrent.futures
 import hashlib
+import os
+from typing import List
 
 
-def sha1_checksum(path: str):
+def sha1_checksum(path: str, chunk_size: int = 4096):
     h = hashlib.sha1()
     with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(chunk_size), b""):
             h.update(chunk)
     return h.hexdigest()
 
+
+def block_hashes(path: str, block_size: int, thread_num: int = 4) -> List[str]:
+    """
+    Get sha256 of every block of file (the same as content_hash of uploaded blocks)
+
+    Blocks are read and hashed by threads, hashlib releases GIL for big data
+    """
+    size = os.path.getsize(path)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        def block_hash(offset: int) -> str:
+            return hashlib.sha256(os.pread(fd, block_size, offset)).hexdigest()
+
+        with concurrent.futures.ThreadPoolExecutor(thread_num) as executor:
+            return list(executor.map(block_hash, range(0, size, block_size)))
+    finally:
+        os.close(fd)
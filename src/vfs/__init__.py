@@ -0,0 +1,29 @@
+import importlib
+
+# block reader and write-back import http client, so submodules are imported on first access
+_exports = {
+    "VFS": ".vfs",
+    "Page": ".vfs",
+    "BlockCache": ".block_cache",
+    "BlockReader": ".block_reader",
+    "BlockReaderConfig": ".block_reader",
+    "Versions": ".versions",
+    "UPLOAD_DIRECTORY": ".versions",
+    "VERSIONS_DIRECTORY": ".versions",
+    "SNAPSHOTS_DIRECTORY": ".versions",
+    "TRASH_DIRECTORY": ".versions",
+    "HIDDEN_DIRECTORIES": ".versions",
+    "WriteBack": ".write_back",
+    "WriteBackConfig": ".write_back",
+    "FsyncMode": ".write_back",
+}
+
+
+def __getattr__(name: str):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_exports[name], __name__), name)
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_exports))
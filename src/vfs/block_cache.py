@@ -0,0 +1,106 @@
+import asyncio
+import collections
+import os
+from typing import Optional
+
+from loguru import logger
+
+
+class BlockCache:
+    """
+    Least recently used blocks kept in memory and in directory on disk
+
+    Blocks pushed out of memory are still read from disk until the disk part is full too.
+    Disk part survives restarts: files of previous runs are reused from the oldest one
+    """
+
+    def __init__(self, memory_size: int, disk_size: int = 0, path: str = ""):
+        self._memory_size = memory_size
+        self._disk_size = disk_size if path else 0
+        self._path = path
+        self._memory: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+        self._memory_used = 0
+        self._disk: collections.OrderedDict[str, int] = collections.OrderedDict()  # key -> size
+        self._disk_used = 0
+        self.hits = 0
+        self.misses = 0
+
+        if self._disk_size:
+            os.makedirs(path, exist_ok=True)
+            entries = [entry for entry in os.scandir(path) if entry.is_file() and not entry.name.endswith(".tmp")]
+            for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+                self._disk[entry.name] = entry.stat().st_size
+                self._disk_used += entry.stat().st_size
+            self._evict_disk()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self._path, key)
+
+    def _evict_memory(self) -> None:
+        while self._memory_used > self._memory_size and self._memory:
+            _, data = self._memory.popitem(last=False)
+            self._memory_used -= len(data)
+
+    def _evict_disk(self) -> None:
+        while self._disk_used > self._disk_size and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            try:
+                os.remove(self._file(key))
+            except OSError as e:
+                logger.error(f"Cannot remove cached block {key}: {e}")
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        if len(data) > self._memory_size:
+            return
+        self._memory[key] = data
+        self._memory_used += len(data)
+        self._evict_memory()
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._file(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key: str, data: bytes) -> None:
+        # written under temporary name, so a block is never read half written
+        with open(self._file(key) + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(self._file(key) + ".tmp", self._file(key))
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return data
+
+        if key in self._disk:
+            self._disk.move_to_end(key)
+            data = await asyncio.to_thread(self._read_disk, key)
+            if data is not None and len(data) == self._disk[key]:
+                self._put_memory(key, data)
+                self.hits += 1
+                return data
+            self._disk_used -= self._disk.pop(key)
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, data: bytes) -> None:
+        if key in self._memory:
+            return
+        self._put_memory(key, data)
+
+        if not self._disk_size or key in self._disk or len(data) > self._disk_size:
+            return
+        try:
+            await asyncio.to_thread(self._write_disk, key, data)
+        except OSError as e:
+            logger.error(f"Cannot cache block {key}: {e}")
+            return
+        self._disk[key] = len(data)
+        self._disk_used += len(data)
+        self._evict_disk()
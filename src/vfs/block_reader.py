@@ -0,0 +1,134 @@
+import asyncio
+import collections
+import dataclasses
+from typing import Dict, List, Optional, Tuple
+
+import entity
+import exceptions
+import repository
+from network.downloader import Downloader, DownloaderConfig
+from network.storage_base import DownloadStatus
+from .block_cache import BlockCache
+
+
+@dataclasses.dataclass(kw_only=True)
+class BlockReaderConfig:
+    memory_cache: int = 256 * 2 ** 20  # bytes of blocks kept in memory
+    disk_cache: int = 2 * 2 ** 30  # bytes of blocks kept in cache_path (0 - disable)
+    cache_path: str = ""  # directory of disk cache ('' - disable)
+    read_ahead: int = 4  # blocks downloaded ahead of sequential reads
+    race_num: int = 2  # replicas of block downloaded at once, the first one is used
+    parallel_num: int = 4  # simultaneous block downloads
+    layout_cache: int = 1024  # files which blocks are kept in memory
+
+
+class BlockReader:
+    """
+    Read ranges of files by whole blocks through cache
+
+    Reading at the end of the previous read of the same file is sequential,
+    then the next read_ahead blocks are downloaded in background
+    """
+
+    def __init__(self, block_repo: "repository.MetadataStore", config: Optional[BlockReaderConfig] = None):
+        config = config or BlockReaderConfig()
+        self._block_repo = block_repo
+        self._config = config
+        self._downloader = Downloader(block_repo, DownloaderConfig(parallel_num=config.parallel_num))
+        self._cache = BlockCache(config.memory_cache, config.disk_cache, config.cache_path)
+        self._semaphore = asyncio.Semaphore(config.parallel_num)
+        self._layouts: collections.OrderedDict[int, Tuple[int, Tuple[List[entity.Block]]]] = \
+            collections.OrderedDict()
+        self._fetching: Dict[str, asyncio.Task] = {}
+        self._ends: Dict[int, int] = {}  # file id -> end of the last read
+
+    async def __aenter__(self):
+        await self._downloader.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        for task in self._fetching.values():
+            task.cancel()
+        await asyncio.gather(*self._fetching.values(), return_exceptions=True)
+        await self._downloader.__aexit__(exc_type, exc_val, exc_tb)
+
+    @property
+    def cache(self) -> BlockCache:
+        return self._cache
+
+    async def _layout(self, file: entity.File) -> Tuple[int, Tuple[List[entity.Block]]]:
+        """
+        Size of block and replicas of every block number
+        """
+        layout = self._layouts.get(file.id)
+        if layout is None:
+            groups = await self._block_repo.get_blocks_grouped_by_number(file)
+            # all blocks except the last one have the size of the first
+            layout = (groups[0][0].size if groups and groups[0] else file.size, groups)
+            self._layouts[file.id] = layout
+            if len(self._layouts) > self._config.layout_cache:
+                self._layouts.popitem(last=False)
+        else:
+            self._layouts.move_to_end(file.id)
+        return layout
+
+    @staticmethod
+    def _key(file: entity.File, block_size: int, number: int) -> str:
+        # files with the same content have the same blocks
+        return f"{file.checksum or file.id}-{block_size}-{number}"
+
+    async def _download(self, key: str, group: List[entity.Block]) -> bytes:
+        async with self._semaphore:
+            status, data = await self._downloader.download_first(group, self._config.race_num)
+        if status != DownloadStatus.OK:
+            raise exceptions.BlockDownloadFailed(f"Cannot download block {key}: {status}")
+        await self._cache.put(key, data)
+        return data
+
+    async def _block(self, file: entity.File, number: int) -> bytes:
+        block_size, groups = await self._layout(file)
+        if number >= len(groups) or not groups[number]:
+            raise exceptions.BlockDownloadFailed(f"File {file.filename} has no block {number}")
+
+        key = self._key(file, block_size, number)
+        task = self._fetching.get(key)
+        if task is None:
+            data = await self._cache.get(key)
+            if data is not None:
+                return data
+            task = asyncio.create_task(self._download(key, groups[number]))
+            self._fetching[key] = task
+            task.add_done_callback(lambda _: self._fetching.pop(key, None))
+        return await asyncio.shield(task)
+
+    def _read_ahead(self, file: entity.File, numbers: range, block_count: int) -> None:
+        for number in range(numbers.stop, min(numbers.stop + self._config.read_ahead, block_count)):
+            task = asyncio.create_task(self._block(file, number))
+            # errors are raised again when block is read
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def read(self, file: entity.File, offset: int, size: int) -> bytes:
+        """
+        Read size bytes of file from offset (less at the end of file)
+
+        Raise BlockDownloadFailed if no replica of a block can be downloaded
+        """
+        size = max(0, min(size, file.size - offset))
+        if not size:
+            return bytes()
+
+        block_size, groups = await self._layout(file)
+        numbers = range(offset // block_size, (offset + size - 1) // block_size + 1)
+        sequential = offset == 0 or self._ends.get(file.id) == offset
+        self._ends[file.id] = offset + size
+
+        blocks = asyncio.gather(*(self._block(file, number) for number in numbers))
+        if sequential:
+            self._read_ahead(file, numbers, len(groups))
+
+        # only the requested parts of blocks are copied
+        parts = []
+        for number, data in zip(numbers, await blocks):
+            start = max(offset - number * block_size, 0)
+            parts.append(data[start:offset + size - number * block_size])
+        return b"".join(parts)
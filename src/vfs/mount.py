@@ -0,0 +1,266 @@
+"""
+FUSE filesystem of catalog, read-only or writable with write-back staging
+
+Needs libfuse, so it's imported only by 'mount' command
+"""
+import asyncio
+import contextlib
+import errno
+import functools
+import itertools
+import os
+import shutil
+import stat
+import subprocess
+import time
+from typing import Dict, List, Optional, Set, Union
+
+from fuse import FUSE, FuseOSError, Operations
+from loguru import logger
+
+import entity
+import exceptions
+import repository
+from network.balancer import Balancer
+from .block_reader import BlockReader, BlockReaderConfig
+from .vfs import VFS
+from .versions import TRASH_DIRECTORY, UPLOAD_DIRECTORY
+from .write_back import Staged, WriteBack, WriteBackConfig
+
+_ERRNO = {
+    exceptions.UnknownFile: errno.ENOENT,
+    exceptions.FileAlreadyExists: errno.EEXIST,
+    exceptions.NotEnoughSpace: errno.ENOSPC,
+    exceptions.NoStorage: errno.ENOSPC,
+}
+
+
+class RaidFS(Operations):
+    """
+    FUSE calls operations from its threads, they are run in event loop of catalog and wait for result
+
+    Without write_back filesystem is read-only. Directories exist while they have files,
+    empty directories made by mkdir are kept only in memory
+    """
+
+    def __init__(self, vfs: VFS, reader: BlockReader, loop: asyncio.AbstractEventLoop,
+                 write_back: Optional[WriteBack] = None):
+        self._vfs = vfs
+        self._reader = reader
+        self._loop = loop
+        self._write_back = write_back
+        self._files: Dict[int, Union[entity.File, Staged]] = {}
+        self._handles = itertools.count(1)
+        self._directories: Set[str] = set()
+        self._time = time.time()
+
+    def _run(self, coro):
+        try:
+            return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+        except exceptions.ErrorBase as e:
+            if type(e) not in _ERRNO:
+                logger.exception(e)
+            raise FuseOSError(_ERRNO.get(type(e), errno.EIO))
+
+    def _writable(self) -> WriteBack:
+        if not self._write_back:
+            raise FuseOSError(errno.EROFS)
+        return self._write_back
+
+    def _handle(self, file: Union[entity.File, Staged]) -> int:
+        fh = next(self._handles)
+        self._files[fh] = file
+        return fh
+
+    def _staged(self, fh: int) -> Staged:
+        file = self._files.get(fh)
+        if not isinstance(file, Staged):
+            raise FuseOSError(errno.EBADF)
+        return file
+
+    async def _lookup(self, path: str) -> Union[entity.File, entity.Directory, Staged]:
+        """
+        Raise UnknownFile if there is no file or directory
+        """
+        staged = self._write_back.get(path.strip("/")) if self._write_back else None
+        if staged:
+            return staged
+        try:
+            return await self._vfs.stat(path)
+        except exceptions.UnknownFile:
+            directory = VFS.normalize(path)
+            if directory in self._directories or (self._write_back and any(self._write_back.list(directory))):
+                return entity.Directory(path=directory)
+            raise
+
+    def getattr(self, path, fh=None):
+        entry = self._files[fh] if fh in self._files else self._run(self._lookup(path))
+        attrs = dict(st_uid=os.getuid(), st_gid=os.getgid(),
+                     st_atime=self._time, st_mtime=self._time, st_ctime=self._time)
+        mode = 0o755 if self._write_back else 0o555
+        if isinstance(entry, entity.Directory):
+            return dict(attrs, st_mode=stat.S_IFDIR | mode, st_nlink=2, st_size=0)
+        return dict(attrs, st_mode=stat.S_IFREG | (mode & 0o666), st_nlink=1, st_size=entry.size)
+
+    async def _names(self, path: str) -> List[str]:
+        directory = VFS.normalize(path)
+        names = {}
+        async for _, entry in self._vfs.tree(directory, depth=0):
+            if isinstance(entry, entity.Directory):
+                if entry.path not in (UPLOAD_DIRECTORY, TRASH_DIRECTORY):
+                    names[entry.name.rstrip("/")] = None
+            else:
+                names[entry.filename.rsplit("/", 1)[-1]] = None
+
+        # staged files and directories which aren't uploaded yet
+        subdirectories = {path for path in self._directories if VFS.normalize(os.path.dirname(path[:-1])) == directory}
+        if self._write_back:
+            files, staged_subdirectories = self._write_back.list(directory)
+            names.update((staged.filename.rsplit("/", 1)[-1], None) for staged in files)
+            subdirectories |= staged_subdirectories
+        names.update((path[len(directory):-1], None) for path in sorted(subdirectories))
+        return list(names)
+
+    def readdir(self, path, fh):
+        if not isinstance(self._run(self._lookup(path)), entity.Directory):
+            raise FuseOSError(errno.ENOTDIR)
+        return [".", ".."] + self._run(self._names(path))
+
+    def open(self, path, flags):
+        entry = self._run(self._lookup(path))
+        if isinstance(entry, entity.Directory):
+            raise FuseOSError(errno.EISDIR)
+        if flags & (os.O_WRONLY | os.O_RDWR) or isinstance(entry, Staged):
+            # staged file is kept until it is closed
+            write_back = self._writable()
+            return self._handle(self._run(write_back.open(path.strip("/"), bool(flags & os.O_TRUNC))))
+        return self._handle(entry)
+
+    def create(self, path, mode, fi=None):
+        return self._handle(self._run(self._writable().create(path.strip("/"))))
+
+    async def _read_staged(self, staged: Staged, size: int, offset: int) -> bytes:
+        return WriteBack.read(staged, size, offset)
+
+    def read(self, path, size, offset, fh):
+        file = self._files[fh]
+        if isinstance(file, Staged):
+            return self._run(self._read_staged(file, size, offset))
+        return self._run(self._reader.read(file, offset, size))
+
+    def write(self, path, data, offset, fh):
+        return self._run(self._writable().write(self._staged(fh), data, offset))
+
+    def truncate(self, path, length, fh=None):
+        write_back = self._writable()
+        if fh in self._files:
+            self._run(write_back.truncate(self._staged(fh), length))
+            return 0
+        fh = self.open(path, os.O_WRONLY | (os.O_TRUNC if not length else 0))
+        try:
+            self._run(write_back.truncate(self._staged(fh), length))
+        finally:
+            self.release(path, fh)
+        return 0
+
+    def flush(self, path, fh):
+        return 0
+
+    def fsync(self, path, datasync, fh):
+        if isinstance(self._files.get(fh), Staged):
+            self._run(self._write_back.fsync(self._staged(fh)))
+        return 0
+
+    async def _release(self, staged: Staged) -> None:
+        self._write_back.release(staged)
+
+    def release(self, path, fh):
+        file = self._files.pop(fh, None)
+        if isinstance(file, Staged):
+            self._run(self._release(file))
+        return 0
+
+    def unlink(self, path):
+        self._run(self._writable().unlink(path.strip("/")))
+        return 0
+
+    def rename(self, old, new):
+        write_back = self._writable()
+        if isinstance(self._run(self._lookup(old)), entity.Directory):
+            # tools like mv copy directory instead
+            raise FuseOSError(errno.EXDEV)
+        self._run(write_back.rename(old.strip("/"), new.strip("/")))
+        return 0
+
+    def mkdir(self, path, mode):
+        self._writable()
+        try:
+            self._run(self._lookup(path))
+        except FuseOSError:
+            self._directories.add(VFS.normalize(path))
+            return 0
+        raise FuseOSError(errno.EEXIST)
+
+    def rmdir(self, path):
+        self._writable()
+        if not isinstance(self._run(self._lookup(path)), entity.Directory):
+            raise FuseOSError(errno.ENOTDIR)
+        if self._run(self._names(path)):
+            raise FuseOSError(errno.ENOTEMPTY)
+        self._directories.discard(VFS.normalize(path))
+        return 0
+
+    def chmod(self, path, mode):
+        # catalog has no modes and times, but copying tools set them
+        self._writable()
+        return 0
+
+    def chown(self, path, uid, gid):
+        self._writable()
+        return 0
+
+    def utimens(self, path, times=None):
+        self._writable()
+        return 0
+
+    def statfs(self, path):
+        root = self._run(self._vfs.get_directory(""))
+        return dict(f_bsize=4096, f_frsize=4096, f_blocks=-(-root.size // 4096), f_bfree=0, f_bavail=0,
+                    f_files=root.file_count, f_ffree=0, f_namemax=255)
+
+
+def _unmount(mountpoint: str) -> None:
+    command = shutil.which("fusermount3") or shutil.which("fusermount")
+    subprocess.run([command, "-u", mountpoint] if command else ["umount", mountpoint], check=False)
+
+
+async def mount(block_repo: "repository.MetadataStore", mountpoint: str,
+                config: Optional[BlockReaderConfig] = None,
+                balancer: Optional[Balancer] = None,
+                write_back_config: Optional[WriteBackConfig] = None) -> None:
+    """
+    Serve catalog at mountpoint until it is unmounted (or the task is cancelled)
+
+    Filesystem is writable if balancer for uploads is given
+    """
+    loop = asyncio.get_running_loop()
+    async with contextlib.AsyncExitStack() as stack:
+        reader = await stack.enter_async_context(BlockReader(block_repo, config))
+        write_back = None
+        if balancer:
+            # staged files are uploaded on exit unless mount is cancelled
+            write_back = await stack.enter_async_context(WriteBack(block_repo, balancer, reader, write_back_config))
+        fs = RaidFS(VFS(block_repo), reader, loop, write_back)
+        serving = loop.run_in_executor(None, functools.partial(FUSE, fs, mountpoint, foreground=True,
+                                                               ro=not write_back, fsname="cloud-raid",
+                                                               nothreads=False))
+        logger.info(f"Catalog mounted at {mountpoint}")
+        try:
+            await asyncio.shield(serving)
+        except asyncio.CancelledError:
+            # FUSE returns in its thread when mountpoint is unmounted
+            _unmount(mountpoint)
+            raise
+        finally:
+            logger.info(f"Catalog unmounted from {mountpoint}, cache hits: {reader.cache.hits}, "
+                        f"misses: {reader.cache.misses}")
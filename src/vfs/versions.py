@@ -0,0 +1,158 @@
+import datetime
+import uuid
+from typing import Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+from loguru import logger
+
+import entity
+import exceptions
+import repository
+
+if TYPE_CHECKING:
+    from network.scheduler import TransferScheduler
+
+UPLOAD_DIRECTORY = ".uploading/"  # files are uploaded here and then renamed
+VERSIONS_DIRECTORY = ".versions/"  # version of 'a/b' is '.versions/a/b/<time>'
+SNAPSHOTS_DIRECTORY = ".snapshots/"  # snapshot 'name' is '.snapshots/name/' with copies of files
+TRASH_DIRECTORY = ".trash/"  # replaced files waiting for deletion of their blocks
+HIDDEN_DIRECTORIES = (UPLOAD_DIRECTORY, VERSIONS_DIRECTORY, SNAPSHOTS_DIRECTORY, TRASH_DIRECTORY)
+
+
+class Versions:
+    """
+    Old versions of files and point-in-time snapshots of catalog
+
+    Versions and snapshots are files in hidden directories, their blocks share data in storages
+    with current files, so only changed blocks take space. Data is deleted from storage
+    when the last block using it is deleted
+    """
+
+    def __init__(self, block_repo: "repository.MetadataStore", scheduler: Optional["TransferScheduler"] = None):
+        self._block_repo = block_repo
+        self._scheduler = scheduler  # session of deleted blocks
+
+    @staticmethod
+    def version_name(filename: str, time: Optional[datetime.datetime] = None) -> str:
+        time = time or datetime.datetime.now(datetime.timezone.utc)
+        return f"{VERSIONS_DIRECTORY}{filename}/{time.strftime('%Y%m%dT%H%M%S.%fZ')}"
+
+    async def delete_files(self, files: Iterable[entity.File]) -> List[entity.File]:
+        """
+        Delete files and data of their blocks which isn't shared with other files
+
+        Return deleted files (files with blocks not deleted from storages are kept)
+        """
+        # deleter imports http client, listing of versions and snapshots doesn't need it
+        from network.deleter import Deleter
+
+        deleted = []
+        async with Deleter(self._block_repo, scheduler=self._scheduler) as deleter:
+            for file in files:
+                failed = await deleter.delete_blocks(await self._block_repo.get_blocks_by_file(file))
+                if failed:
+                    logger.error(f"Cannot delete {len(failed)} blocks of {file.filename}")
+                    continue
+                await self._block_repo.del_file(file)
+                deleted.append(file)
+        await self._block_repo.commit()
+        return deleted
+
+    # VERSIONS
+
+    async def replace(self, file: entity.File, filename: str, keep_version: bool = False) -> None:
+        """
+        Rename uploaded file to filename replacing file with this name by one commit
+
+        Replaced file becomes the latest version if keep_version is set, otherwise it is moved to trash
+        by the same commit and deleted after it, so its blocks are deleted even if this is interrupted
+        (see purge_trash)
+        """
+        old = None
+        try:
+            old = await self._block_repo.get_file_by_filename(filename)
+        except exceptions.UnknownFile:
+            pass
+
+        replaced = self.version_name(filename) if keep_version else TRASH_DIRECTORY + uuid.uuid4().hex
+        if old:
+            await self._block_repo.rename_file(old, replaced)
+        await self._block_repo.rename_file(file, filename)
+        await self._block_repo.commit()
+
+        if old and not keep_version:
+            await self.delete_files([await self._block_repo.get_file_by_filename(replaced)])
+
+    async def purge_trash(self) -> int:
+        """
+        Delete files left in trash by interrupted replaces, return number of deleted files
+        """
+        files = await self._block_repo.get_files_by_directory(TRASH_DIRECTORY)
+        for file in files:
+            logger.info(f"Delete replaced file {file.filename}")
+        return len(await self.delete_files(files)) if files else 0
+
+    async def list(self, filename: str) -> Tuple[entity.File]:
+        """
+        Get versions of file from the oldest one, version is the last part of their filenames
+        """
+        return await self._block_repo.get_files_by_directory(f"{VERSIONS_DIRECTORY}{filename}/")
+
+    async def restore(self, filename: str, version: str) -> None:
+        """
+        Make copy of version the current file, the current file becomes version
+
+        Raise UnknownFile if there is no such version
+        """
+        source = await self._block_repo.get_file_by_filename(f"{VERSIONS_DIRECTORY}{filename}/{version}")
+        copy = await self._block_repo.copy_file(source, UPLOAD_DIRECTORY + uuid.uuid4().hex)
+        await self.replace(copy, filename, keep_version=True)
+
+    async def prune(self, filename: str, keep: int) -> int:
+        """
+        Delete all but keep latest versions of file, return number of deleted versions
+        """
+        versions = await self.list(filename)
+        return len(await self.delete_files(versions[:max(len(versions) - keep, 0)]))
+
+    # SNAPSHOTS
+
+    @staticmethod
+    def snapshot_path(name: str) -> str:
+        if not name or "/" in name:
+            raise ValueError(f"Wrong snapshot name {name!r}")
+        return f"{SNAPSHOTS_DIRECTORY}{name}/"
+
+    async def create_snapshot(self, name: str, prefix: str = "") -> int:
+        """
+        Copy files which filenames start with prefix to snapshot directory, hidden directories aren't copied
+
+        Raise FileAlreadyExists if snapshot exists. Return number of files in snapshot
+        """
+        path = self.snapshot_path(name)
+        try:
+            await self._block_repo.get_directory(path)
+            raise exceptions.FileAlreadyExists(path)
+        except exceptions.UnknownDirectory:
+            pass
+        count = await self._block_repo.copy_files(prefix, path + prefix, exclude=HIDDEN_DIRECTORIES)
+        await self._block_repo.commit()
+        return count
+
+    async def list_snapshots(self) -> Tuple[entity.Directory]:
+        return await self._block_repo.get_subdirectories(SNAPSHOTS_DIRECTORY)
+
+    async def delete_snapshot(self, name: str, batch_size: int = 500) -> int:
+        """
+        Delete files of snapshot by batches, return number of deleted files
+
+        Raise UnknownDirectory if there is no such snapshot
+        """
+        path = self.snapshot_path(name)
+        await self._block_repo.get_directory(path)
+        count = 0
+        start = path
+        while files := await self._block_repo.get_files_by_range(start, repository.MetadataStore.prefix_end(path),
+                                                                 batch_size):
+            count += len(await self.delete_files(files))
+            start = files[-1].filename + "\0"
+        return count
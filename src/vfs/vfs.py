@@ -0,0 +1,111 @@
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional, Tuple, Union
+
+import exceptions
+import repository
+from entity import Directory, File
+
+Entry = Union[Directory, File]
+
+
+@dataclass(kw_only=True)
+class Page:
+    entries: Tuple[Entry, ...] = field(default_factory=tuple)
+    next: Optional[str] = None  # pass as after to get the next page, None - last page
+
+
+class VFS:
+    """
+    Directory tree over filenames of catalog
+
+    Filenames are split by '/', directory paths end with '/' and the root is an empty path.
+    Directories with their sizes are kept in catalog, so listing reads one page by index
+    whatever the number of files
+    """
+
+    def __init__(self, store: repository.MetadataStore, page_size: int = 100):
+        self._store = store
+        self._page_size = page_size
+
+    @staticmethod
+    def normalize(path: str) -> str:
+        """
+        Path of directory as it is kept in catalog: without leading '/' and with trailing one
+        """
+        path = path.strip("/")
+        if path in ("", "."):
+            return ""
+        return path + "/"
+
+    @staticmethod
+    def key(entry: Entry) -> str:
+        return entry.path if isinstance(entry, Directory) else entry.filename
+
+    async def stat(self, path: str) -> Entry:
+        """
+        Get file or directory by path
+
+        Raise UnknownFile if there is neither of them
+        """
+        try:
+            return await self._store.get_file_by_filename(path.strip("/"))
+        except exceptions.UnknownFile:
+            pass
+        try:
+            return await self.get_directory(path)
+        except exceptions.UnknownDirectory:
+            raise exceptions.UnknownFile()
+
+    async def get_directory(self, path: str) -> Directory:
+        """
+        Raise UnknownDirectory if directory has no files, the root always exists
+        """
+        path = self.normalize(path)
+        try:
+            return await self._store.get_directory(path)
+        except exceptions.UnknownDirectory:
+            if path:
+                raise
+            return Directory(path="")
+
+    async def list(self, path: str, after: str = "", limit: Optional[int] = None) -> Page:
+        """
+        Get subdirectories and files of directory ordered by path after given one
+        """
+        path = self.normalize(path)
+        limit = limit or self._page_size
+        directories = await self._store.get_subdirectories(path, after, limit + 1)
+        files = await self._store.get_files_by_directory(path, after, limit + 1)
+        entries = sorted(directories + files, key=self.key)
+        if len(entries) <= limit:
+            return Page(entries=tuple(entries))
+        return Page(entries=tuple(entries[:limit]), next=self.key(entries[limit - 1]))
+
+    async def find(self, prefix: str, after: str = "", limit: Optional[int] = None) -> Page:
+        """
+        Get files which filenames start with prefix ordered by filename after given one
+        """
+        limit = limit or self._page_size
+        prefix = prefix.lstrip("/")
+        # the least string greater than after is after + '\0'
+        start = max(prefix, after + "\0") if after else prefix
+        end = repository.MetadataStore.prefix_end(prefix)
+        files = await self._store.get_files_by_range(start, end, limit + 1)
+        if len(files) <= limit:
+            return Page(entries=files)
+        return Page(entries=files[:limit], next=files[limit - 1].filename)
+
+    async def tree(self, path: str = "", depth: Optional[int] = None) -> AsyncIterator[Tuple[int, Entry]]:
+        """
+        Walk directory in depth-first order page by page, yield level and entry
+
+        :param depth: levels of subdirectories to walk into, None - all
+        """
+        page = Page(next="")
+        while page.next is not None:
+            page = await self.list(path, page.next)
+            for entry in page.entries:
+                yield 0, entry
+                if isinstance(entry, Directory) and (depth is None or depth > 0):
+                    async for level, subentry in self.tree(entry.path, None if depth is None else depth - 1):
+                        yield level + 1, subentry
@@ -0,0 +1,446 @@
+import asyncio
+import contextlib
+import dataclasses
+import enum
+import os
+import shutil
+import uuid
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from loguru import logger
+
+import entity
+import exceptions
+import repository
+from network.balancer import Balancer
+from network.uploader import Uploader, UploaderConfig
+from .block_reader import BlockReader
+from .versions import UPLOAD_DIRECTORY, Versions
+
+
+class FsyncMode(enum.Enum):
+    NONE = "none"  # return at once, file is uploaded after it is closed
+    LOCAL = "local"  # write staged file to local disk
+    UPLOAD = "upload"  # wait until file is uploaded to storages
+
+    def __str__(self):
+        return self.value
+
+    @staticmethod
+    def from_str(s: str) -> Union["FsyncMode", None]:
+        for _, v in FsyncMode.__members__.items():
+            if v.value == s:
+                return v
+        return None
+
+
+@dataclasses.dataclass(kw_only=True)
+class WriteBackConfig:
+    staging_path: str = "staging"
+    staging_size: int = 4 * 2 ** 30  # bytes of staged files, writes wait for uploads when it is full
+    fsync: FsyncMode = FsyncMode.LOCAL
+    flush_delay: float = 2  # seconds after file is closed before its upload
+    retry_delay: float = 30  # seconds before the next upload of file which failed
+    parallel_num: int = 2  # files uploaded at once
+    block_parallel_num: int = 5  # blocks of one file uploaded at once
+    duplicate_count: int = 1
+    need_encrypt: bool = False
+    keep_versions: bool = False  # replaced content is kept as version of file
+
+
+@dataclasses.dataclass(kw_only=True)
+class Staged:
+    filename: str
+    path: str  # local file in staging directory
+    fd: int
+    size: int = 0
+    open_count: int = 0
+    version: int = 0  # incremented by every change
+    uploaded_version: int = 0
+    failed_version: int = 0
+    sync_count: int = 0  # fsync calls waiting for upload
+    deleted: bool = False
+
+
+class WriteBack:
+    """
+    Keep written files in local staging directory and upload them in background
+
+    Writes return as soon as data is in staging file. File is uploaded flush_delay seconds
+    after the last writer closes it: its copy is uploaded under UPLOAD_DIRECTORY and then replaces
+    file with the same name in catalog, so readers see either old or new content.
+    Only blocks which differ from the replaced content are uploaded.
+    Every staged file has '.name' file with its filename written when its content is complete,
+    so files staged by previous run are uploaded on start
+    """
+
+    def __init__(self,
+                 block_repo: "repository.MetadataStore",
+                 balancer: Balancer,
+                 reader: BlockReader,
+                 config: Optional[WriteBackConfig] = None):
+        self._block_repo = block_repo
+        self._balancer = balancer
+        self._reader = reader
+        self._config = config or WriteBackConfig()
+        self._versions = Versions(block_repo)
+        self._staged: Dict[str, Staged] = {}
+        self._used = 0
+        self._changed = asyncio.Condition()  # notified when space is freed or upload ends
+        self._semaphore = asyncio.Semaphore(self._config.parallel_num)
+        self._timers: Dict[int, asyncio.TimerHandle] = {}  # id of staged -> scheduled upload
+        self._uploads: Dict[int, asyncio.Task] = {}  # id of staged -> running upload
+
+    async def __aenter__(self):
+        os.makedirs(self._config.staging_path, exist_ok=True)
+        await self._recover()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.drain()
+        for timer in self._timers.values():
+            timer.cancel()
+        for task in self._uploads.values():
+            task.cancel()
+        await asyncio.gather(*self._uploads.values(), return_exceptions=True)
+        for staged in self._staged.values():
+            os.close(staged.fd)
+
+    async def _recover(self) -> None:
+        """
+        Delete uploads and replaced files left by previous run and upload files it staged
+        """
+        await self._versions.purge_trash()
+        for file in await self._block_repo.get_files_by_directory(UPLOAD_DIRECTORY):
+            logger.info(f"Delete interrupted upload {file.filename}")
+            await self._delete_file(file)
+
+        for name in os.listdir(self._config.staging_path):
+            path = os.path.join(self._config.staging_path, name)
+            if name.endswith(".upload"):
+                os.remove(path)
+            elif not name.endswith(".name"):
+                try:
+                    with open(path + ".name") as f:
+                        filename = f.read()
+                except FileNotFoundError:
+                    os.remove(path)
+                    continue
+                staged = Staged(filename=filename, path=path, fd=os.open(path, os.O_RDWR),
+                                size=os.path.getsize(path), version=1)
+                self._staged[filename] = staged
+                self._used += staged.size
+                logger.info(f"Upload {filename} staged by previous run")
+                self._schedule(staged, 0)
+
+    # STAGING
+
+    def get(self, filename: str) -> Optional[Staged]:
+        return self._staged.get(filename)
+
+    def list(self, directory: str) -> Tuple[List[Staged], Set[str]]:
+        """
+        Get staged files of directory and its subdirectories with staged files
+        """
+        files, subdirectories = [], set()
+        for filename, staged in self._staged.items():
+            if not filename.startswith(directory):
+                continue
+            name, slash, _ = filename[len(directory):].partition("/")
+            if slash:
+                subdirectories.add(directory + name + "/")
+            else:
+                files.append(staged)
+        return files, subdirectories
+
+    async def _reserve(self, size: int) -> None:
+        """
+        Wait until staging has space for size bytes more
+
+        Raise NotEnoughSpace if no upload can free it
+        """
+        async with self._changed:
+            while self._used + size > self._config.staging_size:
+                if not self._uploads and not self._timers:
+                    raise exceptions.NotEnoughSpace()
+                await self._changed.wait()
+            self._used += size
+
+    async def _free(self, size: int) -> None:
+        async with self._changed:
+            self._used -= size
+            self._changed.notify_all()
+
+    @staticmethod
+    def _write_name(staged: Staged) -> None:
+        # renamed when complete, so a crash leaves either the whole name or no name (and the file is removed)
+        with open(staged.path + ".name.tmp", "w") as f:
+            f.write(staged.filename)
+        os.replace(staged.path + ".name.tmp", staged.path + ".name")
+
+    def _add(self, filename: str) -> Staged:
+        path = os.path.join(self._config.staging_path, uuid.uuid4().hex)
+        staged = Staged(filename=filename, path=path, fd=os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC))
+        self._staged[filename] = staged
+        return staged
+
+    async def create(self, filename: str) -> Staged:
+        """
+        Stage empty file which replaces file with the same name
+        """
+        staged = self._staged.get(filename)
+        if staged:
+            await self.truncate(staged, 0)
+        else:
+            staged = self._add(filename)
+            self._write_name(staged)
+        staged.version += 1
+        staged.open_count += 1
+        self._cancel_timer(staged)
+        return staged
+
+    async def open(self, filename: str, truncate: bool = False) -> Staged:
+        """
+        Open file for writing, content of file in catalog is downloaded to staging unless it is truncated
+
+        Raise UnknownFile if file isn't staged and isn't in catalog
+        """
+        staged = self._staged.get(filename)
+        if staged is None:
+            file = await self._block_repo.get_file_by_filename(filename)
+            if truncate:
+                return await self.create(filename)
+            staged = self._add(filename)
+            staged.version += 1
+            staged.open_count += 1
+            try:
+                await self._reserve(file.size)
+                staged.size = file.size
+                chunk_size = 4 * 2 ** 20
+                for offset in range(0, file.size, chunk_size):
+                    os.pwrite(staged.fd, await self._reader.read(file, offset, chunk_size), offset)
+                # name is written after the whole copy, so the next run doesn't upload a partial one
+                self._write_name(staged)
+            except Exception:
+                # partial copy mustn't replace file
+                staged.open_count -= 1
+                staged.deleted = True
+                await self._discard(staged)
+                raise
+            return staged
+
+        staged.open_count += 1
+        self._cancel_timer(staged)
+        if truncate:
+            await self.truncate(staged, 0)
+        return staged
+
+    async def write(self, staged: Staged, data: bytes, offset: int) -> int:
+        end = offset + len(data)
+        if end > staged.size:
+            await self._reserve(end - staged.size)
+            staged.size = end
+        staged.version += 1
+        return os.pwrite(staged.fd, data, offset)
+
+    async def truncate(self, staged: Staged, length: int) -> None:
+        if length > staged.size:
+            await self._reserve(length - staged.size)
+        else:
+            await self._free(staged.size - length)
+        os.ftruncate(staged.fd, length)
+        staged.size = length
+        staged.version += 1
+
+    @staticmethod
+    def read(staged: Staged, size: int, offset: int) -> bytes:
+        return os.pread(staged.fd, size, offset)
+
+    async def fsync(self, staged: Staged) -> None:
+        """
+        Raise UploadFailed if fsync mode is 'upload' and file isn't uploaded
+        """
+        if self._config.fsync == FsyncMode.NONE:
+            return
+        await asyncio.to_thread(os.fsync, staged.fd)
+        if self._config.fsync != FsyncMode.UPLOAD:
+            return
+
+        version = staged.version
+        staged.sync_count += 1
+        try:
+            if id(staged) not in self._uploads:
+                self._schedule(staged, 0)
+            async with self._changed:
+                while staged.uploaded_version < version and not staged.deleted:
+                    if staged.failed_version >= version:
+                        raise exceptions.UploadFailed()
+                    await self._changed.wait()
+        finally:
+            staged.sync_count -= 1
+
+    def release(self, staged: Staged) -> None:
+        staged.open_count -= 1
+        if not staged.open_count:
+            self._schedule(staged, self._config.flush_delay)
+
+    async def unlink(self, filename: str) -> None:
+        """
+        Delete staged file and file in catalog
+
+        Raise UnknownFile if there is neither of them
+        """
+        staged = self._staged.pop(filename, None)
+        if staged:
+            staged.deleted = True
+            self._cancel_timer(staged)
+            if id(staged) not in self._uploads and not staged.open_count:
+                await self._discard(staged)
+        try:
+            file = await self._block_repo.get_file_by_filename(filename)
+        except exceptions.UnknownFile:
+            if not staged:
+                raise
+            return
+        await self._delete_file(file)
+
+    async def rename(self, old: str, new: str) -> None:
+        """
+        Rename staged file or file in catalog, file with new name is replaced
+
+        Raise UnknownFile if there is no old file
+        """
+        staged = self._staged.get(old)
+        if not staged:
+            await self._block_repo.get_file_by_filename(old)
+        try:
+            await self.unlink(new)
+        except exceptions.UnknownFile:
+            pass
+
+        if not staged:
+            await self._block_repo.rename_file(entity.File(filename=old), new)
+            await self._block_repo.commit()
+            return
+
+        # the previous content of old in catalog is replaced by staged one under new name
+        try:
+            await self._delete_file(await self._block_repo.get_file_by_filename(old))
+        except exceptions.UnknownFile:
+            pass
+        del self._staged[old]
+        staged.filename = new
+        self._write_name(staged)
+        self._staged[new] = staged
+        if not staged.open_count:
+            self._schedule(staged, self._config.flush_delay)
+
+    async def _discard(self, staged: Staged) -> None:
+        """
+        Remove staged file unless it is open or was changed after upload
+        """
+        if staged.open_count or (not staged.deleted and staged.uploaded_version != staged.version):
+            return
+        if self._staged.get(staged.filename) is staged:
+            del self._staged[staged.filename]
+        os.close(staged.fd)
+        os.remove(staged.path)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(staged.path + ".name")
+        await self._free(staged.size)
+
+    # UPLOAD
+
+    def _cancel_timer(self, staged: Staged) -> None:
+        timer = self._timers.pop(id(staged), None)
+        if timer:
+            timer.cancel()
+
+    def _schedule(self, staged: Staged, delay: float) -> None:
+        """
+        Upload staged file after delay, file being uploaded is uploaded again when its upload ends
+        """
+        self._cancel_timer(staged)
+        if id(staged) in self._uploads:
+            return
+        self._timers[id(staged)] = asyncio.get_running_loop().call_later(delay, self._start_upload, staged)
+
+    def _start_upload(self, staged: Staged) -> None:
+        self._timers.pop(id(staged), None)
+        task = asyncio.create_task(self._upload(staged))
+        self._uploads[id(staged)] = task
+        task.add_done_callback(lambda _: self._uploaded(staged))
+
+    def _uploaded(self, staged: Staged) -> None:
+        del self._uploads[id(staged)]
+        if staged.deleted:
+            if not staged.open_count:
+                asyncio.create_task(self._discard(staged))
+        elif staged.uploaded_version == staged.version and not staged.open_count:
+            asyncio.create_task(self._discard(staged))
+        elif staged.failed_version == staged.version:
+            self._schedule(staged, self._config.retry_delay)
+        elif staged.sync_count:
+            self._schedule(staged, 0)
+        elif not staged.open_count:
+            self._schedule(staged, self._config.flush_delay)
+        asyncio.create_task(self._notify())
+
+    async def _notify(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def _upload(self, staged: Staged) -> None:
+        async with self._semaphore:
+            if staged.deleted:
+                return
+            version = staged.version
+            # the copy is uploaded, so file can be written during upload
+            snapshot = staged.path + ".upload"
+            await asyncio.to_thread(shutil.copyfile, staged.path, snapshot)
+            file = entity.File(filename=UPLOAD_DIRECTORY + uuid.uuid4().hex,
+                               path=snapshot,
+                               duplicate_count=self._config.duplicate_count,
+                               need_encrypt=self._config.need_encrypt)
+            try:
+                self._balancer.fill_file(file)
+                try:
+                    base = await self._block_repo.get_file_by_filename(staged.filename)
+                except exceptions.UnknownFile:
+                    base = None
+                async with Uploader(self._balancer, self._block_repo,
+                                    UploaderConfig(parallel_num=self._config.block_parallel_num)) as uploader:
+                    if await uploader.upload_file(file, base):
+                        raise exceptions.UploadFailed()
+                if staged.deleted:
+                    await self._delete_file(file)
+                    return
+                await self._versions.replace(file, staged.filename, self._config.keep_versions)
+            except (exceptions.ErrorBase, OSError) as e:
+                logger.exception(e)
+                logger.error(f"Cannot upload {staged.filename}, retry in {self._config.retry_delay}s")
+                staged.failed_version = version
+                if file.id:
+                    await self._delete_file(file)
+                return
+            finally:
+                os.remove(snapshot)
+
+        staged.uploaded_version = version
+        logger.info(f"Uploaded {staged.filename} ({staged.size} bytes)")
+
+    async def _delete_file(self, file: entity.File) -> None:
+        await self._versions.delete_files([file])
+
+    async def drain(self) -> None:
+        """
+        Upload all closed staged files now and wait for their uploads
+        """
+        for staged in list(self._staged.values()):
+            if id(staged) in self._timers:
+                self._schedule(staged, 0)
+        async with self._changed:
+            while self._uploads or any(id(staged) in self._timers and staged.failed_version < staged.version
+                                       for staged in self._staged.values()):
+                await self._changed.wait()